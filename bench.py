@@ -0,0 +1,394 @@
+"""Бенчмарки бота.
+
+Запуск: python bench.py <бенчмарк> [параметры]
+Токен не нужен: бот импортируется с фиктивными BOT_TOKEN/ADMIN_ID и не подключается к Telegram.
+"""
+import argparse
+import asyncio
+import gc
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+os.environ.setdefault('BOT_TOKEN', '123456:bench')
+os.environ.setdefault('ADMIN_ID', '1')
+
+import bot  # noqa: E402
+from aiogram import Bot, Dispatcher, F  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.filters import StateFilter  # noqa: E402
+from aiogram.fsm.context import FSMContext  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Message, Update, User  # noqa: E402
+from aiohttp import ClientSession, web  # noqa: E402
+
+# ==================== ПАМЯТЬ: ЗАПИСИ ПОЛЬЗОВАТЕЛЕЙ ====================
+
+def make_dict_user(i: int) -> dict:
+    """Старый формат: словарь из cmd_start"""
+    return {
+        'username': f"user{i}",
+        'first_name': f"Имя{i}",
+        'link1': None,
+        'link2': None,
+        'link1_done': False,
+        'link2_done': False,
+        'link1_screenshot': None,
+        'link2_screenshot': None,
+        'link1_rejected': False,
+        'link2_rejected': False,
+        'already_in_bot_1': False,
+        'already_in_bot_2': False,
+        'active_refs': 0,
+        'history': [],
+        'joined_date': '01.01.2025 12:00'
+    }
+
+def make_record_user(i: int) -> bot.UserRecord:
+    """Новый формат: UserRecord"""
+    return bot.UserRecord(username=f"user{i}", first_name=f"Имя{i}", joined_date=1735722000)
+
+def measure(factory, count: int) -> tuple:
+    """Возвращает (байт на пользователя, секунд на создание)"""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    users = {i: factory(i) for i in range(count)}
+    elapsed = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users
+    return size / count, elapsed
+
+def bench_memory(args):
+    """Память на пользователя: dict против UserRecord"""
+    print(f"👥 Пользователей: {args.users}")
+    dict_size, dict_time = measure(make_dict_user, args.users)
+    print(f"dict:       {dict_size:8.0f} байт/польз., {bot.format_size(int(dict_size * args.users))} всего, {dict_time:.2f} сек")
+    record_size, record_time = measure(make_record_user, args.users)
+    print(f"UserRecord: {record_size:8.0f} байт/польз., {bot.format_size(int(record_size * args.users))} всего, {record_time:.2f} сек")
+    print(f"Экономия: {100 * (1 - record_size / dict_size):.0f}%")
+
+# ==================== ТЕКСТЫ: ПРИВЕТСТВИЕ, ПРОФИЛЬ, СТАТУС ====================
+
+def naive_status_text(user_data) -> str:
+    """Старый get_bot_status_text: шесть проверок флагов на каждый вызов"""
+    text = ""
+    for i in (1, 2):
+        name = bot.BOT_LINKS[i - 1]['name']
+        if user_data.get(f'link{i}_done'):
+            text += f"✅ {name}: ВЫПОЛНЕН\n"
+        elif user_data.get(f'link{i}_rejected'):
+            text += f"❌ {name}: ОТКЛОНЕН\n"
+        elif user_data.get(f'already_in_bot_{i}'):
+            text += f"🔄 {name}: УЖЕ БЫЛ В БОТЕ\n"
+        else:
+            text += f"⏳ {name}: В ОЖИДАНИИ\n"
+    return text
+
+def naive_welcome(first_name: str, user_data) -> str:
+    """Старое приветствие из cmd_start"""
+    status1 = "🟢" if user_data.get('link1_done', False) else "🔴"
+    status2 = "🟢" if user_data.get('link2_done', False) else "🔴"
+    return (
+        f"🔰 Здравствуй, {first_name}!\n"
+        f"Добро пожаловать в бот взаимного реферала!\n\n"
+        f"📊 МОИ РЕФЕРАЛЬНЫЕ ССЫЛКИ:\n\n"
+        f"№1 – {bot.BOT_LINKS[0]['name']}\n"
+        f"{bot.BOT_LINKS[0]['url']}\n"
+        f"Статус: {status1}\n\n"
+        f"№2 – {bot.BOT_LINKS[1]['name']}\n"
+        f"{bot.BOT_LINKS[1]['url']}\n"
+        f"Статус: {status2}"
+    )
+
+def per_call(func, records: list) -> float:
+    """Микросекунд на вызов func(record) по всем записям"""
+    started = time.perf_counter()
+    for record in records:
+        func(record)
+    return (time.perf_counter() - started) / len(records) * 1e6
+
+def bench_render(args):
+    """Время сборки текстов: каждый раз заново против шаблонов с мемоизацией"""
+    records = []
+    for i in range(args.users):
+        record = make_record_user(i)
+        record.flags = i % 64
+        records.append(record)
+    print(f"👥 Пользователей: {args.users}")
+    
+    cases = [
+        ("статус", naive_status_text, bot.get_bot_status_text),
+        ("приветствие", lambda r: naive_welcome(r.first_name, r), lambda r: bot.render_welcome(r.first_name, r)),
+    ]
+    for name, naive, rendered in cases:
+        for record in records:
+            assert naive(record) == rendered(record), name
+        before = per_call(naive, records)
+        after = per_call(rendered, records)
+        print(f"{name:12} {before:6.2f} мкс → {after:6.2f} мкс ({before / after:.1f}x)")
+
+# ==================== ЧАСЫ: ОТМЕТКИ ВРЕМЕНИ ====================
+
+def bench_clock(args):
+    """Отметки времени в обработчиках: datetime.now().strftime против грубых часов"""
+    records = [make_record_user(i) for i in range(args.users)]
+    print(f"👥 Пользователей: {args.users}")
+    fmt = bot.DISPLAY_TIME_FORMAT
+    
+    # Запись: регистрация в cmd_start, сообщение поддержки, действие в истории
+    before = per_call(lambda r: datetime.now().strftime(fmt), records)
+    after = per_call(lambda r: bot.clock.now(), records)
+    print(f"{'запись':12} {before:6.2f} мкс → {after:6.2f} мкс ({before / after:.1f}x)")
+    
+    # Показ: профиль и история (время меняется не чаще раза в минуту)
+    timestamp = bot.clock.now()
+    before = per_call(lambda r: datetime.fromtimestamp(timestamp).strftime(fmt), records)
+    after = per_call(lambda r: bot.format_timestamp(timestamp), records)
+    print(f"{'показ':12} {before:6.2f} мкс → {after:6.2f} мкс ({before / after:.1f}x)")
+
+# ==================== ДИСПЕТЧЕРИЗАЦИЯ CALLBACK-КНОПОК ====================
+
+def make_callback_update(update_id: int, data: str) -> Update:
+    return Update(update_id=update_id, callback_query=CallbackQuery(
+        id=str(update_id), chat_instance='bench', data=data,
+        from_user=User(id=update_id, is_bot=False, first_name="bench"),
+    ))
+
+def filter_dispatcher(actions: list) -> Dispatcher:
+    """Старая схема: по обработчику с фильтром F.data == ... на действие"""
+    dp = Dispatcher()
+    for action in actions:
+        async def handler(callback: CallbackQuery):
+            pass
+        dp.callback_query.register(handler, F.data == action)
+    return dp
+
+def router_dispatcher(actions: list) -> Dispatcher:
+    """Новая схема: один обработчик и CallbackRouter"""
+    dp = Dispatcher()
+    router = bot.CallbackRouter()
+    for action in actions:
+        async def handler(callback: CallbackQuery):
+            pass
+        router.action(action)(handler)
+    dp.callback_query.register(router.dispatch)
+    return dp
+
+def make_message_update(update_id: int) -> Update:
+    user = User(id=update_id, is_bot=False, first_name="bench")
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id, date=0, text="bench", from_user=user,
+        chat=Chat(id=update_id, type='private'),
+    ))
+
+def state_filter_dispatcher(states: list) -> Dispatcher:
+    """Старая схема: по обработчику с фильтром состояния на состояние"""
+    dp = Dispatcher()
+    for state in states:
+        async def handler(message: Message, state: FSMContext):
+            pass
+        dp.message.register(handler, StateFilter(state))
+    return dp
+
+def state_router_dispatcher(states: list) -> Dispatcher:
+    """Новая схема: одно чтение состояния и MessageRouter"""
+    dp = Dispatcher()
+    router = bot.MessageRouter()
+    for state in states:
+        async def handler(message: Message, state: FSMContext):
+            pass
+        router.state(state)(handler)
+    
+    async def fallback(message: Message, state: FSMContext):
+        pass
+    
+    async def route(message: Message, state: FSMContext):
+        await router.dispatch(message, state, fallback)
+    dp.message.register(route)
+    return dp
+
+async def set_states(dp: Dispatcher, updates: list, states: list):
+    """Ставит каждому отправителю состояние по кругу"""
+    for i, update in enumerate(updates):
+        key = StorageKey(bot_id=bot.bot.id, chat_id=update.message.chat.id, user_id=update.message.from_user.id)
+        await dp.storage.set_state(key, states[i % len(states)])
+
+async def per_update(dp: Dispatcher, updates: list) -> float:
+    """Микросекунд на апдейт"""
+    started = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot.bot, update)
+    return (time.perf_counter() - started) / len(updates) * 1e6
+
+def bench_dispatch(args):
+    """Стоимость выбора обработчика callback: цепочка фильтров против словаря"""
+    actions = sorted(bot.callbacks.handlers)
+    print(f"🔘 Действий: {len(actions)}, апдейтов: {args.updates}")
+    
+    async def run():
+        for label, picked in (("первое", actions[:1]), ("последнее", actions[-1:]), ("все", actions)):
+            updates = [make_callback_update(i, picked[i % len(picked)]) for i in range(args.updates)]
+            before = await per_update(filter_dispatcher(actions), updates)
+            after = await per_update(router_dispatcher(actions), updates)
+            print(f"{label:12} {before:6.1f} мкс → {after:6.1f} мкс ({before / after:.1f}x)")
+    
+    asyncio.run(run())
+
+def bench_messages(args):
+    """Стоимость выбора обработчика сообщения: фильтры состояний против словаря"""
+    states = list(bot.ReferralStates.__all_states__)
+    print(f"🗂 Состояний: {len(states)}, апдейтов: {args.updates}")
+    updates = [make_message_update(i) for i in range(1, args.updates + 1)]
+    
+    async def run():
+        for label, picked in (("первое", states[:1]), ("последнее", states[-1:]), ("все", states)):
+            old, new = state_filter_dispatcher(states), state_router_dispatcher(states)
+            await set_states(old, updates, picked)
+            await set_states(new, updates, picked)
+            before = await per_update(old, updates)
+            after = await per_update(new, updates)
+            print(f"{label:12} {before:6.1f} мкс → {after:6.1f} мкс ({before / after:.1f}x)")
+    
+    asyncio.run(run())
+
+# ==================== ТРАНСПОРТ: POLLING ПРОТИВ ВЕБХУКА ====================
+
+class StubTelegram:
+    """Заглушка Bot API на localhost.
+
+    Отдает апдейты через long polling getUpdates или отправляет их на вебхук
+    и отмечает, когда на апдейт пришел ответ sendMessage. delay - задержка
+    каждого ответа API (имитация сети до Telegram).
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.replies = {}  # chat_id -> future со временем ответа
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        data = await request.post()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        result = True
+        if method == 'getupdates':
+            try:
+                result = [await asyncio.wait_for(self.updates.get(), float(data.get('timeout') or 1))]
+            except asyncio.TimeoutError:
+                result = []
+        elif method == 'getme':
+            result = {'id': 123456, 'is_bot': True, 'first_name': "bench", 'username': "bench_bot"}
+        elif method == 'sendmessage':
+            chat_id = int(data['chat_id'])
+            reply = self.replies.pop(chat_id, None)
+            if reply is not None:
+                reply.set_result(time.perf_counter())
+            result = {'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': data['text']}
+        return web.json_response({'ok': True, 'result': result})
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        self.replies[chat_id] = asyncio.get_running_loop().create_future()
+        return self.replies[chat_id]
+
+def start_update(update_id: int) -> dict:
+    """/start от нового пользователя: cmd_start со всеми middleware и базой"""
+    user = {'id': update_id, 'is_bot': False, 'first_name': "bench"}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': "/start", 'from': user,
+        'chat': {'id': update_id, 'type': 'private'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    }}
+
+async def serve(app: web.Application) -> tuple:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    return runner, runner.addresses[0][1]
+
+def latency_line(label: str, samples: list) -> str:
+    ms = sorted(sample * 1000 for sample in samples)
+    p95 = ms[int(len(ms) * 0.95) - 1]
+    p99 = ms[int(len(ms) * 0.99) - 1]
+    return f"{label:8} p50 {statistics.median(ms):6.2f} мс, p95 {p95:6.2f} мс, p99 {p99:6.2f} мс, среднее {statistics.fmean(ms):6.2f} мс"
+
+def bench_transport(args):
+    """Задержка от апдейта до ответа: long polling против вебхука (заглушка Bot API)"""
+    os.chdir(tempfile.mkdtemp())  # отдельная база для cmd_start
+    bot.db.connect()
+    bot.db.load()
+    count = min(args.updates, 2000)
+    print(f"📨 Апдейтов: {count}, задержка API: {args.api_delay * 1000:.0f} мс")
+    
+    async def run():
+        stub = StubTelegram(args.api_delay)
+        stub_runner, stub_port = await serve(stub.app)
+        # Бот без очереди исходящих: сравнивается транспорт, а не лимиты Telegram
+        bench_bot = Bot(bot.BOT_TOKEN, session=AiohttpSession(
+            api=TelegramAPIServer.from_base(f"http://127.0.0.1:{stub_port}")))
+        next_id = iter(range(1_000_000, 2_000_000))
+        
+        # Long polling
+        polling = asyncio.create_task(bot.dp.start_polling(bench_bot, handle_signals=False, close_bot_session=False))
+        samples = []
+        for _ in range(count):
+            update_id = next(next_id)
+            reply = stub.expect_reply(update_id)
+            started = time.perf_counter()
+            stub.updates.put_nowait(start_update(update_id))
+            samples.append(await reply - started)
+        print(latency_line("polling", samples))
+        await bot.dp.stop_polling()
+        await polling
+        
+        # Вебхук
+        secret = "bench-secret"
+        webhook_runner, webhook_port = await serve(bot.build_webhook_app(bot.dp, bench_bot, secret))
+        url = f"http://127.0.0.1:{webhook_port}{bot.WEBHOOK_PATH}"
+        samples = []
+        async with ClientSession() as http:
+            async with http.post(url, json=start_update(0), headers={'X-Telegram-Bot-Api-Secret-Token': "wrong"}) as response:
+                assert response.status == 401, response.status
+            for _ in range(count):
+                update_id = next(next_id)
+                reply = stub.expect_reply(update_id)
+                started = time.perf_counter()
+                async with http.post(url, json=start_update(update_id),
+                                     headers={'X-Telegram-Bot-Api-Secret-Token': secret}) as response:
+                    assert response.status == 200, response.status
+                samples.append(await reply - started)
+        print(latency_line("webhook", samples))
+        
+        await webhook_runner.cleanup()
+        await stub_runner.cleanup()
+    
+    asyncio.run(run())
+
+BENCHMARKS = {
+    'memory': bench_memory,
+    'render': bench_render,
+    'clock': bench_clock,
+    'dispatch': bench_dispatch,
+    'messages': bench_messages,
+    'transport': bench_transport,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--users', type=int, default=1_000_000, help="число синтетических пользователей")
+    parser.add_argument('--updates', type=int, default=20_000, help="число синтетических апдейтов")
+    parser.add_argument('--api-delay', type=float, default=0.0, help="задержка ответов заглушки Bot API, сек")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,42 @@
 import asyncio
+import bisect
+import contextlib
+import cProfile
+import functools
+import inspect
+import io
+import heapq
+import json
 import logging
+import pstats
 import re
-from typing import Optional, Dict, Any, List
+import secrets
+import signal
+import sqlite3
+import threading
+import time
+import traceback
+from typing import Optional, Dict, Any, List, Tuple, Callable, Awaitable, Iterable
+from array import array
+from collections import OrderedDict, deque
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, F, types
+from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
-    ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InputMediaPhoto
+    ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InputMediaPhoto, Update
 )
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import (
+    SendMessage, SendPhoto, SendMediaGroup, SendDocument, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageCaption, EditMessageReplyMarkup
+)
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
 import os
 import sys
@@ -62,13 +86,1029 @@ RULES_TEXT = """
 • Не спрашивать был ли я в боте — доп ссылка запрашивается автоматически
 """
 
+# Причины отклонения ссылки (код -> текст); в callback_data передается индекс в REJECT_REASON_CODES
+REJECT_REASONS = {
+    "more_6": "Больше 6 спонсоров",
+    "already_in_bot": "Вы уже были в этом боте",
+    "bad_screenshot": "Некорректный скриншот",
+    "other": "Другая причина"
+}
+REJECT_REASON_CODES = list(REJECT_REASONS)
+
+# ==================== ЧАСЫ ====================
+
+DISPLAY_TIME_FORMAT = '%d.%m.%Y %H:%M'
+
+class Clock:
+    """Грубые часы: текущее время в целых секундах эпохи.
+
+    Значение обновляет фоновая задача раз в секунду, поэтому обработчики
+    берут готовое число вместо datetime.now(). Все отметки времени хранятся
+    как int, в строку они превращаются только при показе (format_timestamp).
+    """
+
+    def __init__(self):
+        self._now = int(time.time())
+
+    def now(self) -> int:
+        return self._now
+
+    async def run(self):
+        """Фоновая задача обновления времени (на границе секунды)"""
+        while True:
+            current = time.time()
+            self._now = int(current)
+            await asyncio.sleep(1 - current % 1)
+
+class FakeClock(Clock):
+    """Часы для тестов и бенчмарков: время идет только через advance()"""
+
+    def __init__(self, start: int = 0):
+        self._now = start
+
+    def advance(self, seconds: int):
+        self._now += seconds
+
+    async def run(self):
+        pass
+
+clock: Clock = Clock()
+
+def set_clock(new_clock: Clock):
+    """Подменяет часы (например, на FakeClock)"""
+    global clock
+    clock = new_clock
+
+@functools.lru_cache(maxsize=4096)
+def _format_minute(minute: int) -> str:
+    return datetime.fromtimestamp(minute * 60).strftime(DISPLAY_TIME_FORMAT)
+
+def format_timestamp(timestamp: Optional[int]) -> str:
+    """Отметка времени для показа (строки кэшируются по минутам)"""
+    if timestamp is None:
+        return "Неизвестно"
+    return _format_minute(int(timestamp) // 60)
+
+def parse_timestamp(value) -> Optional[int]:
+    """Отметка времени из int или из строки старого формата ('31.12.2024 23:59')"""
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return int(datetime.strptime(value, DISPLAY_TIME_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+# ==================== ИСТОРИЯ ДЕЙСТВИЙ ====================
+
+HISTORY_CAPACITY = int(os.getenv('HISTORY_CAPACITY', '10'))  # действий в памяти на пользователя
+
+# Коды действий. Аргумент: номер ссылки/бота в младшем байте,
+# для отклонения - номер причины (REJECT_REASON_CODES, с 1) во втором
+HISTORY_ACCEPT_RULES = 1
+HISTORY_REJECT_RULES = 2
+HISTORY_ALREADY_IN_BOT = 3
+HISTORY_LINK_SENT = 4
+HISTORY_SCREENSHOT_SENT = 5
+HISTORY_LINK_ACCEPTED = 6
+HISTORY_LINK_REJECTED = 7
+HISTORY_SECOND_SKIPPED = 8
+
+HISTORY_TEXTS = {
+    HISTORY_ACCEPT_RULES: "Принял правила",
+    HISTORY_REJECT_RULES: "Отказ от правил",
+    HISTORY_ALREADY_IN_BOT: "Отметил, что уже был в {bot}",
+    HISTORY_LINK_SENT: "Отправил ссылку №{num}",
+    HISTORY_SCREENSHOT_SENT: "Отправил скриншот №{num}",
+    HISTORY_LINK_ACCEPTED: "Ссылка №{num} принята админом",
+    HISTORY_LINK_REJECTED: "Ссылка №{num} отклонена: {reason}",
+    HISTORY_SECOND_SKIPPED: "Админ пропустил вторую ссылку",
+}
+
+def pack_history(timestamp: int, action: int, arg: int = 0) -> int:
+    """Упаковывает действие в одно int64: время << 24 | код << 16 | аргумент"""
+    return timestamp << 24 | action << 16 | arg
+
+def unpack_history(entry: int) -> Tuple[int, int, int]:
+    """Возвращает (время, код, аргумент)"""
+    return entry >> 24, (entry >> 16) & 0xFF, entry & 0xFFFF
+
+def render_history(entry: int) -> str:
+    """Текст действия для показа в профиле"""
+    timestamp, action, arg = unpack_history(entry)
+    num = arg & 0xFF
+    reason = arg >> 8
+    text = HISTORY_TEXTS.get(action, "Неизвестное действие").format(
+        num=num,
+        bot=BOT_LINKS[num - 1]['name'] if 1 <= num <= len(BOT_LINKS) else f"№{num}",
+        reason=REJECT_REASONS[REJECT_REASON_CODES[reason - 1]] if 1 <= reason <= len(REJECT_REASON_CODES) else "Не указана"
+    )
+    return f"{format_timestamp(timestamp)} - {text}"
+
+class HistoryRing:
+    """Кольцевой буфер последних HISTORY_CAPACITY действий на массиве int64"""
+    __slots__ = ('entries', 'start')
+
+    def __init__(self, entries=()):
+        self.entries = array('q', list(entries)[-HISTORY_CAPACITY:])
+        self.start = 0  # позиция самой старой записи, когда буфер заполнен
+
+    def push(self, entry: int) -> Optional[int]:
+        """Добавляет действие, возвращает вытесненное (или None)"""
+        if len(self.entries) < HISTORY_CAPACITY:
+            self.entries.append(entry)
+            return None
+        evicted = self.entries[self.start]
+        self.entries[self.start] = entry
+        self.start = (self.start + 1) % len(self.entries)
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self):
+        """Действия от старых к новым"""
+        yield from self.entries[self.start:]
+        yield from self.entries[:self.start]
+
+    def last(self, count: int) -> List[int]:
+        return list(self)[-count:]
+
+# ==================== ЗАПИСЬ ПОЛЬЗОВАТЕЛЯ ====================
+
+class UserRecord:
+    """Компактная запись пользователя.
+
+    Поля хранятся в __slots__, флаги статуса упакованы в одно int.
+    Поддерживает доступ как к dict (record['link1_done'], record.get(...)),
+    поэтому обработчики работают с ней так же, как со старым словарем.
+    """
+
+    # Флаги статуса -> бит в self.flags
+    FLAGS = {
+        'link1_done': 1 << 0,
+        'link2_done': 1 << 1,
+        'link1_rejected': 1 << 2,
+        'link2_rejected': 1 << 3,
+        'already_in_bot_1': 1 << 4,
+        'already_in_bot_2': 1 << 5,
+    }
+    FIELDS = (
+        'username', 'first_name', 'link1', 'link2', 'link1_screenshot', 'link2_screenshot',
+        'active_refs', 'attempts', 'history', 'joined_date',
+    )
+    __slots__ = FIELDS + ('flags',)
+
+    def __init__(self, username: Optional[str] = None, first_name: Optional[str] = None,
+                 joined_date: Optional[int] = None):
+        self.username = username
+        self.first_name = first_name
+        self.link1 = None
+        self.link2 = None
+        self.link1_screenshot = None
+        self.link2_screenshot = None
+        self.active_refs = 0
+        self.attempts = 0
+        self.history: Optional[HistoryRing] = None  # создается при первом действии
+        self.joined_date = joined_date  # секунды эпохи
+        self.flags = 0
+
+    def __getitem__(self, key: str):
+        bit = self.FLAGS.get(key)
+        if bit is not None:
+            return bool(self.flags & bit)
+        if key in self.FIELDS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        bit = self.FLAGS.get(key)
+        if bit is not None:
+            self.flags = self.flags | bit if value else self.flags & ~bit
+        elif key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.FLAGS or key in self.FIELDS
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Компактное представление для журнала и снимка"""
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        data['history'] = list(self.history) if self.history else []
+        data['flags'] = self.flags
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'UserRecord':
+        """Создает запись из to_dict() или из старого словаря с отдельными флагами"""
+        record = cls()
+        for key, value in data.items():
+            if key == 'flags':
+                record.flags = value
+            elif key == 'joined_date':
+                # Старый формат хранил строку '%d.%m.%Y %H:%M'
+                record.joined_date = parse_timestamp(value)
+            elif key == 'history':
+                # Старый формат хранил готовые строки - они не переносятся
+                entries = [entry for entry in value if isinstance(entry, int)]
+                record.history = HistoryRing(entries) if entries else None
+            elif key in record:
+                record[key] = value
+        return record
+
+    def __repr__(self) -> str:
+        return f"UserRecord({self.to_dict()!r})"
+
+# ==================== ХРАНИЛИЩЕ ====================
+
+# Файл базы данных и параметры отложенной записи
+DB_PATH = os.getenv('DB_PATH', 'bot.db')
+DB_FLUSH_INTERVAL = float(os.getenv('DB_FLUSH_INTERVAL', '0.5'))  # секунд между транзакциями
+DB_FLUSH_BATCH = int(os.getenv('DB_FLUSH_BATCH', '1000'))  # изменений до внеочередной записи
+
+# Журнал изменений и снимки
+JOURNAL_PATH = os.getenv('JOURNAL_PATH', 'bot.journal')
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', '3600'))  # секунд между снимками
+JOURNAL_MAX_SIZE = int(os.getenv('JOURNAL_MAX_SIZE', str(64 * 1024 * 1024)))  # байт до внеочередного снимка
+
+# Кэш FSM состояний
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))  # записей в памяти
+FSM_SWEEP_INTERVAL = int(os.getenv('FSM_SWEEP_INTERVAL', '600'))  # секунд между очистками
+FSM_DEFAULT_TTL = 86400  # TTL для состояний без своего значения в FSM_STATE_TTL
+
+def _json_default(obj):
+    """Сериализация datetime и UserRecord в журнал и снимок"""
+    if isinstance(obj, UserRecord):
+        return obj.to_dict()
+    if isinstance(obj, datetime):
+        return {'$dt': obj.timestamp()}
+    raise TypeError(f"Тип {type(obj).__name__} не сериализуется в JSON")
+
+def _json_hook(obj: dict):
+    if len(obj) == 1 and '$dt' in obj:
+        return datetime.fromtimestamp(obj['$dt'])
+    return obj
+
+def dump_json(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_json_default)
+
+def load_json(text: str):
+    return json.loads(text, object_hook=_json_hook)
+
+class Database:
+    """Хранилище: журнал изменений + снимок в SQLite (WAL).
+
+    Все данные живут в памяти, обработчики только помечают изменения.
+    Фоновая задача раз в DB_FLUSH_INTERVAL (или каждые DB_FLUSH_BATCH
+    изменений) дописывает их в журнал JOURNAL_PATH в отдельном потоке.
+    Раз в SNAPSHOT_INTERVAL (или при росте журнала больше JOURNAL_MAX_SIZE)
+    журнал сжимается в снимок в SQLite и обнуляется, поэтому при старте
+    загружается снимок и проигрывается только хвост журнала.
+
+    Записи журнала - JSON-строки [seq, op, ...]:
+        u/u-  пользователь (user_id, data)     m/m-  членство в списке (list, user_id)
+        t/t-  временный бан (user_id, until)   s     сообщение поддержки (user_id, entry)
+        h     запись истории техработ (index, record)
+        r/r-  заявка в очереди проверки (user_id, submitted)
+    FSM состояния, вытесненная из памяти история действий и прогресс
+    рассылок пишутся сразу в SQLite, минуя журнал.
+    """
+
+    def __init__(self, path: str, journal_path: str):
+        self.path = path
+        self.journal_path = journal_path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.reader: Optional[sqlite3.Connection] = None
+        self.journal = None
+        self.seq = 0
+        self.snapshot_seq = 0
+        self._dirty_users: set = set()
+        self._dirty_members: Dict[Tuple[str, int], bool] = {}
+        self._dirty_temp_bans: set = set()
+        self._dirty_maintenance: set = set()
+        self._dirty_review: set = set()
+        self._support_appends: List[Tuple[int, Dict]] = []
+        self._dirty_fsm: Dict[str, Optional[tuple]] = {}
+        self._history_spill: List[Tuple[int, int]] = []
+        self._dirty_broadcasts: Dict[int, tuple] = {}
+        self._last_broadcast_id = 0
+        self._pending = 0
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._unwritten = None  # пачка, запись которой не удалась (повторяется первой)
+        self._last_snapshot = time.monotonic()
+        self.flushes = 0
+        self.written = 0
+        self.journal_records = 0
+        self.journal_bytes = 0  # размер журнала; меняют только потоки записи под _flush_lock
+        self.replayed = 0
+        self.replay_time = 0.0
+
+    def connect(self):
+        """Открывает базу и журнал, создает таблицы"""
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS members (
+                list TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (list, user_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS temp_bans (
+                user_id INTEGER PRIMARY KEY,
+                until REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS support (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS maintenance (
+                idx INTEGER PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS review (
+                user_id INTEGER PRIMARY KEY,
+                submitted REAL NOT NULL,
+                decided INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS fsm_state_updated ON fsm (state, updated);
+            CREATE TABLE IF NOT EXISTS history (
+                user_id INTEGER NOT NULL,
+                entry INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS history_user ON history (user_id);
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL,
+                last_user_id INTEGER NOT NULL,
+                sent INTEGER NOT NULL,
+                failed INTEGER NOT NULL,
+                skipped INTEGER NOT NULL,
+                created REAL NOT NULL,
+                report_chat_id INTEGER,
+                report_message_id INTEGER
+            );
+        """)
+        # Базы, созданные до сохранения решений модераторов
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(review)")}
+        if 'decided' not in columns:
+            self.conn.execute("ALTER TABLE review ADD COLUMN decided INTEGER NOT NULL DEFAULT 0")
+        # Отдельное соединение для чтения, чтобы не мешать транзакциям записи
+        self.reader = sqlite3.connect(self.path, check_same_thread=False)
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.journal_bytes = self.journal.tell()
+
+    def load(self):
+        """Загружает снимок и проигрывает хвост журнала (вызывается один раз при старте)"""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'snapshot_seq'").fetchone()
+        self.snapshot_seq = self.seq = int(row[0]) if row else 0
+        
+        for user_id, data in self.conn.execute("SELECT user_id, data FROM users"):
+            users_db[user_id] = UserRecord.from_dict(load_json(data))
+        
+        for name, user_id in self.conn.execute("SELECT list, user_id FROM members"):
+            member_lists[name].load([user_id])
+        
+        for user_id, until in self.conn.execute("SELECT user_id, until FROM temp_bans"):
+            dict.__setitem__(temp_bans, user_id, datetime.fromtimestamp(until))
+        
+        for user_id, data in self.conn.execute("SELECT user_id, data FROM support ORDER BY id"):
+            support_chats.setdefault(user_id, []).append(load_json(data))
+        
+        for idx, data in self.conn.execute("SELECT idx, data FROM maintenance ORDER BY idx"):
+            self._set_maintenance(idx, load_json(data))
+        
+        self._last_broadcast_id = self.conn.execute("SELECT MAX(id) FROM broadcasts").fetchone()[0] or 0
+        
+        for user_id, submitted, decided in self.conn.execute(
+                "SELECT user_id, submitted, decided FROM review ORDER BY submitted"):
+            review_queue.load(user_id, submitted, decided)
+        
+        started = time.perf_counter()
+        self.replayed = 0
+        for record in self._read_journal():
+            self._replay(record)
+            self.replayed += 1
+        self.replay_time = time.perf_counter() - started
+        self.journal_records = self.replayed
+        stats.reset()
+        
+        logger.info(
+            f"💾 Загружено из {self.path}: {len(users_db)} пользователей, "
+            f"{len(blacklist)} в ЧС, {len(temp_bans)} временных банов; "
+            f"из журнала {self.replayed} записей за {self.replay_time:.3f} сек"
+        )
+
+    def _read_journal(self):
+        """Читает записи журнала новее снимка"""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = load_json(line)
+                except ValueError:
+                    # Оборванная последняя строка после аварийного завершения
+                    logger.warning("⚠️ Пропущена поврежденная запись журнала")
+                    continue
+                if record[0] > self.snapshot_seq:
+                    self.seq = max(self.seq, record[0])
+                    yield record
+
+    @staticmethod
+    def _set_maintenance(idx: int, record: Dict):
+        while len(maintenance_history) <= idx:
+            maintenance_history.append({})
+        maintenance_history[idx] = record
+
+    def _replay(self, record: list):
+        """Применяет запись журнала к данным в памяти"""
+        op = record[1]
+        if op == 'u':
+            users_db[record[2]] = UserRecord.from_dict(record[3])
+        elif op == 'u-':
+            users_db.pop(record[2], None)
+        elif op == 'm':
+            member_lists[record[2]].load([record[3]])
+        elif op == 'm-':
+            set.discard(member_lists[record[2]], record[3])
+        elif op == 't':
+            dict.__setitem__(temp_bans, record[2], datetime.fromtimestamp(record[3]))
+        elif op == 't-':
+            dict.pop(temp_bans, record[2], None)
+        elif op == 's':
+            support_chats.setdefault(record[2], []).append(record[3])
+        elif op == 'h':
+            self._set_maintenance(record[2], record[3])
+        elif op == 'r':
+            # Записи до сохранения решений модераторов - без маски
+            review_queue.load(record[2], record[3], record[4] if len(record) > 4 else 0)
+        elif op == 'r-':
+            review_queue.pending.pop(record[2], None)
+            review_queue.decided.pop(record[2], None)
+
+    def _mark(self):
+        self._pending += 1
+        if self._pending >= DB_FLUSH_BATCH:
+            self._wakeup.set()
+
+    def mark_user(self, user_id: int):
+        """Помечает запись пользователя для сохранения"""
+        self._dirty_users.add(user_id)
+        self._mark()
+
+    def mark_member(self, name: str, user_id: int, present: bool):
+        """Помечает изменение членства в списке (ЧС, админы, ...)"""
+        self._dirty_members[(name, user_id)] = present
+        self._mark()
+
+    def mark_temp_ban(self, user_id: int):
+        """Помечает изменение временного бана"""
+        self._dirty_temp_bans.add(user_id)
+        self._mark()
+
+    def mark_support(self, user_id: int, entry: Dict):
+        """Добавляет сообщение поддержки в журнал"""
+        self._support_appends.append((user_id, entry))
+        self._mark()
+
+    def mark_maintenance(self, idx: int):
+        """Помечает запись истории техработ для сохранения"""
+        self._dirty_maintenance.add(idx)
+        self._mark()
+
+    def mark_review(self, user_id: int):
+        """Помечает изменение заявки в очереди проверки"""
+        self._dirty_review.add(user_id)
+        self._mark()
+
+    def mark_fsm(self, key: str, row: Optional[tuple]):
+        """Помечает запись FSM для сохранения (None - удалить)"""
+        self._dirty_fsm[key] = row
+        self._mark()
+
+    def mark_history_spill(self, user_id: int, entry: int):
+        """Сохраняет вытесненное из кольцевого буфера действие в архив"""
+        self._history_spill.append((user_id, entry))
+        self._mark()
+
+    def mark_broadcast(self, row: tuple):
+        """Сохраняет состояние рассылки"""
+        self._dirty_broadcasts[row[0]] = row
+        self._last_broadcast_id = max(self._last_broadcast_id, row[0])
+        self._mark()
+
+    def next_broadcast_id(self) -> int:
+        """Номер новой рассылки (без запроса к соединению, которым пишет поток)"""
+        return self._last_broadcast_id + 1
+
+    def load_active_broadcast(self) -> Optional[tuple]:
+        """Незавершенная рассылка (вызывается при старте)"""
+        return self.conn.execute(
+            "SELECT id, text, status, last_user_id, sent, failed, skipped, created, "
+            "report_chat_id, report_message_id FROM broadcasts WHERE status = 'active' "
+            "ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+
+    async def load_fsm(self, key: str) -> Optional[tuple]:
+        """Читает запись FSM (state, data, updated), учитывая еще не записанные изменения"""
+        if key in self._dirty_fsm:
+            return self._dirty_fsm[key]
+        started = time.perf_counter()
+        try:
+            return await asyncio.to_thread(self._read_fsm, key)
+        finally:
+            m_storage_latency.observe(time.perf_counter() - started, 'fsm_read')
+
+    def _read_fsm(self, key: str) -> Optional[tuple]:
+        return self.reader.execute(
+            "SELECT state, data, updated FROM fsm WHERE key = ?", (key,)
+        ).fetchone()
+
+    def _sweep_fsm(self, ttls: Dict[str, int], default_ttl: int, now: float) -> int:
+        """Удаляет из базы записи FSM с истекшим TTL"""
+        conn = self.conn
+        deleted = 0
+        conn.execute("BEGIN")
+        try:
+            for state, ttl in ttls.items():
+                deleted += conn.execute(
+                    "DELETE FROM fsm WHERE state = ? AND updated < ?", (state, now - ttl)
+                ).rowcount
+            placeholders = ",".join("?" * len(ttls))
+            deleted += conn.execute(
+                f"DELETE FROM fsm WHERE (state IS NULL OR state NOT IN ({placeholders})) AND updated < ?",
+                (*ttls, now - default_ttl)
+            ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return deleted
+
+    async def sweep_fsm(self, ttls: Dict[str, int], default_ttl: int, now: float) -> int:
+        async with self._flush_lock:
+            return await asyncio.to_thread(self._sweep_fsm, ttls, default_ttl, now)
+
+    def _journal_line(self, *record) -> str:
+        self.seq += 1
+        return dump_json([self.seq, *record]) + '\n'
+
+    def _take_batch(self) -> Optional[Tuple[List[str], List[tuple], List[tuple], List[tuple], List[tuple]]]:
+        """Забирает накопленные изменения и сериализует их (в потоке event loop)"""
+        if not self._pending:
+            return None
+        
+        lines = []
+        for user_id in self._dirty_users:
+            data = users_db.get(user_id)
+            lines.append(self._journal_line('u-', user_id) if data is None
+                         else self._journal_line('u', user_id, data))
+        
+        for (name, user_id), present in self._dirty_members.items():
+            lines.append(self._journal_line('m' if present else 'm-', name, user_id))
+        
+        for user_id in self._dirty_temp_bans:
+            until = temp_bans.get(user_id)
+            lines.append(self._journal_line('t-', user_id) if until is None
+                         else self._journal_line('t', user_id, until.timestamp()))
+        
+        for user_id, entry in self._support_appends:
+            lines.append(self._journal_line('s', user_id, entry))
+        
+        for idx in sorted(self._dirty_maintenance):
+            lines.append(self._journal_line('h', idx, maintenance_history[idx]))
+        
+        for user_id in self._dirty_review:
+            submitted = review_queue.pending.get(user_id)
+            lines.append(self._journal_line('r-', user_id) if submitted is None
+                         else self._journal_line('r', user_id, submitted, review_queue.decided.get(user_id, 0)))
+        
+        fsm, fsm_del = [], []
+        for key, row in self._dirty_fsm.items():
+            if row is None:
+                fsm_del.append((key,))
+            else:
+                fsm.append((key, *row))
+        
+        self._dirty_users = set()
+        self._dirty_members = {}
+        self._dirty_temp_bans = set()
+        self._support_appends = []
+        self._dirty_maintenance = set()
+        self._dirty_review = set()
+        history = self._history_spill
+        broadcasts = list(self._dirty_broadcasts.values())
+        
+        self._dirty_fsm = {}
+        self._history_spill = []
+        self._dirty_broadcasts = {}
+        self._pending = 0
+        return lines, fsm, fsm_del, history, broadcasts
+
+    def _write(self, lines: List[str], fsm: List[tuple], fsm_del: List[tuple], history: List[tuple],
+               broadcasts: List[tuple]):
+        """Дописывает журнал, обновляет FSM, архив истории и рассылки (в отдельном потоке)"""
+        if lines:
+            position = self.journal_bytes
+            try:
+                self.journal.write(''.join(lines))
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+            except Exception:
+                self._truncate_journal(position)
+                raise
+            self.journal_bytes = self.journal.tell()
+            # Журнал записан - при повторе пачки пишем только таблицы
+            lines.clear()
+        
+        if fsm or fsm_del or history or broadcasts:
+            conn = self.conn
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO fsm (key, state, data, updated) VALUES (?, ?, ?, ?)", fsm)
+                conn.executemany("DELETE FROM fsm WHERE key = ?", fsm_del)
+                conn.executemany("INSERT INTO history (user_id, entry) VALUES (?, ?)", history)
+                conn.executemany("INSERT OR REPLACE INTO broadcasts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", broadcasts)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _truncate_journal(self, position: int):
+        """Отрезает недописанный хвост журнала, чтобы повтор начался с целой строки"""
+        try:
+            self.journal.close()
+        except OSError:
+            pass
+        os.truncate(self.journal_path, position)
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.journal_bytes = position
+
+    async def _write_batch(self, batch: tuple):
+        # Пачка остается в _unwritten, пока запись не удалась
+        self._unwritten = batch
+        records = len(batch[0])
+        rows = sum(len(rows) for rows in batch)
+        started = time.perf_counter()
+        await asyncio.to_thread(self._write, *batch)
+        m_storage_latency.observe(time.perf_counter() - started, 'flush')
+        self._unwritten = None
+        self.flushes += 1
+        self.journal_records += records
+        self.written += rows
+
+    async def _flush_locked(self):
+        # Не записанная пачка уже получила номера seq - пишем ее раньше новых
+        # изменений, иначе журнал нарушит порядок
+        if self._unwritten is not None:
+            await self._write_batch(self._unwritten)
+        batch = self._take_batch()
+        if batch is not None:
+            await self._write_batch(batch)
+
+    async def flush(self):
+        """Сбрасывает накопленные изменения на диск"""
+        async with self._flush_lock:
+            await self._flush_locked()
+
+    def journal_size(self) -> int:
+        """Размер журнала в байтах (без обращения к файлу, который может писать поток)"""
+        return self.journal_bytes
+
+    def _compact(self) -> int:
+        """Переносит журнал в снимок SQLite и обнуляет журнал (в отдельном потоке)"""
+        users: Dict[int, Optional[str]] = {}
+        members: Dict[Tuple[str, int], bool] = {}
+        bans: Dict[int, Optional[float]] = {}
+        support: List[Tuple[int, str]] = []
+        maintenance: Dict[int, str] = {}
+        review: Dict[int, Optional[Tuple[float, int]]] = {}
+        last_seq = self.snapshot_seq
+        records = 0
+        
+        # Схлопываем журнал: для каждого ключа важна только последняя запись
+        for record in self._read_journal():
+            records += 1
+            last_seq = record[0]
+            op = record[1]
+            if op in ('u', 'u-'):
+                users[record[2]] = dump_json(record[3]) if op == 'u' else None
+            elif op in ('m', 'm-'):
+                members[(record[2], record[3])] = op == 'm'
+            elif op in ('t', 't-'):
+                bans[record[2]] = record[3] if op == 't' else None
+            elif op == 's':
+                support.append((record[2], dump_json(record[3])))
+            elif op == 'h':
+                maintenance[record[2]] = dump_json(record[3])
+            elif op in ('r', 'r-'):
+                review[record[2]] = (record[3], record[4] if len(record) > 4 else 0) if op == 'r' else None
+        
+        conn = self.conn
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)",
+                             [(k, v) for k, v in users.items() if v is not None])
+            conn.executemany("DELETE FROM users WHERE user_id = ?",
+                             [(k,) for k, v in users.items() if v is None])
+            conn.executemany("INSERT OR IGNORE INTO members (list, user_id) VALUES (?, ?)",
+                             [k for k, v in members.items() if v])
+            conn.executemany("DELETE FROM members WHERE list = ? AND user_id = ?",
+                             [k for k, v in members.items() if not v])
+            conn.executemany("INSERT OR REPLACE INTO temp_bans (user_id, until) VALUES (?, ?)",
+                             [(k, v) for k, v in bans.items() if v is not None])
+            conn.executemany("DELETE FROM temp_bans WHERE user_id = ?",
+                             [(k,) for k, v in bans.items() if v is None])
+            conn.executemany("INSERT INTO support (user_id, data) VALUES (?, ?)", support)
+            conn.executemany("INSERT OR REPLACE INTO maintenance (idx, data) VALUES (?, ?)",
+                             list(maintenance.items()))
+            conn.executemany("INSERT OR REPLACE INTO review (user_id, submitted, decided) VALUES (?, ?, ?)",
+                             [(k, *v) for k, v in review.items() if v is not None])
+            conn.executemany("DELETE FROM review WHERE user_id = ?",
+                             [(k,) for k, v in review.items() if v is None])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('snapshot_seq', ?)", (str(last_seq),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        
+        # Снимок зафиксирован - журнал можно обнулить. Если упадем до этого,
+        # при старте записи с seq <= snapshot_seq будут пропущены.
+        self.snapshot_seq = last_seq
+        self.journal.close()
+        self.journal = open(self.journal_path, 'w', encoding='utf-8')
+        self.journal_bytes = 0
+        return records
+
+    async def compact(self) -> Dict[str, Any]:
+        """Принудительное сжатие журнала в снимок"""
+        async with self._flush_lock:
+            await self._flush_locked()
+            size_before = self.journal_size()
+            started = time.perf_counter()
+            records = await asyncio.to_thread(self._compact)
+            duration = time.perf_counter() - started
+            m_storage_latency.observe(duration, 'compact')
+            self.journal_records = 0
+            self._last_snapshot = time.monotonic()
+            return {
+                'records': records,
+                'size_before': size_before,
+                'size_after': self.journal_size(),
+                'duration': duration,
+            }
+
+    async def run(self):
+        """Фоновая задача пакетной записи и периодических снимков"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=DB_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if (time.monotonic() - self._last_snapshot > SNAPSHOT_INTERVAL
+                        or self.journal_size() > JOURNAL_MAX_SIZE):
+                    stats = await self.compact()
+                    logger.info(f"💾 Снимок создан: {stats['records']} записей журнала за {stats['duration']:.2f} сек")
+            except Exception as e:
+                logger.error(f"Ошибка записи в базу: {e}")
+
+    async def close(self):
+        """Финальная запись, снимок и закрытие базы"""
+        await self.compact()
+        self.journal.close()
+        self.reader.close()
+        self.conn.close()
+
+class PersistentSet(set):
+    """Множество ID, изменения которого сохраняются в базу"""
+
+    def __init__(self, name: str, initial=()):
+        super().__init__(initial)
+        self.name = name
+
+    def load(self, user_ids):
+        """Добавление без пометки на запись (при загрузке из базы)"""
+        super().update(user_ids)
+
+    def add(self, user_id):
+        if user_id not in self:
+            super().add(user_id)
+            db.mark_member(self.name, user_id, True)
+
+    def discard(self, user_id):
+        if user_id in self:
+            super().discard(user_id)
+            db.mark_member(self.name, user_id, False)
+
+    def remove(self, user_id):
+        super().remove(user_id)
+        db.mark_member(self.name, user_id, False)
+
+    def update(self, *others):
+        for other in others:
+            for user_id in other:
+                self.add(user_id)
+
+    def add_many(self, user_ids) -> List[int]:
+        """Добавляет пачку ID, возвращает новые (попадут в одну пакетную запись)"""
+        added = [user_id for user_id in user_ids if user_id not in self]
+        super().update(added)
+        for user_id in added:
+            db.mark_member(self.name, user_id, True)
+        return added
+
+    def clear(self):
+        for user_id in list(self):
+            db.mark_member(self.name, user_id, False)
+        super().clear()
+
+class PersistentBans(dict):
+    """Временные баны: user_id -> время окончания, изменения сохраняются в базу"""
+
+    def __setitem__(self, user_id, until):
+        super().__setitem__(user_id, until)
+        db.mark_temp_ban(user_id)
+        ban_scheduler.schedule(user_id, until)
+
+    def __delitem__(self, user_id):
+        super().__delitem__(user_id)
+        db.mark_temp_ban(user_id)
+
+    def pop(self, user_id, *default):
+        if user_id in self:
+            db.mark_temp_ban(user_id)
+        return super().pop(user_id, *default)
+
+    def clear(self):
+        for user_id in self:
+            db.mark_temp_ban(user_id)
+        super().clear()
+
+class FSMRecord:
+    """Состояние FSM пользователя в кэше"""
+    __slots__ = ('state', 'data', 'updated')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None, updated: float = 0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.updated = updated
+
+class SQLiteFSMStorage(BaseStorage):
+    """FSM хранилище в SQLite с ограниченным LRU-кэшем и TTL по состояниям.
+
+    Запись идет через общую пакетную запись Database, чтение с диска - только
+    при промахе кэша и в отдельном потоке. Брошенные состояния удаляются по
+    истечении TTL из FSM_STATE_TTL (или FSM_DEFAULT_TTL).
+    """
+
+    def __init__(self, database: Database, cache_size: int):
+        self.db = database
+        self.cache_size = cache_size
+        self.cache: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return (
+            f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or 0}:"
+            f"{key.business_connection_id or ''}:{key.destiny}"
+        )
+
+    @staticmethod
+    def _ttl(state: Optional[str]) -> int:
+        return FSM_STATE_TTL.get(state, FSM_DEFAULT_TTL)
+
+    async def _get(self, key: StorageKey) -> FSMRecord:
+        record = self.cache.get(key)
+        if record is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            row = await self.db.load_fsm(self._key(key))
+            loaded = FSMRecord(row[0], load_json(row[1]), row[2]) if row else FSMRecord()
+            # Пока читали с диска, запись могла появиться в кэше
+            record = self.cache.setdefault(key, loaded)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        
+        if (record.state is not None or record.data) and clock.now() - record.updated > self._ttl(record.state):
+            record.state = None
+            record.data = {}
+            self._save(key, record)
+            self.expired += 1
+        return record
+
+    def _save(self, key: StorageKey, record: FSMRecord):
+        record.updated = clock.now()
+        if record.state is None and not record.data:
+            self.db.mark_fsm(self._key(key), None)
+        else:
+            self.db.mark_fsm(self._key(key), (record.state, dump_json(record.data), record.updated))
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        record = await self._get(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._save(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._get(key)
+        record.data = dict(data)
+        self._save(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._get(key)).data)
+
+    async def close(self) -> None:
+        pass
+
+    async def run_sweeper(self):
+        """Фоновая очистка просроченных состояний в кэше и в базе"""
+        while True:
+            await asyncio.sleep(FSM_SWEEP_INTERVAL)
+            try:
+                now = clock.now()
+                for key in [k for k, r in self.cache.items() if now - r.updated > self._ttl(r.state)]:
+                    del self.cache[key]
+                deleted = await self.db.sweep_fsm(FSM_STATE_TTL, FSM_DEFAULT_TTL, now)
+                self.expired += deleted
+                if deleted:
+                    logger.info(f"🧹 Удалено просроченных FSM состояний: {deleted}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки FSM состояний: {e}")
+
+db = Database(DB_PATH, JOURNAL_PATH)
+
+def save_user(user_id: int):
+    """Помечает пользователя для записи в базу (без блокировки на диск)"""
+    db.mark_user(user_id)
+
+def add_history(user_id: int, action: int, arg: int = 0):
+    """Добавляет действие в историю пользователя, вытесненное уходит в базу"""
+    user = users_db.get(user_id)
+    if user is None:
+        return
+    if user.history is None:
+        user.history = HistoryRing()
+    evicted = user.history.push(pack_history(clock.now(), action, arg))
+    if evicted is not None:
+        db.mark_history_spill(user_id, evicted)
+    save_user(user_id)
+
+def add_support_message(user_id: int, entry: Dict):
+    """Добавляет сообщение в историю переписки с поддержкой"""
+    support_chats.setdefault(user_id, []).append(entry)
+    db.mark_support(user_id, entry)
+
+def save_maintenance_record(index: int = -1):
+    """Помечает запись истории техработ для записи в базу"""
+    db.mark_maintenance(index % len(maintenance_history))
+
 # База данных пользователей
-users_db: Dict[int, Dict[str, Any]] = {}
-blacklist: set = set()
-temp_bans: Dict[int, datetime] = {}
-admins: set = {ADMIN_ID}
-moderators: set = set()
-whitelist: set = {ADMIN_ID, PROTECTED_ID}  # Белый список для тех. работ
+users_db: Dict[int, UserRecord] = {}
+blacklist = PersistentSet('blacklist')
+temp_bans: Dict[int, datetime] = PersistentBans()
+admins = PersistentSet('admins', {ADMIN_ID})
+moderators = PersistentSet('moderators')
+whitelist = PersistentSet('whitelist', {ADMIN_ID, PROTECTED_ID})  # Белый список для тех. работ
+unreachable = PersistentSet('unreachable')  # Заблокировали бота - пропускаются в рассылках
+
+member_lists: Dict[str, PersistentSet] = {
+    s.name: s for s in (blacklist, admins, moderators, whitelist, unreachable)
+}
 
 # Режим технических работ
 maintenance_mode = False
@@ -80,6 +1120,71 @@ maintenance_history: List[Dict] = []
 # Поддержка пользователей
 support_chats: Dict[int, List[Dict]] = {}
 
+# ==================== СТАТИСТИКА ====================
+
+class UserStats:
+    """Счетчики статистики по пользователям.
+
+    Обновляются при каждом изменении записи, поэтому экран статистики не
+    перебирает users_db. Размеры ЧС, белого списка и банов - это len()
+    соответствующих множеств, для них счетчики не нужны.
+    """
+
+    LINKS_DONE = UserRecord.FLAGS['link1_done'] | UserRecord.FLAGS['link2_done']
+    LINKS_REJECTED = UserRecord.FLAGS['link1_rejected'] | UserRecord.FLAGS['link2_rejected']
+    COUNTERS = ('users', 'active_refs', 'links_done', 'links_rejected')
+
+    def __init__(self):
+        self.users = 0
+        self.active_refs = 0
+        self.links_done = 0  # пользователей хотя бы с одной принятой ссылкой
+        self.links_rejected = 0  # пользователей хотя бы с одной отклоненной ссылкой
+
+    def add(self, record: UserRecord, sign: int = 1):
+        """Учитывает запись (sign=-1 - убирает ее вклад)"""
+        self.users += sign
+        self.active_refs += sign * record.active_refs
+        if record.flags & self.LINKS_DONE:
+            self.links_done += sign
+        if record.flags & self.LINKS_REJECTED:
+            self.links_rejected += sign
+
+    @contextlib.contextmanager
+    def track(self, record: UserRecord):
+        """Пересчитывает вклад записи вокруг ее изменения"""
+        self.add(record, -1)
+        try:
+            yield record
+        finally:
+            self.add(record)
+
+    @classmethod
+    def compute(cls, records: Iterable[UserRecord]) -> 'UserStats':
+        """Полный пересчет (при загрузке и для проверки)"""
+        stats = cls()
+        for record in records:
+            stats.add(record)
+        return stats
+
+    def reset(self):
+        """Пересчитывает счетчики по users_db"""
+        fresh = self.compute(users_db.values())
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(fresh, name))
+
+    def check(self) -> Dict[str, Tuple[int, int]]:
+        """Сверяет счетчики с полным пересчетом: {счетчик: (было, должно быть)}, расхождения исправляет"""
+        fresh = self.compute(users_db.values())
+        drift = {
+            name: (getattr(self, name), getattr(fresh, name))
+            for name in self.COUNTERS if getattr(self, name) != getattr(fresh, name)
+        }
+        for name, (_, actual) in drift.items():
+            setattr(self, name, actual)
+        return drift
+
+stats = UserStats()
+
 # FSM состояния
 class ReferralStates(StatesGroup):
     waiting_for_agreement = State()
@@ -98,10 +1203,41 @@ class ReferralStates(StatesGroup):
     waiting_for_moder_id = State()
     waiting_for_admin_id = State()
     waiting_for_whitelist_id = State()
+    waiting_for_whitelist_remove_id = State()
     waiting_for_maintenance_time = State()
     waiting_for_maintenance_reason = State()
     waiting_for_maintenance_message = State()
     waiting_for_already_in_bot_choice = State()
+    waiting_for_broadcast_text = State()
+    waiting_for_import_file = State()
+
+# TTL состояний (сек): реферальный процесс можно продолжить и через несколько дней,
+# ввод данных в админке и поддержке быстро теряет актуальность
+FSM_STATE_TTL: Dict[str, int] = {
+    ReferralStates.waiting_for_agreement.state: 7 * 86400,
+    ReferralStates.waiting_for_links.state: 7 * 86400,
+    ReferralStates.waiting_for_link1.state: 7 * 86400,
+    ReferralStates.waiting_for_link2.state: 7 * 86400,
+    ReferralStates.waiting_for_screenshot1.state: 7 * 86400,
+    ReferralStates.waiting_for_screenshot2.state: 7 * 86400,
+    ReferralStates.waiting_for_already_in_bot_choice.state: 7 * 86400,
+    ReferralStates.waiting_for_support_message.state: 3600,
+    ReferralStates.waiting_for_support_reply.state: 3600,
+    ReferralStates.waiting_for_ban_id.state: 900,
+    ReferralStates.waiting_for_temp_ban_time.state: 900,
+    ReferralStates.waiting_for_unban_id.state: 900,
+    ReferralStates.waiting_for_blacklist_id.state: 900,
+    ReferralStates.waiting_for_unblacklist_id.state: 900,
+    ReferralStates.waiting_for_moder_id.state: 900,
+    ReferralStates.waiting_for_admin_id.state: 900,
+    ReferralStates.waiting_for_whitelist_id.state: 900,
+    ReferralStates.waiting_for_whitelist_remove_id.state: 900,
+    ReferralStates.waiting_for_maintenance_time.state: 900,
+    ReferralStates.waiting_for_maintenance_reason.state: 900,
+    ReferralStates.waiting_for_maintenance_message.state: 900,
+    ReferralStates.waiting_for_broadcast_text.state: 900,
+    ReferralStates.waiting_for_import_file.state: 900,
+}
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
@@ -114,16 +1250,8 @@ def is_moderator(user_id: int) -> bool:
     return user_id in moderators or is_admin(user_id)
 
 def is_banned(user_id: int) -> bool:
-    """Проверка на бан"""
-    if user_id in blacklist:
-        return True
-    if user_id in temp_bans:
-        if datetime.now() < temp_bans[user_id]:
-            return True
-        else:
-            # Автоматический разбан по истечении времени
-            del temp_bans[user_id]
-    return False
+    """Проверка на бан (истекшие временные баны снимает BanScheduler)"""
+    return user_id in blacklist or user_id in temp_bans
 
 def can_access_during_maintenance(user_id: int) -> bool:
     """Проверка доступа во время технических работ"""
@@ -145,43 +1273,97 @@ def check_protected_id(user_id: int) -> bool:
 
 def get_user_status_emoji(user_id: int) -> tuple:
     """Возвращает статус ссылок пользователя"""
-    if user_id not in users_db:
-        return "🔴", "🔴"
-    
-    user_data = users_db[user_id]
-    status1 = "🟢" if user_data.get('link1_done', False) else "🔴"
-    status2 = "🟢" if user_data.get('link2_done', False) else "🔴"
+    user_data = users_db.get(user_id)
+    return _status_emoji(user_data.flags if user_data is not None else 0)
+
+# Тексты ниже зависят только от флагов статуса (6 бит - не больше 64
+# вариантов), поэтому собираются один раз на значение флагов. В ответ
+# подставляются лишь поля конкретного пользователя (имя, ID, ссылки).
+
+def status_flags(user_data) -> int:
+    """Упакованные флаги статуса (для {} вместо записи - 0)"""
+    if isinstance(user_data, UserRecord):
+        return user_data.flags
+    return sum(bit for key, bit in UserRecord.FLAGS.items() if user_data.get(key))
+
+@functools.lru_cache(maxsize=None)
+def _status_emoji(flags: int) -> tuple:
+    status1 = "🟢" if flags & UserRecord.FLAGS['link1_done'] else "🔴"
+    status2 = "🟢" if flags & UserRecord.FLAGS['link2_done'] else "🔴"
     return status1, status2
 
+@functools.lru_cache(maxsize=None)
+def _render_status(flags: int) -> str:
+    text = ""
+    for i in (1, 2):
+        name = BOT_LINKS[i - 1]['name']
+        if flags & UserRecord.FLAGS[f'link{i}_done']:
+            text += f"✅ {name}: ВЫПОЛНЕН\n"
+        elif flags & UserRecord.FLAGS[f'link{i}_rejected']:
+            text += f"❌ {name}: ОТКЛОНЕН\n"
+        elif flags & UserRecord.FLAGS[f'already_in_bot_{i}']:
+            text += f"🔄 {name}: УЖЕ БЫЛ В БОТЕ\n"
+        else:
+            text += f"⏳ {name}: В ОЖИДАНИИ\n"
+    return text
+
 def get_bot_status_text(user_data: Dict) -> str:
     """Возвращает текст статуса по ботам"""
-    text = ""
+    return _render_status(status_flags(user_data))
+
+@functools.lru_cache(maxsize=None)
+def _render_welcome_body(flags: int) -> str:
+    status1, status2 = _status_emoji(flags)
+    return (
+        f"Добро пожаловать в бот взаимного реферала!\n\n"
+        f"📊 МОИ РЕФЕРАЛЬНЫЕ ССЫЛКИ:\n\n"
+        f"№1 – {BOT_LINKS[0]['name']}\n"
+        f"{BOT_LINKS[0]['url']}\n"
+        f"Статус: {status1}\n\n"
+        f"№2 – {BOT_LINKS[1]['name']}\n"
+        f"{BOT_LINKS[1]['url']}\n"
+        f"Статус: {status2}"
+    )
+
+def render_welcome(first_name: str, user_data) -> str:
+    """Приветствие /start"""
+    # Приветствие показывает только выполнение ссылок - остальные флаги не плодят варианты
+    done = UserRecord.FLAGS['link1_done'] | UserRecord.FLAGS['link2_done']
+    flags = user_data.flags & done if user_data is not None else 0
+    return f"🔰 Здравствуй, {first_name}!\n" + _render_welcome_body(flags)
+
+def render_profile(user_id: int, user_data: 'UserRecord') -> str:
+    """Текст профиля пользователя"""
+    profile_text = (
+        f"👤 ПРОФИЛЬ ПОЛЬЗОВАТЕЛЯ\n\n"
+        f"🆔 ID: {user_id}\n"
+        f"📝 Имя: {user_data.first_name or 'Не указано'}\n"
+        f"📅 Регистрация: {format_timestamp(user_data.joined_date)}\n\n"
+        f"📊 Активные рефералы: {user_data.active_refs}\n"
+        f"🔗 СТАТУС ПО БОТАМ:\n"
+        f"{_render_status(user_data.flags)}\n"
+        f"⛔ В черном списке: {'Да' if user_id in blacklist else 'Нет'}\n"
+        f"⏰ Временный бан: {'Да' if user_id in temp_bans else 'Нет'}\n"
+        f"💘 В белом списке: {'Да' if user_id in whitelist else 'Нет'}\n\n"
+    )
     
-    if user_data.get('link1_done'):
-        text += f"✅ {BOT_LINKS[0]['name']}: ВЫПОЛНЕН\n"
-    elif user_data.get('link1_rejected'):
-        text += f"❌ {BOT_LINKS[0]['name']}: ОТКЛОНЕН\n"
-    elif user_data.get('already_in_bot_1'):
-        text += f"🔄 {BOT_LINKS[0]['name']}: УЖЕ БЫЛ В БОТЕ\n"
-    else:
-        text += f"⏳ {BOT_LINKS[0]['name']}: В ОЖИДАНИИ\n"
-    
-    if user_data.get('link2_done'):
-        text += f"✅ {BOT_LINKS[1]['name']}: ВЫПОЛНЕН\n"
-    elif user_data.get('link2_rejected'):
-        text += f"❌ {BOT_LINKS[1]['name']}: ОТКЛОНЕН\n"
-    elif user_data.get('already_in_bot_2'):
-        text += f"🔄 {BOT_LINKS[1]['name']}: УЖЕ БЫЛ В БОТЕ\n"
-    else:
-        text += f"⏳ {BOT_LINKS[1]['name']}: В ОЖИДАНИИ\n"
+    # Добавляем ссылки пользователя
+    if user_data.link1:
+        profile_text += f"🔗 Ссылка №1: {user_data.link1}\n"
+    if user_data.link2:
+        profile_text += f"🔗 Ссылка №2: {user_data.link2}\n"
     
-    return text
+    # Добавляем историю
+    if user_data.history:
+        profile_text += f"\n{format_user_history(user_data)}"
+    
+    return profile_text
 
 def format_user_history(user_data: Dict) -> str:
     """Форматирует историю пользователя"""
     history = "📜 История действий:\n"
-    for action in user_data.get('history', [])[-5:]:  # Последние 5 действий
-        history += f"• {action}\n"
+    for entry in user_data.get('history').last(5):  # Последние 5 действий
+        history += f"• {render_history(entry)}\n"
     return history
 
 def format_time_delta(seconds: int) -> str:
@@ -195,6 +1377,15 @@ def format_time_delta(seconds: int) -> str:
     else:
         return f"{seconds // 86400} д"
 
+def format_size(size: int) -> str:
+    """Форматирует размер в байтах"""
+    if size < 1024:
+        return f"{size} Б"
+    elif size < 1024 * 1024:
+        return f"{size / 1024:.1f} КБ"
+    else:
+        return f"{size / (1024 * 1024):.1f} МБ"
+
 def parse_time_string(time_str: str) -> Optional[int]:
     """Парсит строку времени (1h, 30m, 2d)"""
     match = re.match(r'^(\d+)([hmd])$', time_str.lower())
@@ -212,32 +1403,1043 @@ def parse_time_string(time_str: str) -> Optional[int]:
         return value * 86400
     return None
 
-# ==================== MIDDLEWARE ДЛЯ ТЕХНИЧЕСКИХ РАБОТ ====================
-# ВАЖНО: global объявлен в самом начале функции!
+# ==================== БЛОКИРОВКИ ПОЛЬЗОВАТЕЛЕЙ ====================
 
-@dp.message.middleware()
-@dp.callback_query.middleware()
-async def maintenance_middleware(handler, event, data):
-    """Middleware для проверки режима технических работ"""
-    # 1. СНАЧАЛА объявляем все глобальные переменные
-    global maintenance_mode, maintenance_end_time, maintenance_reason, maintenance_message_text
-    
-    # 2. ТОЛЬКО ПОТОМ весь остальной код
-    if not maintenance_mode:
-        return await handler(event, data)
-    
-    # Определяем ID пользователя
-    user_id = None
-    if isinstance(event, Message):
-        user_id = event.from_user.id
-    elif isinstance(event, CallbackQuery):
-        user_id = event.from_user.id
-    
-    # Проверяем доступ
-    if user_id and can_access_during_maintenance(user_id):
-        return await handler(event, data)
-    
-    # Формируем сообщение о техработах
+USER_LOCK_SHARDS = int(os.getenv('USER_LOCK_SHARDS', '256'))
+
+# Фиксированный набор блокировок вместо блокировки на каждого пользователя:
+# пользователь всегда попадает в один и тот же шард, разные пользователи
+# почти всегда в разные, поэтому их обработчики идут параллельно.
+_user_locks = [asyncio.Lock() for _ in range(USER_LOCK_SHARDS)]
+
+def user_lock(user_id: int) -> asyncio.Lock:
+    """Блокировка для изменения записи пользователя (проверка + изменение без await между ними)"""
+    return _user_locks[user_id % USER_LOCK_SHARDS]
+
+# ==================== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ====================
+
+OUTBOUND_RATE = float(os.getenv('OUTBOUND_RATE', '28'))  # сообщений в секунду всего (лимит Telegram ~30)
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))  # сообщений в секунду в один чат
+OUTBOUND_CHAT_BURST = float(os.getenv('OUTBOUND_CHAT_BURST', '3'))  # всплеск в один чат
+OUTBOUND_RETRIES = 2  # повторов после TelegramRetryAfter
+
+# Классы приоритета: меньше - важнее
+PRIORITY_INTERACTIVE = 0  # ответы пользователю в обработчиках
+PRIORITY_MODERATION = 1   # заявки на проверку для модераторов
+PRIORITY_NOTIFY = 2       # уведомления персоналу и пользователям
+PRIORITY_BULK = 3         # массовые рассылки
+PRIORITY_NAMES = ["interactive", "moderation", "notify", "bulk"]
+
+# Приоритет отправок в текущей задаче (воркеры рассылок выставляют свой)
+send_priority: ContextVar[int] = ContextVar('send_priority', default=PRIORITY_INTERACTIVE)
+
+# Методы, на которые действуют лимиты Telegram на отправку сообщений
+RATE_LIMITED_METHODS = (
+    SendMessage, SendPhoto, SendMediaGroup, SendDocument, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageCaption, EditMessageReplyMarkup,
+)
+
+class TokenBucket:
+    """Token bucket: не больше rate операций в секунду, всплеск до burst"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def delay(self, cost: float = 1) -> float:
+        """Забирает токены; возвращает, сколько нужно подождать до отправки"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= cost
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self, cost: float = 1):
+        delay = self.delay(cost)
+        if delay:
+            await asyncio.sleep(delay)
+
+class OutboundQueue:
+    """Единая очередь исходящих сообщений с полосами приоритета.
+
+    Каждая отправка сначала ждет свой чат (OUTBOUND_CHAT_RATE), не занимая
+    общую очередь, затем встает в полосу своего приоритета. Общий лимит
+    OUTBOUND_RATE выдается всегда самой важной непустой полосе, поэтому
+    ответы пользователям не ждут массовых рассылок. 429 от Telegram
+    приостанавливает всю очередь на retry_after.
+    """
+
+    def __init__(self):
+        self.lanes: List[deque] = [deque() for _ in PRIORITY_NAMES]
+        self.global_bucket = TokenBucket(OUTBOUND_RATE)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.rate_limited = 0
+
+    def depth(self) -> List[int]:
+        """Глубина очереди по полосам"""
+        return [len(lane) for lane in self.lanes]
+
+    async def _wait_chat(self, chat_id: int, cost: float):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # Забываем чаты с полным запасом токенов - они не ограничены
+                now = time.monotonic()
+                self.chat_buckets = {
+                    c: b for c, b in self.chat_buckets.items()
+                    if b.tokens + (now - b.updated) * b.rate < b.burst
+                }
+            bucket = self.chat_buckets[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+        await bucket.acquire(cost)
+
+    async def acquire(self, priority: int, chat_id: Optional[int], cost: float = 1):
+        """Ждет разрешения на отправку"""
+        if chat_id is not None:
+            await self._wait_chat(chat_id, cost)
+        
+        # Быстрый путь: очередь пуста и общий лимит не исчерпан
+        if not any(self.lanes) and time.monotonic() >= self.paused_until:
+            if self.global_bucket.delay(cost) == 0:
+                self.sent[priority] += 1
+                return
+            # Токен уже списан - ждем его как и все
+            self.global_bucket.tokens += cost
+        
+        future = asyncio.get_running_loop().create_future()
+        self.lanes[priority].append((future, cost))
+        self._wakeup.set()
+        await future
+        self.sent[priority] += 1
+
+    def pause(self, seconds: float):
+        """Приостанавливает отправку после 429"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.rate_limited += 1
+
+    def _next(self) -> Optional[tuple]:
+        for lane in self.lanes:
+            while lane:
+                future, cost = lane[0]
+                if not future.cancelled():
+                    return lane, future, cost
+                lane.popleft()
+        return None
+
+    async def run(self):
+        """Выдает разрешения на отправку по приоритету"""
+        while True:
+            head = self._next()
+            if head is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            paid = head[2]
+            await self.global_bucket.acquire(paid)
+            
+            # Пока ждали, могла прийти отправка важнее - отдаем токены ей,
+            # доплатив разницу, если она дороже (например, альбом)
+            head = self._next()
+            while head is not None and head[2] > paid:
+                await self.global_bucket.acquire(head[2] - paid)
+                paid = head[2]
+                head = self._next()
+            if head is None:
+                self.global_bucket.tokens += paid
+                continue
+            lane, future, cost = head
+            # Отправка дешевле оплаченной - излишек возвращаем
+            self.global_bucket.tokens += paid - cost
+            lane.popleft()
+            future.set_result(None)
+
+outbound = OutboundQueue()
+
+async def outbound_middleware(make_request, bot, method):
+    """Middleware сессии: все отправки бота проходят через общую очередь"""
+    m_sent.inc(type(method).__name__)
+    try:
+        return await _send_through_queue(make_request, bot, method)
+    except Exception as e:
+        m_errors.inc('outbound', type(e).__name__)
+        raise
+
+async def _timed_request(make_request, bot, method):
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    finally:
+        m_api_latency.observe(time.perf_counter() - started, type(method).__name__)
+
+async def _send_through_queue(make_request, bot, method):
+    if not isinstance(method, RATE_LIMITED_METHODS):
+        return await _timed_request(make_request, bot, method)
+    
+    chat_id = getattr(method, 'chat_id', None)
+    if not isinstance(chat_id, int):
+        chat_id = None
+    cost = len(method.media) if isinstance(method, SendMediaGroup) else 1
+    
+    priority = send_priority.get()
+    for attempt in range(OUTBOUND_RETRIES + 1):
+        started = time.perf_counter()
+        await outbound.acquire(priority, chat_id, cost)
+        m_outbound_wait.observe(time.perf_counter() - started, PRIORITY_NAMES[priority])
+        try:
+            return await _timed_request(make_request, bot, method)
+        except TelegramRetryAfter as e:
+            outbound.pause(e.retry_after)
+            if attempt == OUTBOUND_RETRIES:
+                raise
+            logger.warning(f"⚠️ Telegram просит подождать {e.retry_after} сек ({type(method).__name__})")
+
+# ==================== РАССЫЛКА УВЕДОМЛЕНИЙ ====================
+
+NOTIFY_CONCURRENCY = int(os.getenv('NOTIFY_CONCURRENCY', '8'))  # одновременных отправок
+NOTIFY_RETRIES = 3
+
+class StaffNotifier:
+    """Параллельная рассылка уведомлений администраторам и модераторам.
+
+    Обработчики только ставят отправки в очередь и сразу отвечают пользователю.
+    NOTIFY_CONCURRENCY воркеров отправляют их через общую очередь исходящих
+    с приоритетом задания, лимиты Telegram соблюдает она.
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def fanout(self, recipients: Iterable[int], send: Callable[[int], Awaitable[Any]],
+               priority: int = PRIORITY_NOTIFY):
+        """Ставит send(chat_id) в очередь для каждого получателя"""
+        for chat_id in recipients:
+            self.queue.put_nowait((chat_id, send, priority))
+
+    def notify(self, text: str, reply_markup=None, with_moderators: bool = False, exclude: Optional[int] = None):
+        """Уведомление администраторам (и модераторам), кроме exclude"""
+        recipients = admins.union(moderators) if with_moderators else set(admins)
+        recipients.discard(exclude)
+        self.fanout(recipients, lambda chat_id: bot.send_message(chat_id, text, reply_markup=reply_markup))
+
+    async def _deliver(self, chat_id: int, send: Callable[[int], Awaitable[Any]]):
+        for attempt in range(NOTIFY_RETRIES + 1):
+            try:
+                await send(chat_id)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                await asyncio.sleep(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Бот заблокирован или чат не найден - повтор не поможет
+                logger.warning(f"Не удалось уведомить {chat_id}: {e}")
+                break
+            except Exception as e:
+                self.retried += 1
+                logger.error(f"Ошибка отправки уведомления {chat_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+        self.failed += 1
+
+    async def _worker(self):
+        while True:
+            chat_id, send, priority = await self.queue.get()
+            send_priority.set(priority)
+            try:
+                await self._deliver(chat_id, send)
+            finally:
+                self.queue.task_done()
+
+    async def run(self):
+        """Запускает воркеры рассылки"""
+        await asyncio.gather(*(self._worker() for _ in range(NOTIFY_CONCURRENCY)))
+
+notifier = StaffNotifier()
+
+# ==================== ОЧЕРЕДЬ ПРОВЕРКИ ====================
+
+REVIEW_CLAIM_TIMEOUT = int(os.getenv('REVIEW_CLAIM_TIMEOUT', '900'))  # сек, потом заявку может взять другой
+REVIEW_NOTIFY_INTERVAL = int(os.getenv('REVIEW_NOTIFY_INTERVAL', '30'))  # сек между обновлениями счетчика
+
+class ModerationQueue:
+    """Очередь заявок на проверку скриншотов.
+
+    Заявки упорядочены по времени отправки (OrderedDict user_id -> время).
+    Модератор забирает самую старую свободную заявку и получает только ее,
+    поэтому на заявку уходит одна отправка, а не по сообщению каждому из
+    персонала. Остальным раз в REVIEW_NOTIFY_INTERVAL обновляется одно
+    сообщение-счетчик. Взятая заявка, которую не закрыли за
+    REVIEW_CLAIM_TIMEOUT, снова становится свободной.
+    """
+
+    def __init__(self):
+        self.pending: "OrderedDict[int, float]" = OrderedDict()
+        self.claims: Dict[int, Tuple[int, float]] = {}  # user_id -> (модератор, когда взята)
+        self.decided: Dict[int, int] = {}  # user_id -> битовая маска ссылок, по которым уже есть решение
+        self.counter_messages: Dict[int, int] = {}  # модератор -> message_id счетчика
+        self._changed = False
+        self._announced_depth = 0
+        self.submitted = 0
+        self.completed = 0
+
+    def load(self, user_id: int, submitted: float, decided: int = 0):
+        """Добавление без пометки на запись (при загрузке из базы)"""
+        self.pending[user_id] = submitted
+        self.pending.move_to_end(user_id)
+        if decided:
+            self.decided[user_id] = decided
+        else:
+            self.decided.pop(user_id, None)
+
+    def submit(self, user_id: int):
+        """Ставит заявку в конец очереди (повторная отправка заменяет старую)"""
+        self.pending.pop(user_id, None)
+        self.claims.pop(user_id, None)
+        self.decided.pop(user_id, None)
+        self.pending[user_id] = clock.now()
+        self.submitted += 1
+        self._changed = True
+        db.mark_review(user_id)
+
+    def complete(self, user_id: int):
+        """Заявка проверена"""
+        self.claims.pop(user_id, None)
+        self.decided.pop(user_id, None)
+        submitted = self.pending.pop(user_id, None)
+        if submitted is not None:
+            m_review_wait.observe(clock.now() - submitted)
+            self.completed += 1
+            self._changed = True
+            db.mark_review(user_id)
+
+    def stamp(self, user_id: int) -> int:
+        """Метка текущей заявки пользователя (секунда отправки), 0 - заявки нет"""
+        submitted = self.pending.get(user_id)
+        return int(submitted) if submitted is not None else 0
+
+    def decide(self, user_id: int, stamp: int, link_num: int) -> bool:
+        """Ключ идемпотентности решения модератора.
+
+        True только для первого решения по ссылке link_num в заявке stamp.
+        Кнопки закрытой или замененной заявки больше не срабатывают.
+        Решение сохраняется вместе с заявкой, поэтому старая кнопка не
+        засчитает реферал повторно и после перезапуска.
+        """
+        if not stamp or self.stamp(user_id) != stamp:
+            return False
+        decided = self.decided.get(user_id, 0)
+        bit = 1 << link_num
+        if decided & bit:
+            return False
+        self.decided[user_id] = decided | bit
+        db.mark_review(user_id)
+        return True
+
+    def hold(self, user_id: int, stamp: int, moderator_id: int) -> bool:
+        """Закрепляет заявку за модератором, который принимает по ней решение.
+
+        False - заявку сейчас проверяет другой модератор (его взятие не
+        истекло). Кнопки закрытой или замененной заявки взятия не трогают,
+        их отклонит decide.
+        """
+        if not stamp or self.stamp(user_id) != stamp:
+            return True
+        now = clock.now()
+        claim = self.claims.get(user_id)
+        if claim is not None and claim[0] != moderator_id and now - claim[1] < REVIEW_CLAIM_TIMEOUT:
+            return False
+        if claim is None or claim[0] != moderator_id:
+            self._changed = True
+        self.claims[user_id] = (moderator_id, now)
+        return True
+
+    def live_claims(self) -> Dict[int, int]:
+        """Неистекшие взятия: user_id -> модератор"""
+        now = clock.now()
+        return {user_id: owner for user_id, (owner, claimed_at) in self.claims.items()
+                if now - claimed_at < REVIEW_CLAIM_TIMEOUT}
+
+    def claimed_by(self, moderator_id: int) -> Optional[int]:
+        """Заявка, которую модератор уже взял и еще не закрыл"""
+        now = clock.now()
+        for user_id, (owner, claimed_at) in self.claims.items():
+            if owner == moderator_id and now - claimed_at < REVIEW_CLAIM_TIMEOUT:
+                return user_id
+        return None
+
+    def claim(self, moderator_id: int) -> Optional[int]:
+        """Отдает модератору самую старую свободную заявку"""
+        user_id = self.claimed_by(moderator_id)
+        if user_id is not None:
+            return user_id
+        
+        now = clock.now()
+        for user_id in self.pending:
+            if is_banned(user_id):
+                continue
+            claim = self.claims.get(user_id)
+            if claim is None or now - claim[1] >= REVIEW_CLAIM_TIMEOUT:
+                self.claims[user_id] = (moderator_id, now)
+                self._changed = True
+                return user_id
+        return None
+
+    def depth(self) -> int:
+        return len(self.pending)
+
+    def free(self) -> int:
+        """Заявок, которые еще никто не взял (или взятие истекло)"""
+        return len(self.pending) - len(self.live_claims())
+
+    def oldest_age(self) -> float:
+        """Сколько секунд ждет самая старая заявка"""
+        for submitted in self.pending.values():
+            return clock.now() - submitted
+        return 0.0
+
+    def counter_text(self) -> str:
+        if not self.pending:
+            return "📥 Очередь проверки пуста"
+        return (
+            f"📥 Заявок на проверке: {self.depth()} (свободных: {self.free()})\n"
+            f"⏳ Самая старая ждет: {format_time_delta(int(self.oldest_age()))}"
+        )
+
+    async def _send_counter(self, chat_id: int):
+        text = self.counter_text()
+        message_id = self.counter_messages.get(chat_id)
+        if message_id is not None:
+            try:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                            reply_markup=get_review_keyboard())
+                return
+            except TelegramBadRequest as e:
+                if 'not modified' in str(e):
+                    return
+                # Сообщение удалено - отправим новое
+        message = await bot.send_message(chat_id, text, reply_markup=get_review_keyboard())
+        self.counter_messages[chat_id] = message.message_id
+
+    def _announce(self):
+        # Очередь опустела или снова наполнилась - новое сообщение, чтобы пришло уведомление
+        if (self.depth() == 0) != (self._announced_depth == 0):
+            self.counter_messages.clear()
+        self._announced_depth = self.depth()
+        self._changed = False
+        
+        busy = set(self.live_claims().values())
+        notifier.fanout(admins.union(moderators) - busy, self._send_counter)
+
+    async def run(self):
+        """Фоновая задача обновления счетчика у персонала"""
+        while True:
+            await asyncio.sleep(REVIEW_NOTIFY_INTERVAL)
+            if self._changed:
+                self._announce()
+
+review_queue = ModerationQueue()
+
+# ==================== МАССОВАЯ РАССЫЛКА ====================
+
+BROADCAST_CHUNK = int(os.getenv('BROADCAST_CHUNK', '200'))  # получателей между сохранениями прогресса
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '30'))  # одновременных отправок
+BROADCAST_REPORT_INTERVAL = 10  # секунд между обновлениями отчета
+BROADCAST_MAX_LENGTH = 4096     # лимит Telegram на текст сообщения
+
+# Ошибки TelegramBadRequest, после которых пользователю больше не пишем
+UNREACHABLE_ERRORS = ("chat not found", "user is deactivated")
+
+class Broadcast:
+    """Состояние задания рассылки (сохраняется в базу после каждой пачки)"""
+    __slots__ = ('id', 'text', 'status', 'last_user_id', 'sent', 'failed', 'skipped', 'created',
+                 'report_chat_id', 'report_message_id', 'total', 'started', 'done_at_start')
+
+    def __init__(self, id: int, text: str, status: str = 'active', last_user_id: int = 0,
+                 sent: int = 0, failed: int = 0, skipped: int = 0, created: float = 0.0,
+                 report_chat_id: Optional[int] = None, report_message_id: Optional[int] = None):
+        self.id = id
+        self.text = text
+        self.status = status
+        self.last_user_id = last_user_id
+        self.sent = sent
+        self.failed = failed
+        self.skipped = skipped
+        self.created = created or clock.now()
+        self.report_chat_id = report_chat_id
+        self.report_message_id = report_message_id
+        self.total = 0
+        self.started = time.monotonic()
+        self.done_at_start = self.done
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.skipped
+
+    def row(self) -> tuple:
+        return (self.id, self.text, self.status, self.last_user_id, self.sent, self.failed,
+                self.skipped, self.created, self.report_chat_id, self.report_message_id)
+
+class Broadcaster:
+    """Рассылка сообщения всем пользователям.
+
+    Получатели идут по возрастанию user_id пачками по BROADCAST_CHUNK, после
+    каждой пачки прогресс сохраняется, поэтому после перезапуска рассылка
+    продолжается с места остановки. Отправки идут в полосе bulk общей очереди,
+    то есть с максимальной скоростью, которую оставляют ответы пользователям.
+    Забаненные и недоступные (заблокировали бота) пропускаются.
+    """
+
+    def __init__(self):
+        self.current: Optional[Broadcast] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def active(self) -> bool:
+        return self.current is not None and self.current.status == 'active'
+
+    def start(self, text: str, report_chat_id: Optional[int] = None,
+              report_message_id: Optional[int] = None) -> Broadcast:
+        """Запускает новую рассылку"""
+        if self.active:
+            raise RuntimeError("Рассылка уже идет")
+        if len(text) > BROADCAST_MAX_LENGTH:
+            raise ValueError(f"Текст длиннее {BROADCAST_MAX_LENGTH} символов ({len(text)})")
+        broadcast = Broadcast(db.next_broadcast_id(), text,
+                              report_chat_id=report_chat_id, report_message_id=report_message_id)
+        db.mark_broadcast(broadcast.row())
+        self._launch(broadcast)
+        return broadcast
+
+    def resume(self):
+        """Продолжает незавершенную рассылку после перезапуска"""
+        row = db.load_active_broadcast()
+        if row:
+            broadcast = Broadcast(*row)
+            logger.info(f"📢 Продолжение рассылки #{broadcast.id} после пользователя {broadcast.last_user_id}")
+            self._launch(broadcast)
+
+    def cancel(self) -> bool:
+        if not self.active:
+            return False
+        self.current.status = 'cancelled'
+        db.mark_broadcast(self.current.row())
+        return True
+
+    def _launch(self, broadcast: Broadcast):
+        self.current = broadcast
+        self.task = asyncio.create_task(self._run(broadcast))
+
+    def progress_text(self) -> str:
+        """Прогресс, скорость и оставшееся время"""
+        b = self.current
+        if b is None:
+            return "📢 Рассылок еще не было"
+        
+        statuses = {'active': "⏳ идет", 'done': "✅ завершена", 'cancelled': "⛔ остановлена"}
+        elapsed = time.monotonic() - b.started
+        rate = (b.done - b.done_at_start) / elapsed if elapsed > 0 else 0.0
+        remaining = max(b.total - b.done, 0)
+        eta = format_time_delta(int(remaining / rate)) if rate > 0 and b.status == 'active' else "—"
+        
+        return (
+            f"📢 РАССЫЛКА #{b.id}: {statuses.get(b.status, b.status)}\n\n"
+            f"👥 Обработано: {b.done} из {b.total}\n"
+            f"✅ Доставлено: {b.sent}\n"
+            f"❌ Ошибок: {b.failed}\n"
+            f"⏭ Пропущено: {b.skipped}\n"
+            f"⚡ Скорость: {rate:.1f} сообщ./сек\n"
+            f"⏳ Осталось: {eta}"
+        )
+
+    async def _report(self, b: Broadcast):
+        """Обновляет сообщение с отчетом у администратора"""
+        if not b.report_chat_id or not b.report_message_id:
+            return
+        send_priority.set(PRIORITY_NOTIFY)
+        # Без reply_markup Telegram убрал бы кнопки остановки из отчета
+        keyboard = get_broadcast_keyboard() if b.status == 'active' else get_back_keyboard()
+        try:
+            await bot.edit_message_text(self.progress_text(), chat_id=b.report_chat_id,
+                                        message_id=b.report_message_id, reply_markup=keyboard)
+        except TelegramBadRequest:
+            pass  # Текст не изменился или сообщение удалено
+        except Exception as e:
+            logger.error(f"Ошибка обновления отчета рассылки: {e}")
+
+    async def _send(self, b: Broadcast, user_id: int, semaphore: asyncio.Semaphore):
+        if is_banned(user_id) or user_id in unreachable:
+            b.skipped += 1
+            return
+        async with semaphore:
+            send_priority.set(PRIORITY_BULK)
+            try:
+                await bot.send_message(user_id, b.text)
+                b.sent += 1
+            except TelegramForbiddenError:
+                # Бот заблокирован - не пишем ему в следующих рассылках
+                unreachable.add(user_id)
+                b.failed += 1
+            except TelegramBadRequest as e:
+                # Недоступен только удаленный чат; ошибка в самом тексте
+                # (длина, разметка) - не повод вычеркивать получателя
+                if any(reason in e.message.lower() for reason in UNREACHABLE_ERRORS):
+                    unreachable.add(user_id)
+                else:
+                    logger.error(f"Ошибка рассылки пользователю {user_id}: {e}")
+                b.failed += 1
+            except Exception as e:
+                logger.error(f"Ошибка рассылки пользователю {user_id}: {e}")
+                b.failed += 1
+
+    async def _run(self, b: Broadcast):
+        # Снимок получателей: кто зарегистрируется во время рассылки, ее не получит
+        user_ids = sorted(users_db)
+        b.total = len(user_ids)
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        last_report = time.monotonic()
+        
+        try:
+            for start in range(bisect.bisect_right(user_ids, b.last_user_id), len(user_ids), BROADCAST_CHUNK):
+                if b.status != 'active':
+                    break
+                chunk = user_ids[start:start + BROADCAST_CHUNK]
+                await asyncio.gather(*(self._send(b, user_id, semaphore) for user_id in chunk))
+                b.last_user_id = chunk[-1]
+                db.mark_broadcast(b.row())
+                
+                if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    await self._report(b)
+            
+            if b.status == 'active':
+                b.status = 'done'
+                db.mark_broadcast(b.row())
+            logger.info(f"📢 Рассылка #{b.id}: {b.sent} доставлено, {b.failed} ошибок, {b.skipped} пропущено")
+            await self._report(b)
+        except asyncio.CancelledError:
+            # Остановка бота: прогресс сохранен, продолжим после перезапуска
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка рассылки #{b.id}: {e}")
+
+broadcaster = Broadcaster()
+
+# ==================== СНЯТИЕ ВРЕМЕННЫХ БАНОВ ====================
+
+TEMP_BAN_NOTIFY = os.getenv('TEMP_BAN_NOTIFY', '1') == '1'  # уведомлять об окончании бана
+
+class BanScheduler:
+    """Снятие временных банов точно в срок.
+
+    Min-heap из (время окончания, user_id): добавление O(log n), задача спит
+    до ближайшего окончания. Записи снятых или продленных банов не удаляются
+    из кучи, а пропускаются при извлечении.
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int]] = []
+        self._wakeup = asyncio.Event()
+        self.expired_total = 0
+
+    def load(self):
+        """Строит кучу по загруженным из базы банам"""
+        self.heap = [(until.timestamp(), user_id) for user_id, until in temp_bans.items()]
+        heapq.heapify(self.heap)
+
+    def schedule(self, user_id: int, until: datetime):
+        """Добавляет окончание бана в расписание"""
+        entry = (until.timestamp(), user_id)
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] == entry:
+            # Новый бан заканчивается раньше всех - пересчитываем время сна
+            self._wakeup.set()
+
+    def _pop_expired(self, now: float) -> List[int]:
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            ts, user_id = heapq.heappop(self.heap)
+            until = temp_bans.get(user_id)
+            if until is not None and until.timestamp() == ts:
+                del temp_bans[user_id]
+                expired.append(user_id)
+        return expired
+
+    async def run(self):
+        """Фоновая задача снятия банов"""
+        while True:
+            now = time.time()
+            expired = self._pop_expired(now)
+            if expired:
+                self.expired_total += len(expired)
+                logger.info(f"⏰ Истек временный бан: {len(expired)} пользователей")
+                if TEMP_BAN_NOTIFY:
+                    self._notify(expired)
+            
+            timeout = self.heap[0][0] - now if self.heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _notify(self, expired: List[int]):
+        """Уведомляет пользователей и одним сообщением - администраторов"""
+        notifier.fanout(
+            expired,
+            lambda chat_id: bot.send_message(chat_id, "✅ Срок временного бана истек, доступ к боту восстановлен.")
+        )
+        
+        ids = ", ".join(str(user_id) for user_id in expired[:50])
+        if len(expired) > 50:
+            ids += f" и еще {len(expired) - 50}"
+        notifier.notify(f"⏰ Истек временный бан ({len(expired)}): {ids}")
+
+ban_scheduler = BanScheduler()
+
+# Инициализация бота и диспетчера
+bot = Bot(token=BOT_TOKEN)
+bot.session.middleware(outbound_middleware)
+storage = SQLiteFSMStorage(db, FSM_CACHE_SIZE)
+dp = Dispatcher(storage=storage)
+
+# ==================== МЕТРИКИ ====================
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')  # только локально, наружу - через прокси
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))  # 0 - не запускать HTTP-эндпоинт
+
+class RollingWindow:
+    """Скользящие суммы за 1 мин / 1 ч / 24 ч.
+
+    60 секундных и 1440 минутных ячеек; ячейки, время которых прошло,
+    обнуляются при следующем обращении.
+    """
+    __slots__ = ('seconds', 'minutes', 'last_second', 'last_minute')
+
+    def __init__(self):
+        self.seconds = array('q', bytes(8 * 60))
+        self.minutes = array('q', bytes(8 * 1440))
+        self.last_second = 0
+        self.last_minute = 0
+
+    def _advance(self, now: int):
+        if now != self.last_second:
+            for second in range(max(self.last_second + 1, now - 59), now + 1):
+                self.seconds[second % 60] = 0
+            self.last_second = now
+        minute = now // 60
+        if minute != self.last_minute:
+            for m in range(max(self.last_minute + 1, minute - 1439), minute + 1):
+                self.minutes[m % 1440] = 0
+            self.last_minute = minute
+
+    def add(self, amount: int = 1):
+        now = clock.now()
+        self._advance(now)
+        self.seconds[now % 60] += amount
+        self.minutes[now // 60 % 1440] += amount
+
+    def totals(self) -> Tuple[int, int, int]:
+        """(за минуту, за час, за сутки)"""
+        now = clock.now()
+        self._advance(now)
+        minute = now // 60
+        last_hour = sum(self.minutes[(minute - i) % 1440] for i in range(60))
+        return sum(self.seconds), last_hour, sum(self.minutes)
+
+def _label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names: Tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Счетчик с метками и скользящим окном по сумме всех меток"""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[tuple, int] = {}
+        self.window = RollingWindow()
+
+    def inc(self, *labels, amount: int = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+        self.window.add(amount)
+
+    def total(self) -> int:
+        return sum(self.values.values())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+class Histogram:
+    """Гистограмма с метками (бакеты - верхние границы, как в Prometheus)"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series: Dict[tuple, list] = {}  # метки -> [счетчики бакетов (+Inf последний), сумма, количество]
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def quantile(self, q: float, *labels) -> float:
+        """Оценка квантиля по бакетам с линейной интерполяцией (как histogram_quantile)"""
+        series = self.series.get(labels)
+        if series is None or not series[2]:
+            return 0.0
+        counts, _, count = series
+        rank = q * count
+        cumulative = 0
+        for i, bucket in enumerate(counts):
+            if bucket and cumulative + bucket >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]  # выше последней границы - точнее не сказать
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / bucket
+            cumulative += bucket
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {count}")
+        return lines
+
+class Gauge:
+    """Текущее значение, вычисляется при каждом запросе метрик"""
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+class Metrics:
+    """Реестр метрик и вывод в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.metrics: List[Any] = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+m_updates = metrics.add(Counter('bot_updates_total', "Входящие апдейты", ('type',)))
+m_registrations = metrics.add(Counter('bot_registrations_total', "Новые пользователи"))
+m_links = metrics.add(Counter('bot_links_submitted_total', "Отправленные ссылки", ('link',)))
+m_decisions = metrics.add(Counter('bot_review_decisions_total', "Решения модераторов", ('decision', 'reason_code')))
+m_bans = metrics.add(Counter('bot_bans_total', "Баны", ('kind',)))
+m_support = metrics.add(Counter('bot_support_messages_total', "Сообщения поддержки", ('direction',)))
+m_sent = metrics.add(Counter('bot_outbound_requests_total', "Запросы к Telegram Bot API", ('method',)))
+m_errors = metrics.add(Counter('bot_errors_total', "Ошибки", ('where', 'error')))
+m_review_wait = metrics.add(Histogram(
+    'bot_review_wait_seconds', "Время от отправки заявки до решения",
+    buckets=(60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 86400),
+))
+
+# Задержки: обработчики отдельно от Bot API, очереди исходящих и базы,
+# чтобы было видно, на что уходит время медленного обработчика
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+m_handler_latency = metrics.add(Histogram(
+    'bot_handler_seconds', "Время обработчика", ('handler', 'update_type'), LATENCY_BUCKETS))
+m_api_latency = metrics.add(Histogram(
+    'bot_api_request_seconds', "Время запроса к Telegram Bot API", ('method',), LATENCY_BUCKETS))
+m_outbound_wait = metrics.add(Histogram(
+    'bot_outbound_wait_seconds', "Ожидание в очереди исходящих", ('priority',), LATENCY_BUCKETS))
+m_storage_latency = metrics.add(Histogram(
+    'bot_storage_seconds', "Операции с базой", ('op',), LATENCY_BUCKETS))
+m_loop_lag = metrics.add(Histogram(
+    'bot_event_loop_lag_seconds', "Задержка планирования event loop", buckets=LATENCY_BUCKETS))
+m_loop_stalls = metrics.add(Counter('bot_event_loop_stalls_total', "Зависания event loop дольше LAG_THRESHOLD"))
+
+metrics.add(Gauge('bot_users', "Пользователей", lambda: stats.users))
+metrics.add(Gauge('bot_blacklist_size', "В черном списке", lambda: len(blacklist)))
+metrics.add(Gauge('bot_temp_bans', "Временных банов", lambda: len(temp_bans)))
+metrics.add(Gauge('bot_review_queue_depth', "Заявок в очереди проверки", lambda: review_queue.depth()))
+metrics.add(Gauge('bot_review_oldest_seconds', "Возраст самой старой заявки", lambda: review_queue.oldest_age()))
+metrics.add(Gauge('bot_outbound_queue_depth', "Отправок в очереди", lambda: sum(outbound.depth())))
+
+# Скользящие окна для экрана статистики: (подпись, счетчик)
+ACTIVITY_WINDOWS = (
+    ("📨 Апдейтов", m_updates),
+    ("👤 Регистраций", m_registrations),
+    ("🔗 Ссылок", m_links),
+    ("⚖️ Решений по ссылкам", m_decisions),
+    ("🔨 Банов", m_bans),
+    ("💬 В поддержку", m_support),
+    ("📤 Запросов к API", m_sent),
+    ("⚠️ Ошибок", m_errors),
+    ("🐢 Зависаний event loop", m_loop_stalls),
+)
+
+def format_activity() -> str:
+    """Активность за 1 мин / 1 ч / 24 ч для админ-панели"""
+    text = "📈 АКТИВНОСТЬ (1 мин / 1 ч / 24 ч):\n"
+    for title, counter in ACTIVITY_WINDOWS:
+        minute, hour, day = counter.window.totals()
+        text += f"{title}: {minute} / {hour} / {day}\n"
+    return text
+
+def format_latency(histogram: Histogram, limit: int = 20) -> str:
+    """Таблица p50/p95/p99 по сериям гистограммы, самые медленные сверху (мс)"""
+    rows = []
+    for labels, (_, total, count) in histogram.series.items():
+        p50, p95, p99 = (histogram.quantile(q, *labels) * 1000 for q in (0.5, 0.95, 0.99))
+        rows.append((p99, '/'.join(map(str, labels)), count, total / count * 1000, p50, p95))
+    if not rows:
+        return f"{histogram.help}: нет данных\n"
+    rows.sort(reverse=True)
+    text = f"{histogram.help} (мс, avg / p50 / p95 / p99):\n"
+    for p99, name, count, avg, p50, p95 in rows[:limit]:
+        text += f"  {name}: {count} шт., {avg:.1f} / {p50:.1f} / {p95:.1f} / {p99:.1f}\n"
+    return text
+
+# Имя обработчика для гистограммы: aiogram знает только route_callback и
+# route_message, настоящее имя подставляют CallbackRouter и MessageRouter
+current_handler: ContextVar[str] = ContextVar('current_handler', default='')
+
+async def latency_middleware(handler, event, data):
+    """Внутренний middleware: время обработчика по имени и типу апдейта"""
+    token = current_handler.set(data['handler'].callback.__name__)
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        m_handler_latency.observe(
+            time.perf_counter() - started, current_handler.get(), data['event_update'].event_type)
+        current_handler.reset(token)
+
+# Регистрируется раньше остальных внутренних middleware и учитывает их время
+dp.message.middleware(latency_middleware)
+dp.callback_query.middleware(latency_middleware)
+
+async def metrics_middleware(handler, event: Update, data):
+    """Внешний middleware: считает апдейты по типам и ошибки обработчиков"""
+    m_updates.inc(event.event_type)
+    try:
+        return await handler(event, data)
+    except Exception as e:
+        m_errors.inc('handler', type(e).__name__)
+        raise
+
+# Регистрируем до FSM middleware диспетчера, чтобы считать и отброшенные апдейты
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(metrics_middleware)
+dp.update.outer_middleware(dp.fsm)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    """Запускает HTTP-эндпоинт /metrics (METRICS_HOST:METRICS_PORT)"""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # Порт занят или недоступен - бот работает и без метрик
+        logger.error(f"❌ Не удалось открыть метрики на {METRICS_HOST}:{METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# ==================== MIDDLEWARE БАНОВ ====================
+
+# Сколько апдейтов отброшено до FSM и обработчиков
+gate_stats: Dict[str, int] = {'banned': 0}
+
+async def ban_gate_middleware(handler, event, data):
+    """Внешний middleware: отбрасывает апдейты забаненных до чтения FSM и фильтров"""
+    user = data.get('event_from_user')
+    if user is None:
+        return await handler(event, data)
+    user_id = user.id
+    
+    # Защищенный ID при попадании в бан сразу разбанивается
+    if is_banned(user_id) and not check_protected_id(user_id):
+        gate_stats['banned'] += 1
+        return
+    
+    return await handler(event, data)
+
+# Регистрируем до FSM middleware диспетчера, чтобы не читать состояние отброшенных апдейтов
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(ban_gate_middleware)
+dp.update.outer_middleware(dp.fsm)
+
+# ==================== MIDDLEWARE ДЛЯ ТЕХНИЧЕСКИХ РАБОТ ====================
+# ВАЖНО: global объявлен в самом начале функции!
+
+@dp.message.middleware()
+@dp.callback_query.middleware()
+async def maintenance_middleware(handler, event, data):
+    """Middleware для проверки режима технических работ"""
+    # 1. СНАЧАЛА объявляем все глобальные переменные
+    global maintenance_mode, maintenance_end_time, maintenance_reason, maintenance_message_text
+    
+    # 2. ТОЛЬКО ПОТОМ весь остальной код
+    if not maintenance_mode:
+        return await handler(event, data)
+    
+    # Определяем ID пользователя
+    user_id = None
+    if isinstance(event, Message):
+        user_id = event.from_user.id
+    elif isinstance(event, CallbackQuery):
+        user_id = event.from_user.id
+    
+    # Проверяем доступ
+    if user_id and can_access_during_maintenance(user_id):
+        return await handler(event, data)
+    
+    # Формируем сообщение о техработах
     end_time_str = maintenance_end_time.strftime('%d.%m.%Y %H:%M') if maintenance_end_time else "неизвестно"
     
     maintenance_msg = (
@@ -259,10 +2461,164 @@ async def maintenance_middleware(handler, event, data):
     
     return
 
+# ==================== МАРШРУТИЗАЦИЯ CALLBACK-КНОПОК И СООБЩЕНИЙ ====================
+
+class CallbackRouter:
+    """Диспетчер callback-кнопок за один поиск в словаре.
+
+    Формат callback_data: "действие" или "действие:число:число...".
+    Вместо цепочки фильтров F.data == ... (aiogram проверяет их по очереди)
+    один обработчик разбирает данные и находит действие по имени.
+    Обработчик действия получает callback, state (если он есть в сигнатуре)
+    и числовые аргументы. Число аргументов сверяется с сигнатурой до вызова:
+    кнопка с лишними или недостающими полями считается устаревшей.
+    """
+
+    SEP = ':'
+
+    def __init__(self):
+        self.handlers: Dict[str, Tuple[Callable[..., Awaitable[Any]], bool, int, int]] = {}
+        self.dispatched = 0
+        self.unknown = 0
+
+    def action(self, name: str):
+        """Декоратор: регистрирует обработчик действия"""
+        def register(handler):
+            if name in self.handlers:
+                raise ValueError(f"Действие {name} уже зарегистрировано")
+            parameters = inspect.signature(handler).parameters
+            wants_state = 'state' in parameters
+            # Числовые аргументы - все параметры после callback и state
+            args = list(parameters.values())[2 if wants_state else 1:]
+            required = sum(1 for p in args if p.default is inspect.Parameter.empty)
+            self.handlers[name] = (handler, wants_state, required, len(args))
+            return handler
+        return register
+
+    @classmethod
+    def pack(cls, action: str, *args) -> str:
+        """callback_data для кнопки (аргументы - числа или поля шаблона "{user_id}")"""
+        return cls.SEP.join((action, *map(str, args)))
+
+    @classmethod
+    def unpack(cls, data: str) -> Tuple[str, Tuple[int, ...]]:
+        """(действие, аргументы); ValueError для чужих или испорченных данных"""
+        action, *args = data.split(cls.SEP)
+        return action, tuple(map(int, args))
+
+    async def dispatch(self, callback: CallbackQuery, state: FSMContext):
+        try:
+            action, args = self.unpack(callback.data or '')
+            handler, wants_state, required, total = self.handlers[action]
+            if not required <= len(args) <= total:
+                raise ValueError(f"{action}: {len(args)} аргументов вместо {required}..{total}")
+        except (KeyError, ValueError):
+            # Кнопка из старой версии бота или подделанные данные
+            self.unknown += 1
+            await callback.answer("⚠️ Кнопка устарела, откройте меню заново")
+            return
+        
+        self.dispatched += 1
+        current_handler.set(handler.__name__)
+        if wants_state:
+            await handler(callback, state, *args)
+        else:
+            await handler(callback, *args)
+
+callbacks = CallbackRouter()
+
+@dp.callback_query()
+async def route_callback(callback: CallbackQuery, state: FSMContext):
+    """Единственный обработчик callback-кнопок"""
+    await callbacks.dispatch(callback, state)
+
+class MessageRouter:
+    """Диспетчер сообщений по текущему состоянию FSM.
+
+    Вместо цепочки обработчиков с фильтрами состояний (aiogram проверяет
+    их по очереди) состояние читается один раз, обработчик находится по
+    нему в словаре. Сообщения без подходящего обработчика уходят в fallback.
+    """
+
+    def __init__(self):
+        self.handlers: Dict[str, Tuple[Callable[..., Awaitable[Any]], bool]] = {}
+        self.dispatched = 0
+        self.unhandled = 0
+
+    def state(self, state: State, photo: bool = False):
+        """Декоратор: обработчик сообщений в состоянии state (photo=True - только фото)"""
+        def register(handler):
+            if state.state in self.handlers:
+                raise ValueError(f"Для состояния {state.state} уже есть обработчик")
+            self.handlers[state.state] = (handler, photo)
+            return handler
+        return register
+
+    async def dispatch(self, message: Message, state: FSMContext,
+                       fallback: Callable[[Message, FSMContext], Awaitable[Any]]):
+        entry = self.handlers.get(await state.get_state())
+        if entry is None or (entry[1] and not message.photo):
+            self.unhandled += 1
+            current_handler.set(fallback.__name__)
+            await fallback(message, state)
+            return
+        self.dispatched += 1
+        current_handler.set(entry[0].__name__)
+        await entry[0](message, state)
+
+messages = MessageRouter()
+
 # ==================== КЛАВИАТУРЫ ====================
 
+# Клавиатуры - pydantic-модели, сборка и валидация дерева кнопок на каждый
+# ответ заметно дороже самого ответа. Клавиатуры без параметров и с
+# параметрами из небольшого набора (роль, has_link1, режим техработ)
+# строятся один раз на ключ; ключ уже включает роль и режим, поэтому при их
+# смене берется другой готовый вариант. Клавиатуры с ID пользователя
+# собираются из шаблона копированием уже проверенных кнопок.
+
+def cached_keyboard(build: Callable) -> Callable:
+    """Кэширует клавиатуру по аргументам функции"""
+    return functools.lru_cache(maxsize=None)(build)
+
+class KeyboardTemplate:
+    """Клавиатура с подстановкой в callback_data ({user_id}, {stamp}, ...)"""
+    __slots__ = ('rows',)
+
+    def __init__(self, rows: List[List[Tuple[str, str]]]):
+        self.rows = [
+            [InlineKeyboardButton(text=text, callback_data=data) for text, data in row]
+            for row in rows
+        ]
+
+    def render(self, **values) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup.model_construct(inline_keyboard=[
+            [button.model_copy(update={'callback_data': button.callback_data.format(**values)}) for button in row]
+            for row in self.rows
+        ])
+
+def warm_keyboards():
+    """Строит все варианты клавиатур заранее (при старте)"""
+    for is_staff in (False, True):
+        _main_keyboard(is_staff)
+    for has_link1 in (False, True):
+        get_links_keyboard(has_link1)
+    for maintenance in (False, True):
+        _admin_panel_keyboard(maintenance)
+    for link_num in (1, 2):
+        for has_second in (False, True):
+            _admin_link_template(link_num, has_second)
+    for build in (get_back_keyboard, get_review_keyboard, get_broadcast_keyboard, get_rules_keyboard,
+                  get_already_in_bot_keyboard, get_completion_keyboard, get_admin_ban_keyboard,
+                  get_admin_blacklist_keyboard, get_admin_whitelist_keyboard, get_import_keyboard):
+        build()
+
 def get_main_keyboard(user_id: int = None):
     """Клавиатура главного меню"""
+    return _main_keyboard(bool(user_id and (is_admin(user_id) or is_moderator(user_id))))
+
+@cached_keyboard
+def _main_keyboard(is_staff: bool):
     buttons = [
         [InlineKeyboardButton(text="🚀 Старт", callback_data="start_process")],
         [InlineKeyboardButton(text="📜 Правила", callback_data="show_rules")],
@@ -271,17 +2627,35 @@ def get_main_keyboard(user_id: int = None):
     ]
     
     # Добавляем админ-панель для админов и модераторов
-    if user_id and (is_admin(user_id) or is_moderator(user_id)):
+    if is_staff:
         buttons.append([InlineKeyboardButton(text="👑 Админ-панель", callback_data="admin_panel")])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@cached_keyboard
 def get_back_keyboard():
     """Клавиатура возврата"""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="◀️ Назад / Главное меню", callback_data="back_to_main")]
     ])
 
+@cached_keyboard
+def get_review_keyboard():
+    """Клавиатура счетчика очереди проверки"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📥 Взять заявку", callback_data="review_claim")]
+    ])
+
+@cached_keyboard
+def get_broadcast_keyboard():
+    """Клавиатура отчета о рассылке"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_broadcast_status")],
+        [InlineKeyboardButton(text="⛔ Остановить", callback_data="admin_broadcast_cancel")],
+        [InlineKeyboardButton(text="◀️ Назад / Главное меню", callback_data="back_to_main")]
+    ])
+
+@cached_keyboard
 def get_rules_keyboard():
     """Клавиатура для правил"""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -290,6 +2664,7 @@ def get_rules_keyboard():
         [InlineKeyboardButton(text="◀️ Назад / Главное меню", callback_data="back_to_main")]
     ])
 
+@cached_keyboard
 def get_links_keyboard(has_link1: bool = False):
     """Клавиатура для отправки ссылок"""
     buttons = []
@@ -305,6 +2680,7 @@ def get_links_keyboard(has_link1: bool = False):
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@cached_keyboard
 def get_already_in_bot_keyboard():
     """Клавиатура для выбора бота, в котором уже был"""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -313,6 +2689,7 @@ def get_already_in_bot_keyboard():
         [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_links")]
     ])
 
+@cached_keyboard
 def get_completion_keyboard():
     """Клавиатура для отметки выполнения"""
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -323,219 +2700,757 @@ def get_completion_keyboard():
 
 def get_admin_link_keyboard(user_id: int, link_num: int, has_second: bool = False):
     """Клавиатура для админа при проверке ссылки"""
-    buttons = []
+    # Метка заявки в кнопках - повторные нажатия и старые копии не срабатывают
+    return _admin_link_template(link_num, has_second).render(user_id=user_id, stamp=review_queue.stamp(user_id))
+
+@functools.lru_cache(maxsize=None)
+def _admin_link_template(link_num: int, has_second: bool) -> KeyboardTemplate:
+    rows = []
     
     # Кнопка принятия
-    buttons.append([InlineKeyboardButton(text=f"✅ Принять ссылку №{link_num}", callback_data=f"accept_link_{user_id}_{link_num}")])
+    def reject(reason_code: str) -> str:
+        return CallbackRouter.pack("reject", "{user_id}", link_num, "{stamp}", REJECT_REASON_CODES.index(reason_code))
+    
+    rows.append([(f"✅ Принять ссылку №{link_num}", CallbackRouter.pack("accept", "{user_id}", link_num, "{stamp}"))])
     
     # Кнопки отказа
-    buttons.append([
-        InlineKeyboardButton(text="📊 >6 спонсоров", callback_data=f"reject_reason_{user_id}_{link_num}_more_6"),
-        InlineKeyboardButton(text="🔄 Был в боте", callback_data=f"reject_reason_{user_id}_{link_num}_already_in_bot")
+    rows.append([
+        ("📊 >6 спонсоров", reject("more_6")),
+        ("🔄 Был в боте", reject("already_in_bot"))
     ])
-    buttons.append([
-        InlineKeyboardButton(text="❌ Плохой скрин", callback_data=f"reject_reason_{user_id}_{link_num}_bad_screenshot"),
-        InlineKeyboardButton(text="🤔 Другое", callback_data=f"reject_reason_{user_id}_{link_num}_other")
+    rows.append([
+        ("❌ Плохой скрин", reject("bad_screenshot")),
+        ("🤔 Другое", reject("other"))
     ])
     
     # Если есть вторая ссылка, добавляем кнопку пропуска
     if has_second:
-        buttons.append([InlineKeyboardButton(text="⏭ Пропустить (только 1 ссылка)", callback_data=f"skip_second_{user_id}")])
+        rows.append([("⏭ Пропустить (только 1 ссылка)", CallbackRouter.pack("skip_second", "{user_id}", "{stamp}"))])
     
-    buttons.append([InlineKeyboardButton(text="🚫 В ЧС", callback_data=f"admin_ban_{user_id}")])
+    rows.append([("🚫 В ЧС", CallbackRouter.pack("ban", "{user_id}"))])
     
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return KeyboardTemplate(rows)
 
 def get_admin_panel_keyboard():
     """Клавиатура админ-панели"""
+    return _admin_panel_keyboard(maintenance_mode)
+
+@cached_keyboard
+def _admin_panel_keyboard(maintenance: bool):
     buttons = [
+        [InlineKeyboardButton(text="📥 Взять заявку на проверку", callback_data="review_claim")],
         [InlineKeyboardButton(text="🔨 Бан / Разбан", callback_data="admin_ban_menu")],
         [InlineKeyboardButton(text="⏰ Временный бан", callback_data="admin_temp_ban")],
         [InlineKeyboardButton(text="⛔ Управление ЧС", callback_data="admin_blacklist_menu")],
         [InlineKeyboardButton(text="🛡 Дать права модератора", callback_data="admin_give_moder")],
         [InlineKeyboardButton(text="👑 Дать права администратора", callback_data="admin_give_admin")],
         [InlineKeyboardButton(text="📋 Управление белым списком", callback_data="admin_whitelist_menu")],
+        [InlineKeyboardButton(text="📂 Импорт ID из файла", callback_data="admin_import")],
     ]
     
     # Кнопка управления техработами
-    if maintenance_mode:
+    if maintenance:
         buttons.append([InlineKeyboardButton(text="🔧 Выключить тех. работы", callback_data="admin_maintenance_off")])
     else:
         buttons.append([InlineKeyboardButton(text="🔧 Включить тех. работы", callback_data="admin_maintenance_on")])
     
+    buttons.append([InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")])
     buttons.append([InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")])
     buttons.append([InlineKeyboardButton(text="📜 История тех. работ", callback_data="admin_maintenance_history")])
     buttons.append([InlineKeyboardButton(text="◀️ Назад / Главное меню", callback_data="back_to_main")])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_admin_ban_keyboard():
-    """Клавиатура для бана/разбана"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔨 Забанить навсегда", callback_data="admin_ban_permanent")],
-        [InlineKeyboardButton(text="✅ Разбанить", callback_data="admin_unban")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")]
-    ])
+@cached_keyboard
+def get_admin_ban_keyboard():
+    """Клавиатура для бана/разбана"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔨 Забанить навсегда", callback_data="admin_ban_permanent")],
+        [InlineKeyboardButton(text="✅ Разбанить", callback_data="admin_unban")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")]
+    ])
+
+@cached_keyboard
+def get_admin_blacklist_keyboard():
+    """Клавиатура для ЧС"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ Добавить в ЧС", callback_data="admin_blacklist_add")],
+        [InlineKeyboardButton(text="✅ Удалить из ЧС", callback_data="admin_blacklist_remove")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")]
+    ])
+
+@cached_keyboard
+def get_admin_whitelist_keyboard():
+    """Клавиатура для белого списка"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="➕ Добавить в белый список", callback_data="admin_whitelist_add")],
+        [InlineKeyboardButton(text="➖ Удалить из белого списка", callback_data="admin_whitelist_remove")],
+        [InlineKeyboardButton(text="📋 Показать белый список", callback_data="admin_whitelist_show")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")]
+    ])
+
+@cached_keyboard
+def get_import_keyboard():
+    """Выбор списка для импорта ID"""
+    buttons = [
+        [InlineKeyboardButton(text=title, callback_data=CallbackRouter.pack("admin_import_to", index))]
+        for index, title in enumerate(IMPORT_TARGETS.values())
+    ]
+    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+SUPPORT_KEYBOARD = KeyboardTemplate([[("✍️ Ответить пользователю", CallbackRouter.pack("support_reply", "{user_id}"))]])
+
+def get_support_keyboard(user_id: int):
+    """Клавиатура для ответа на обращение"""
+    return SUPPORT_KEYBOARD.render(user_id=user_id)
+
+# ==================== ПРОФИЛИРОВАНИЕ ====================
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))  # шаг выборки, сек
+PROFILE_DEFAULT_SECONDS = 30
+BOT_FILE = os.path.basename(__file__)
+
+class Profiler:
+    """Профилирование работающего бота без перезапуска.
+
+    sample - таймер SIGPROF раз в PROFILE_INTERVAL процессорного времени
+    снимает стек event loop. Сигнал, а не поток: поток получает GIL только
+    когда loop сам его отпускает (в select), и видел бы один простой.
+    Накладные расходы не зависят от нагрузки, результат - свернутые стеки
+    (collapsed) для flamegraph.pl или speedscope.
+    cprofile - cProfile в потоке event loop: точное число вызовов, но
+    заметно замедляет бота; результат - файл pstats.
+    """
+
+    MODES = ('sample', 'cprofile')
+
+    def __init__(self):
+        self.mode: Optional[str] = None  # режим последнего запуска
+        self.running = False
+        self.started = 0.0
+        self.seconds = 0.0
+        self.duration = 0.0
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self.profile: Optional[cProfile.Profile] = None
+        self._previous_handler = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def start(self, seconds: float, mode: str = 'sample'):
+        """Запускает профилирование на seconds секунд (вызывать из event loop)"""
+        if self.running:
+            raise RuntimeError("Профилирование уже идет")
+        if mode not in self.MODES:
+            raise ValueError(f"Режим должен быть одним из: {', '.join(self.MODES)}")
+        if seconds <= 0:
+            raise ValueError("Длительность должна быть больше нуля")
+        if mode == 'sample' and not hasattr(signal, 'setitimer'):
+            raise RuntimeError("Режим sample недоступен на этой ОС, используйте cprofile")
+        
+        self.mode = mode
+        self.running = True
+        self.started = time.perf_counter()
+        self.seconds = seconds
+        self.stacks = {}
+        self.samples = 0
+        self.profile = None
+        if mode == 'cprofile':
+            # Профилирует поток, в котором включен, - то есть поток event loop
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            # Обработчик сигнала выполняется в главном потоке - потоке event loop
+            self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, PROFILE_INTERVAL, PROFILE_INTERVAL)
+        self._timer = asyncio.get_running_loop().call_later(seconds, self._finish)
+
+    def _finish(self):
+        if self.stop():
+            logger.info(f"🔬 Профилирование завершено, сохранить: /profile dump")
+
+    def stop(self) -> bool:
+        """Останавливает профилирование; False - оно не шло"""
+        if not self.running:
+            return False
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self.profile:
+            self.profile.disable()
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        self.running = False
+        self.duration = time.perf_counter() - self.started
+        return True
+
+    def _sample(self, signum, frame):
+        """Обработчик SIGPROF: добавляет текущий стек в self.stacks"""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            name = getattr(code, 'co_qualname', code.co_name)  # Python 3.11+: Класс.метод
+            names.append(f"{os.path.basename(code.co_filename)}:{name}")
+            frame = frame.f_back
+        stack = ';'.join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    @staticmethod
+    def _bot_frames(stack: str) -> List[str]:
+        """Функции bot.py в свернутом стеке, от внешней к внутренней"""
+        prefix = BOT_FILE + ':'
+        return [frame[len(prefix):] for frame in stack.split(';')
+                if frame.startswith(prefix) and frame != prefix + '<module>']
+
+    def ranking(self, limit: int = 15) -> List[str]:
+        """Функции bot.py, отсортированные по времени с учетом вложенных вызовов"""
+        if self.profile:
+            rows = []
+            for (filename, line, name), (_, calls, own, total, _) in pstats.Stats(self.profile).stats.items():
+                if os.path.basename(filename) == BOT_FILE and name != '<module>':
+                    rows.append((total, own, calls, f"{name} (строка {line})"))
+            rows.sort(reverse=True)
+            return [f"{name}: {total:.3f} сек всего, {own:.3f} сек своих, {calls} вызовов"
+                    for total, own, calls, name in rows[:limit]]
+        
+        totals: Dict[str, int] = {}
+        own: Dict[str, int] = {}
+        for stack, count in self.stacks.items():
+            names = self._bot_frames(stack)
+            if not names:
+                continue
+            for name in set(names):
+                totals[name] = totals.get(name, 0) + count
+            own[names[-1]] = own.get(names[-1], 0) + count
+        samples = self.samples or 1
+        rows = sorted(totals.items(), key=lambda item: -item[1])[:limit]
+        return [f"{name}: {100 * count / samples:.1f}% всего, {100 * own.get(name, 0) / samples:.1f}% своих"
+                for name, count in rows]
+
+    def summary(self) -> str:
+        if self.running:
+            left = self.seconds - (time.perf_counter() - self.started)
+            return f"🔬 Идет профилирование ({self.mode}), осталось {max(left, 0):.0f} сек"
+        if self.mode is None:
+            return "🔬 Профилирование не запускалось"
+        text = f"🔬 Профиль ({self.mode}) за {self.duration:.1f} сек"
+        if self.mode == 'sample':
+            busy = sum(count for stack, count in self.stacks.items() if self._bot_frames(stack))
+            text += f", выборок: {self.samples}, из них в коде бота: {busy}"
+        ranking = self.ranking()
+        return text + ":\n" + ('\n'.join(ranking) if ranking else "код бота не попал в профиль")
+
+    def dump(self, path: Optional[str] = None) -> str:
+        """Сохраняет результат (pstats или свернутые стеки), возвращает путь"""
+        if self.running:
+            raise RuntimeError("Сначала остановите профилирование: /profile stop")
+        if self.mode is None:
+            raise RuntimeError("Нет результатов: /profile start")
+        if path is None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            extension = 'pstats' if self.profile else 'folded'
+            path = os.path.join(PROFILE_DIR, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{extension}")
+        if self.profile:
+            self.profile.dump_stats(path)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                    f.write(f"{stack} {count}\n")
+        return path
+
+profiler = Profiler()
+
+# ==================== КОНТРОЛЬ ЗАДЕРЖЕК EVENT LOOP ====================
+
+LAG_INTERVAL = float(os.getenv('LAG_INTERVAL', '0.05'))    # шаг измерения, сек
+LAG_THRESHOLD = float(os.getenv('LAG_THRESHOLD', '0.25'))  # задержка, после которой снимается стек, сек
+LAG_STALLS_KEPT = 20                                       # последних зависаний для /lag
+LAG_STACK_DEPTH = 15                                       # кадров стека в отчете
+
+class LoopWatchdog:
+    """Измеряет задержку планирования event loop и ловит зависания.
+
+    Задача в loop засыпает на LAG_INTERVAL и сравнивает, сколько спала на
+    самом деле; разница - сколько loop был занят чужим синхронным кодом.
+    Пока loop занят, задача ничего снять не может, поэтому сторожевой поток
+    следит за ее отметкой и при задержке больше LAG_THRESHOLD снимает стек
+    потока loop - это и есть код, который его держит.
+    """
+
+    def __init__(self):
+        self.heartbeat = time.monotonic()  # когда задача последний раз заснула
+        self.max_lag = 0.0
+        self.stalls: deque = deque(maxlen=LAG_STALLS_KEPT)  # (время, задержка, стек)
+        self._captured: Optional[Tuple[float, str]] = None  # (отметка, стек) от потока
+        self._loop_thread = 0
+        self._stop = threading.Event()
+
+    def _watch(self):
+        """Сторожевой поток: снимает стек loop, если отметка давно не обновлялась"""
+        while not self._stop.wait(LAG_INTERVAL):
+            heartbeat = self.heartbeat
+            if time.monotonic() - heartbeat - LAG_INTERVAL < LAG_THRESHOLD:
+                continue
+            if self._captured and self._captured[0] == heartbeat:
+                continue  # это зависание уже снято
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._captured = (heartbeat, ''.join(traceback.format_stack(frame, LAG_STACK_DEPTH)))
+
+    async def run(self):
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+        try:
+            while True:
+                started = self.heartbeat = time.monotonic()
+                await asyncio.sleep(LAG_INTERVAL)
+                lag = max(time.monotonic() - started - LAG_INTERVAL, 0.0)
+                m_loop_lag.observe(lag)
+                self.max_lag = max(self.max_lag, lag)
+                if lag >= LAG_THRESHOLD:
+                    self._record_stall(started, lag)
+        finally:
+            self._stop.set()
+
+    def _record_stall(self, started: float, lag: float):
+        captured = self._captured
+        stack = captured[1] if captured and captured[0] == started else "стек снять не удалось (GIL был занят)\n"
+        self.stalls.append((clock.now(), lag, stack))
+        m_loop_stalls.inc()
+        logger.warning(f"🐢 Event loop был занят {lag * 1000:.0f} мс:\n{stack}")
+
+    def summary(self) -> str:
+        # Квантиль интерполируется внутри корзины и может оказаться больше измеренного максимума
+        p50, p95, p99 = (min(m_loop_lag.quantile(q), self.max_lag) * 1000 for q in (0.5, 0.95, 0.99))
+        return (
+            f"🐢 Задержка event loop: p50 {p50:.1f} мс, p95 {p95:.1f} мс, p99 {p99:.1f} мс, "
+            f"максимум {self.max_lag * 1000:.0f} мс; зависаний дольше {LAG_THRESHOLD * 1000:.0f} мс: {m_loop_stalls.total()}"
+        )
+
+loop_watchdog = LoopWatchdog()
+
+# ==================== МАССОВЫЙ ИМПОРТ ID ====================
+
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # больше бот скачать из Telegram не может
+ID_SEPARATORS = re.compile(r'[\s,;]+')
+
+# Списки, в которые можно импортировать: имя PersistentSet -> подпись
+IMPORT_TARGETS: Dict[str, str] = {
+    'blacklist': "⛔ Черный список",
+    'whitelist': "💘 Белый список",
+    'moderators': "🛡 Модераторы",
+}
+
+def parse_ids(lines: Iterable[str]) -> Tuple[List[int], int, int]:
+    """ID из строк файла (разделители - пробелы, запятые, точки с запятой).
+
+    Возвращает (ID без повторов в порядке появления, число повторов,
+    число нераспознанных значений). Читает построчно, файл целиком в память
+    не загружается.
+    """
+    seen: Dict[int, None] = {}
+    duplicates = invalid = 0
+    for line in lines:
+        for token in ID_SEPARATORS.split(line):
+            if not token:
+                continue
+            if not (token.isascii() and token.isdigit()):
+                invalid += 1
+            elif int(token) in seen:
+                duplicates += 1
+            else:
+                seen[int(token)] = None
+    return list(seen), duplicates, invalid
+
+def read_id_file(path: str) -> Tuple[List[int], int, int]:
+    with open(path, encoding='utf-8', errors='replace') as f:
+        return parse_ids(f)
+
+async def import_ids(name: str, parsed: Tuple[List[int], int, int], started: float) -> str:
+    """Добавляет ID в список одной пакетной записью, возвращает итог"""
+    user_ids, duplicates, invalid = parsed
+    skipped = 0
+    if name == 'blacklist':
+        allowed = [user_id for user_id in user_ids if user_id != PROTECTED_ID and not is_admin(user_id)]
+        skipped = len(user_ids) - len(allowed)
+        user_ids = allowed
+    
+    added = member_lists[name].add_many(user_ids)
+    if name == 'blacklist':
+        for user_id in added:
+            review_queue.complete(user_id)
+        if added:
+            m_bans.inc('import', amount=len(added))
+    
+    # Все изменения уже помечены - одна транзакция на весь импорт
+    await db.flush()
+    
+    text = (
+        f"📥 ИМПОРТ: {IMPORT_TARGETS[name]}\n\n"
+        f"✅ Добавлено: {len(added)}\n"
+        f"↩️ Уже были в списке: {len(user_ids) - len(added)}\n"
+    )
+    if skipped:
+        text += f"🛡 Пропущено (администраторы и защищенный ID): {skipped}\n"
+    text += (
+        f"🔁 Повторов в файле: {duplicates}\n"
+        f"⚠️ Нераспознанных значений: {invalid}\n"
+        f"⏱ {time.perf_counter() - started:.2f} сек"
+    )
+    logger.info(f"📥 Импорт в {name}: добавлено {len(added)} из {len(user_ids) + skipped}")
+    return text
+
+# ==================== КОНСОЛЬ УПРАВЛЕНИЯ ====================
+
+CONTROL_SOCKET = os.getenv('CONTROL_SOCKET', 'bot.sock')  # Unix-сокет консоли, пусто - не запускать
+CONSOLE_END = '\x04'  # строка-признак конца ответа на команду (то же в botctl.py)
+
+class Console:
+    """Консоль управления на Unix-сокете.
+
+    Оператор подключается клиентом botctl.py, команды ищутся в словаре
+    по имени. Каждое подключение обслуживает своя задача, так что
+    операторов может быть несколько; ни потоков, ни опроса stdin.
+    Обработчик получает строку аргументов и функцию вывода.
+    """
+
+    def __init__(self):
+        self.commands: Dict[str, Callable[[str, Callable[[str], None]], Awaitable[None]]] = {}
+        self.clients = 0
+        self.executed = 0
+
+    def command(self, *names: str):
+        """Декоратор: регистрирует обработчик команды (можно под несколькими именами)"""
+        def register(handler):
+            for name in names:
+                if name in self.commands:
+                    raise ValueError(f"Команда {name} уже зарегистрирована")
+                self.commands[name] = handler
+            return handler
+        return register
+
+    async def execute(self, line: str, out: Callable[[str], None]):
+        name, _, args = line.strip().partition(' ')
+        if not name:
+            return
+        handler = self.commands.get(name)
+        if handler is None:
+            out(f"❌ Неизвестная команда: {name}")
+            return
+        self.executed += 1
+        try:
+            await handler(args.strip(), out)
+        except Exception as e:
+            logger.error(f"Ошибка в консольной команде {name}: {e}")
+            out(f"❌ Ошибка: {e}")
+
+    async def serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients += 1
+        logger.info(f"🖥 Оператор подключился к консоли (всего: {self.clients})")
+        
+        def out(text: str):
+            writer.write(f"{text}\n".encode())
+        
+        try:
+            out(f"🖥 Консоль бота, операторов: {self.clients}. /help - список команд")
+            out(CONSOLE_END)
+            await writer.drain()
+            while line := await reader.readline():
+                command = line.decode(errors='replace').strip()
+                if command:
+                    logger.info(f"🖥 Консоль: {command}")
+                    await self.execute(command, out)
+                out(CONSOLE_END)
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass  # клиент отключился или прислал слишком длинную строку
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def start(self, path: str) -> Optional[asyncio.AbstractServer]:
+        """Открывает сокет консоли (доступ только владельцу процесса)"""
+        if not path:
+            return None
+        if not hasattr(asyncio, 'start_unix_server'):
+            logger.warning("🖥 Unix-сокеты недоступны на этой ОС, консоль управления выключена")
+            return None
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)  # сокет от предыдущего запуска
+        # Сокет сразу создается с правами 0600: консоль может банить и
+        # рассылать, другие пользователи системы не должны успеть подключиться
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.serve_client, path)
+        except OSError as e:
+            logger.error(f"❌ Не удалось открыть сокет консоли {path}: {e}")
+            return None
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)  # на случай ОС, где umask не влияет на сокеты
+        logger.info(f"🖥 Консоль управления: python botctl.py --socket {path}")
+        return server
+
+console = Console()
+
+@console.command('/maintenance_on')
+async def console_maintenance_on(args: str, out):
+    """/maintenance_on <время> [причина]"""
+    global maintenance_mode, maintenance_end_time, maintenance_reason
+    parts = args.split(' ', 2)
+    if len(parts) > 1 and '.' in parts[0] and ':' in parts[1]:
+        # ДД.ММ.ГГГГ ЧЧ:ММ - дата и время через пробел
+        time_str = f"{parts[0]} {parts[1]}"
+        reason = parts[2] if len(parts) > 2 else ""
+    else:
+        time_str = parts[0]
+        reason = args[len(time_str):].strip()
+    if not time_str:
+        out("❌ Укажите время: /maintenance_on <время> [причина]")
+        return
+    
+    try:
+        # Пробуем разные форматы
+        if ':' in time_str and '.' in time_str:
+            # Формат ДД.ММ.ГГГГ ЧЧ:ММ
+            end_time = datetime.strptime(time_str, '%d.%m.%Y %H:%M')
+        elif ':' in time_str:
+            # Формат ЧЧ:ММ (сегодня)
+            hours, minutes = map(int, time_str.split(':'))
+            now = datetime.now()
+            end_time = datetime(now.year, now.month, now.day, hours, minutes)
+            if end_time < now:
+                end_time += timedelta(days=1)
+        else:
+            # Формат относительного времени
+            seconds = parse_time_string(time_str)
+            if seconds:
+                end_time = datetime.now() + timedelta(seconds=seconds)
+            else:
+                out("❌ Неверный формат времени. Используйте: ДД.ММ.ГГГГ ЧЧ:ММ, ЧЧ:ММ или 30m, 2h, 1d")
+                return
+        
+        maintenance_mode = True
+        maintenance_end_time = end_time
+        maintenance_reason = reason
+        
+        maintenance_history.append({
+            'admin': 'console',
+            'start_time': datetime.now(),
+            'end_time': end_time,
+            'reason': reason,
+            'status': 'active'
+        })
+        save_maintenance_record()
+        
+        out(f"✅ Технические работы включены до {end_time.strftime('%d.%m.%Y %H:%M')}")
+        if reason:
+            out(f"📝 Причина: {reason}")
+        
+    except ValueError:
+        out("❌ Неверный формат даты. Используйте: ДД.ММ.ГГГГ ЧЧ:ММ")
+
+@console.command('/maintenance_off')
+async def console_maintenance_off(args: str, out):
+    global maintenance_mode, maintenance_end_time, maintenance_reason
+    if maintenance_history:
+        maintenance_history[-1]['status'] = 'completed'
+        maintenance_history[-1]['actual_end_time'] = datetime.now()
+        save_maintenance_record()
+    
+    maintenance_mode = False
+    maintenance_end_time = None
+    maintenance_reason = ""
+    
+    out("✅ Технические работы выключены")
+
+@console.command('/maintenance_status')
+async def console_maintenance_status(args: str, out):
+    if maintenance_mode:
+        end_time_str = maintenance_end_time.strftime('%d.%m.%Y %H:%M') if maintenance_end_time else "неизвестно"
+        out(f"🔧 Технические работы: ВКЛ")
+        out(f"⏳ До: {end_time_str}")
+        if maintenance_reason:
+            out(f"📝 Причина: {maintenance_reason}")
+        out(f"💘 В белом списке: {len(whitelist)} пользователей")
+    else:
+        out("✅ Технические работы: ВЫКЛ")
+
+@console.command('/whitelist_add')
+async def console_whitelist_add(args: str, out):
+    try:
+        user_id = int(args)
+    except ValueError:
+        out("❌ Неверный формат ID")
+        return
+    whitelist.add(user_id)
+    out(f"✅ Пользователь {user_id} добавлен в белый список")
+
+@console.command('/whitelist_remove')
+async def console_whitelist_remove(args: str, out):
+    try:
+        user_id = int(args)
+    except ValueError:
+        out("❌ Неверный формат ID")
+        return
+    if user_id in whitelist:
+        whitelist.remove(user_id)
+        out(f"✅ Пользователь {user_id} удален из белого списка")
+    else:
+        out(f"⚠️ Пользователь {user_id} не в белом списке")
+
+@console.command('/whitelist_list')
+async def console_whitelist_list(args: str, out):
+    out(f"📋 БЕЛЫЙ СПИСОК ({len(whitelist)}):")
+    for uid in sorted(whitelist):
+        user_info = users_db.get(uid, {})
+        username = user_info.get('username', 'нет username')
+        out(f"  • {uid} (@{username})")
+
+@console.command('/unbanall')
+async def console_unbanall(args: str, out):
+    blacklist.clear()
+    temp_bans.clear()
+    out(f"✅ Все пользователи разбанены")
+
+@console.command('/broadcast')
+async def console_broadcast(args: str, out):
+    if broadcaster.active:
+        out("⚠️ Рассылка уже идет. /broadcast_status - прогресс, /broadcast_cancel - остановить")
+    elif len(args) > BROADCAST_MAX_LENGTH:
+        out(f"❌ Текст длиннее {BROADCAST_MAX_LENGTH} символов ({len(args)})")
+    elif args:
+        broadcast = broadcaster.start(args)
+        out(f"📢 Рассылка #{broadcast.id} запущена")
+    else:
+        out("❌ Укажите текст: /broadcast <текст>")
+
+@console.command('/broadcast_status')
+async def console_broadcast_status(args: str, out):
+    out(broadcaster.progress_text())
+
+@console.command('/broadcast_cancel')
+async def console_broadcast_cancel(args: str, out):
+    if broadcaster.cancel():
+        out("⛔ Рассылка остановлена")
+    else:
+        out("⚠️ Нет активной рассылки")
 
-def get_admin_blacklist_keyboard():
-    """Клавиатура для ЧС"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⛔ Добавить в ЧС", callback_data="admin_blacklist_add")],
-        [InlineKeyboardButton(text="✅ Удалить из ЧС", callback_data="admin_blacklist_remove")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")]
-    ])
+@console.command('/stats_check')
+async def console_stats_check(args: str, out):
+    started = time.perf_counter()
+    drift = stats.check()
+    elapsed = time.perf_counter() - started
+    if drift:
+        for name, (counted, actual) in drift.items():
+            out(f"⚠️ {name}: счетчик {counted}, на самом деле {actual} (исправлено)")
+    else:
+        out(f"✅ Счетчики статистики сходятся ({stats.users} пользователей)")
+    out(f"⏱ Пересчет за {elapsed:.3f} сек")
 
-def get_admin_whitelist_keyboard():
-    """Клавиатура для белого списка"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Добавить в белый список", callback_data="admin_whitelist_add")],
-        [InlineKeyboardButton(text="➖ Удалить из белого списка", callback_data="admin_whitelist_remove")],
-        [InlineKeyboardButton(text="📋 Показать белый список", callback_data="admin_whitelist_show")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")]
-    ])
+@console.command('/queue')
+async def console_queue(args: str, out):
+    out(review_queue.counter_text())
+    out(f"🛡 Взято в работу: {len(review_queue.live_claims())}")
+    out(f"📊 Поступило: {review_queue.submitted}, проверено: {review_queue.completed}")
 
-def get_support_keyboard(user_id: int):
-    """Клавиатура для ответа на обращение"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✍️ Ответить пользователю", callback_data=f"support_reply_{user_id}")]
-    ])
+@console.command('/metrics')
+async def console_metrics(args: str, out):
+    out(format_activity().rstrip('\n'))
+    if METRICS_PORT:
+        out(f"🌐 http://{METRICS_HOST}:{METRICS_PORT}/metrics")
 
-# Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+@console.command('/latency')
+async def console_latency(args: str, out):
+    for histogram in (m_handler_latency, m_api_latency, m_outbound_wait, m_storage_latency):
+        out(format_latency(histogram).rstrip('\n'))
+    out(loop_watchdog.summary())
 
-# ==================== ОБРАБОТЧИКИ КОНСОЛЬНЫХ КОМАНД ====================
+@console.command('/lag')
+async def console_lag(args: str, out):
+    out(loop_watchdog.summary())
+    for ts, lag, stack in loop_watchdog.stalls:
+        out(f"\n⏱ {format_timestamp(ts)}, {lag * 1000:.0f} мс:\n{stack.rstrip()}")
 
-async def console_command_handler():
-    """Обработчик консольных команд"""
-    while True:
-        try:
-            command = await asyncio.get_event_loop().run_in_executor(None, sys.stdin.readline)
-            command = command.strip()
-            
-            if not command:
-                continue
-            
-            # /maintenance_on <время> [причина]
-            if command.startswith('/maintenance_on '):
-                parts = command.split(' ', 2)
-                time_str = parts[1]
-                reason = parts[2] if len(parts) > 2 else ""
-                
-                # Здесь нужно global, потому что мы ИЗМЕНЯЕМ переменные
-                global maintenance_mode, maintenance_end_time, maintenance_reason
-                
-                try:
-                    # Пробуем разные форматы
-                    if ':' in time_str and '.' in time_str:
-                        # Формат ДД.ММ.ГГГГ ЧЧ:ММ
-                        end_time = datetime.strptime(time_str, '%d.%m.%Y %H:%M')
-                    elif ':' in time_str:
-                        # Формат ЧЧ:ММ (сегодня)
-                        hours, minutes = map(int, time_str.split(':'))
-                        now = datetime.now()
-                        end_time = datetime(now.year, now.month, now.day, hours, minutes)
-                        if end_time < now:
-                            end_time += timedelta(days=1)
-                    else:
-                        # Формат относительного времени
-                        seconds = parse_time_string(time_str)
-                        if seconds:
-                            end_time = datetime.now() + timedelta(seconds=seconds)
-                        else:
-                            print("❌ Неверный формат времени. Используйте: ДД.ММ.ГГГГ ЧЧ:ММ, ЧЧ:ММ или 30m, 2h, 1d")
-                            continue
-                    
-                    maintenance_mode = True
-                    maintenance_end_time = end_time
-                    maintenance_reason = reason
-                    
-                    maintenance_history.append({
-                        'admin': 'console',
-                        'start_time': datetime.now(),
-                        'end_time': end_time,
-                        'reason': reason,
-                        'status': 'active'
-                    })
-                    
-                    print(f"✅ Технические работы включены до {end_time.strftime('%d.%m.%Y %H:%M')}")
-                    if reason:
-                        print(f"📝 Причина: {reason}")
-                    
-                except ValueError:
-                    print("❌ Неверный формат даты. Используйте: ДД.ММ.ГГГГ ЧЧ:ММ")
-            
-            # /maintenance_off
-            elif command == '/maintenance_off':
-                # Здесь нужно global, потому что мы ИЗМЕНЯЕМ переменные
-                global maintenance_mode, maintenance_end_time, maintenance_reason
-                
-                if maintenance_history:
-                    maintenance_history[-1]['status'] = 'completed'
-                    maintenance_history[-1]['actual_end_time'] = datetime.now()
-                
-                maintenance_mode = False
-                maintenance_end_time = None
-                maintenance_reason = ""
-                
-                print("✅ Технические работы выключены")
-            
-            # /maintenance_status
-            elif command == '/maintenance_status':
-                if maintenance_mode:
-                    end_time_str = maintenance_end_time.strftime('%d.%m.%Y %H:%M') if maintenance_end_time else "неизвестно"
-                    print(f"🔧 Технические работы: ВКЛ")
-                    print(f"⏳ До: {end_time_str}")
-                    if maintenance_reason:
-                        print(f"📝 Причина: {maintenance_reason}")
-                    print(f"💘 В белом списке: {len(whitelist)} пользователей")
-                else:
-                    print("✅ Технические работы: ВЫКЛ")
-            
-            # /whitelist_add <id>
-            elif command.startswith('/whitelist_add '):
-                parts = command.split()
-                if len(parts) == 2:
-                    try:
-                        user_id = int(parts[1])
-                        whitelist.add(user_id)
-                        print(f"✅ Пользователь {user_id} добавлен в белый список")
-                    except ValueError:
-                        print("❌ Неверный формат ID")
-            
-            # /whitelist_remove <id>
-            elif command.startswith('/whitelist_remove '):
-                parts = command.split()
-                if len(parts) == 2:
-                    try:
-                        user_id = int(parts[1])
-                        if user_id in whitelist:
-                            whitelist.remove(user_id)
-                            print(f"✅ Пользователь {user_id} удален из белого списка")
-                        else:
-                            print(f"⚠️ Пользователь {user_id} не в белом списке")
-                    except ValueError:
-                        print("❌ Неверный формат ID")
-            
-            # /whitelist_list
-            elif command == '/whitelist_list':
-                print(f"📋 БЕЛЫЙ СПИСОК ({len(whitelist)}):")
-                for uid in sorted(whitelist):
-                    user_info = users_db.get(uid, {})
-                    username = user_info.get('username', 'нет username')
-                    print(f"  • {uid} (@{username})")
-            
-            # /unbanall
-            elif command == '/unbanall':
-                blacklist.clear()
-                temp_bans.clear()
-                print(f"✅ Все пользователи разбанены")
-            
-            # /help
-            elif command == '/help':
-                print("""
-ДОСТУПНЫЕ КОНСОЛЬНЫЕ КОМАНДЫ:
+@console.command('/profile')
+async def console_profile(args: str, out):
+    """/profile start [секунд] [sample|cprofile] | stop | dump [файл]"""
+    args = args.split()
+    action = args[0] if args else 'status'
+    try:
+        if action == 'start':
+            seconds = float(args[1]) if len(args) > 1 else PROFILE_DEFAULT_SECONDS
+            mode = args[2] if len(args) > 2 else 'sample'
+            profiler.start(seconds, mode)
+            out(f"🔬 Профилирование ({mode}) на {seconds:g} сек, досрочно: /profile stop")
+        elif action == 'stop':
+            if profiler.stop():
+                out(profiler.summary())
+            else:
+                out("⚠️ Профилирование не запущено")
+        elif action == 'dump':
+            path = await asyncio.to_thread(profiler.dump, args[1] if len(args) > 1 else None)
+            out(profiler.summary())
+            out(f"💾 Сохранено: {path}")
+        else:
+            out(profiler.summary())
+    except (RuntimeError, ValueError) as e:
+        out(f"❌ {e}")
+
+@console.command('/compact')
+async def console_compact(args: str, out):
+    out(f"💾 Журнал: {format_size(db.journal_size())}, {db.journal_records} записей")
+    result = await db.compact()
+    out(
+        f"✅ Журнал сжат в снимок: {result['records']} записей за {result['duration']:.2f} сек "
+        f"({format_size(result['size_before'])} → {format_size(result['size_after'])})"
+    )
+    out(f"⏱ Восстановление при старте: {db.replayed} записей за {db.replay_time:.3f} сек")
+
+@console.command('/import')
+async def console_import(args: str, out):
+    """/import <blacklist|whitelist|moderators> <файл>"""
+    name, _, path = args.partition(' ')
+    path = path.strip()
+    if name not in IMPORT_TARGETS or not path:
+        out(f"❌ Использование: /import <{'|'.join(IMPORT_TARGETS)}> <файл>")
+        return
+    started = time.perf_counter()
+    try:
+        parsed = await asyncio.to_thread(read_id_file, path)
+    except OSError as e:
+        out(f"❌ Не удалось прочитать файл: {e}")
+        return
+    summary = await import_ids(name, parsed, started)
+    out(summary)
+    notifier.notify(f"{summary}\n\n🖥 Импорт из консоли: {os.path.basename(path)}")
+
+@console.command('/run')
+async def console_run(args: str, out):
+    """/run <файл> - команды из файла по одной на строку (# - комментарий)"""
+    try:
+        with open(args, encoding='utf-8') as f:
+            lines = [line.strip() for line in f]
+    except OSError as e:
+        out(f"❌ Не удалось прочитать файл: {e}")
+        return
+    executed = 0
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        if line.split(' ', 1)[0] == '/run':
+            out(f"⚠️ Пропущено (вложенный /run): {line}")
+            continue
+        out(f"> {line}")
+        await console.execute(line, out)
+        executed += 1
+    out(f"✅ Выполнено команд: {executed}")
+
+CONSOLE_HELP = """ДОСТУПНЫЕ КОНСОЛЬНЫЕ КОМАНДЫ:
 
 🔧 ТЕХНИЧЕСКИЕ РАБОТЫ:
 /maintenance_on <время> [причина] - включить техработы
@@ -553,14 +3468,39 @@ async def console_command_handler():
 🔨 БАНЫ:
 /unbanall - разбанить всех
 
-👑 ПРАВА:
-                """)
-            
-            elif command:
-                print(f"❌ Неизвестная команда: {command}")
-        
-        except Exception as e:
-            logger.error(f"Ошибка в консольной команде: {e}")
+📂 МАССОВЫЕ ОПЕРАЦИИ:
+/import <blacklist|whitelist|moderators> <файл> - добавить ID из файла одной записью в базу
+   ID через пробел, запятую, точку с запятой или по одному на строку
+/run <файл> - выполнить команды из файла, по одной на строку (# - комментарий)
+
+📢 РАССЫЛКА:
+/broadcast <текст> - разослать сообщение всем пользователям
+/broadcast_status - прогресс, скорость и оставшееся время
+/broadcast_cancel - остановить рассылку
+
+📥 ПРОВЕРКА:
+/queue - размер очереди проверки и возраст самой старой заявки
+/stats_check - пересчитать статистику с нуля и показать расхождения
+/metrics - активность за минуту, час и сутки
+/latency - p50/p95/p99 обработчиков, запросов к Bot API, очереди отправки и базы
+/lag - задержка event loop и стеки последних зависаний
+
+💾 ХРАНИЛИЩЕ:
+/compact - сжать журнал в снимок, показать размер журнала и время восстановления
+
+🔬 ПРОФИЛИРОВАНИЕ:
+/profile start [секунд] [sample|cprofile] - профилировать работающего бота (по умолчанию 30 сек, sample)
+/profile stop - остановить досрочно и показать самые затратные функции бота
+/profile dump [файл] - сохранить свернутые стеки (для flamegraph.pl) или pstats
+/profile - статус
+
+🖥 КОНСОЛЬ:
+/help - эта справка
+/quit - отключиться (в botctl.py)"""
+
+@console.command('/help')
+async def console_help(args: str, out):
+    out(CONSOLE_HELP)
 
 # ==================== ОБРАБОТЧИКИ ПОЛЬЗОВАТЕЛЕЙ ====================
 
@@ -577,43 +3517,24 @@ async def cmd_start(message: Message, state: FSMContext):
         await message.answer("⛔ Вы заблокированы в боте.")
         return
     
+    # Пользователь снова пишет боту - он доступен для рассылок
+    unreachable.discard(user_id)
+    
     # Инициализация пользователя
     if user_id not in users_db:
-        users_db[user_id] = {
-            'username': message.from_user.username,
-            'first_name': message.from_user.first_name,
-            'link1': None,
-            'link2': None,
-            'link1_done': False,
-            'link2_done': False,
-            'link1_screenshot': None,
-            'link2_screenshot': None,
-            'link1_rejected': False,
-            'link2_rejected': False,
-            'already_in_bot_1': False,
-            'already_in_bot_2': False,
-            'active_refs': 0,
-            'history': [],
-            'joined_date': datetime.now().strftime('%d.%m.%Y %H:%M')
-        }
+        users_db[user_id] = UserRecord(
+            username=message.from_user.username,
+            first_name=message.from_user.first_name,
+            joined_date=clock.now()
+        )
+        stats.add(users_db[user_id])
+        m_registrations.inc()
+        save_user(user_id)
     
     # Сброс состояния
     await state.clear()
     
-    # Получение статусов
-    status1, status2 = get_user_status_emoji(user_id)
-    
-    welcome_text = (
-        f"🔰 Здравствуй, {message.from_user.first_name}!\n"
-        f"Добро пожаловать в бот взаимного реферала!\n\n"
-        f"📊 МОИ РЕФЕРАЛЬНЫЕ ССЫЛКИ:\n\n"
-        f"№1 – {BOT_LINKS[0]['name']}\n"
-        f"{BOT_LINKS[0]['url']}\n"
-        f"Статус: {status1}\n\n"
-        f"№2 – {BOT_LINKS[1]['name']}\n"
-        f"{BOT_LINKS[1]['url']}\n"
-        f"Статус: {status2}"
-    )
+    welcome_text = render_welcome(message.from_user.first_name, users_db.get(user_id))
     
     await message.answer(welcome_text, reply_markup=get_main_keyboard(user_id))
 
@@ -632,7 +3553,7 @@ async def cmd_admin(message: Message, state: FSMContext):
         reply_markup=get_admin_panel_keyboard()
     )
 
-@dp.callback_query(F.data == "start_process")
+@callbacks.action("start_process")
 async def start_process(callback: CallbackQuery, state: FSMContext):
     """Начало процесса (кнопка Старт)"""
     await callback.message.edit_text(
@@ -641,13 +3562,13 @@ async def start_process(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "back_to_main")
+@callbacks.action("back_to_main")
 async def back_to_main(callback: CallbackQuery, state: FSMContext):
     """Возврат в главное меню"""
     await state.clear()
     await cmd_start(callback.message, state)
 
-@dp.callback_query(F.data == "back_to_links")
+@callbacks.action("back_to_links")
 async def back_to_links(callback: CallbackQuery, state: FSMContext):
     """Возврат к меню ссылок"""
     user_id = callback.from_user.id
@@ -661,7 +3582,7 @@ async def back_to_links(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_links)
     await callback.answer()
 
-@dp.callback_query(F.data == "show_rules")
+@callbacks.action("show_rules")
 async def show_rules(callback: CallbackQuery):
     """Показывает правила"""
     await callback.message.edit_text(
@@ -670,14 +3591,14 @@ async def show_rules(callback: CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "accept_rules")
+@callbacks.action("accept_rules")
 async def accept_rules(callback: CallbackQuery, state: FSMContext):
     """Принятие правил"""
     user_id = callback.from_user.id
     
     # Добавляем в историю
     if user_id in users_db:
-        users_db[user_id]['history'].append(f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Принял правила")
+        add_history(user_id, HISTORY_ACCEPT_RULES)
     
     await callback.message.edit_text(
         "✅ Правила приняты!\n\n"
@@ -689,17 +3610,18 @@ async def accept_rules(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_links)
     await callback.answer()
 
-@dp.callback_query(F.data == "reject_rules")
+@callbacks.action("reject_rules")
 async def reject_rules(callback: CallbackQuery, state: FSMContext):
     """Отказ от правил"""
     user_id = callback.from_user.id
     
     # Добавляем в ЧС
     blacklist.add(user_id)
+    m_bans.inc('rules')
     
     # Добавляем в историю
     if user_id in users_db:
-        users_db[user_id]['history'].append(f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Отказ от правил")
+        add_history(user_id, HISTORY_REJECT_RULES)
     
     # Уведомление пользователю
     await callback.message.edit_text(
@@ -708,20 +3630,15 @@ async def reject_rules(callback: CallbackQuery, state: FSMContext):
     )
     
     # Уведомление админам
-    for admin_id in admins:
-        try:
-            await bot.send_message(
-                admin_id,
-                f"⚠️ Пользователь @{callback.from_user.username} (ID: {user_id}) "
-                f"отказался от правил и добавлен в ЧС."
-            )
-        except:
-            pass
+    notifier.notify(
+        f"⚠️ Пользователь @{callback.from_user.username} (ID: {user_id}) "
+        f"отказался от правил и добавлен в ЧС."
+    )
     
     await state.clear()
     await callback.answer()
 
-@dp.callback_query(F.data == "profile")
+@callbacks.action("profile")
 async def show_profile(callback: CallbackQuery):
     """Показывает профиль пользователя"""
     user_id = callback.from_user.id
@@ -733,39 +3650,12 @@ async def show_profile(callback: CallbackQuery):
         )
         return
     
-    user_data = users_db[user_id]
-    status1, status2 = get_user_status_emoji(user_id)
-    in_blacklist = "Да" if user_id in blacklist else "Нет"
-    in_temp_ban = "Да" if user_id in temp_bans else "Нет"
-    in_whitelist = "Да" if user_id in whitelist else "Нет"
-    
-    profile_text = (
-        f"👤 ПРОФИЛЬ ПОЛЬЗОВАТЕЛЯ\n\n"
-        f"🆔 ID: {user_id}\n"
-        f"📝 Имя: {user_data.get('first_name', 'Не указано')}\n"
-        f"📅 Регистрация: {user_data.get('joined_date', 'Неизвестно')}\n\n"
-        f"📊 Активные рефералы: {user_data.get('active_refs', 0)}\n"
-        f"🔗 СТАТУС ПО БОТАМ:\n"
-        f"{get_bot_status_text(user_data)}\n"
-        f"⛔ В черном списке: {in_blacklist}\n"
-        f"⏰ Временный бан: {in_temp_ban}\n"
-        f"💘 В белом списке: {in_whitelist}\n\n"
-    )
-    
-    # Добавляем ссылки пользователя
-    if user_data.get('link1'):
-        profile_text += f"🔗 Ссылка №1: {user_data['link1']}\n"
-    if user_data.get('link2'):
-        profile_text += f"🔗 Ссылка №2: {user_data['link2']}\n"
-    
-    # Добавляем историю
-    if user_data.get('history'):
-        profile_text += f"\n{format_user_history(user_data)}"
+    profile_text = render_profile(user_id, users_db[user_id])
     
     await callback.message.edit_text(profile_text, reply_markup=get_back_keyboard())
     await callback.answer()
 
-@dp.callback_query(F.data == "support")
+@callbacks.action("support")
 async def support_action(callback: CallbackQuery, state: FSMContext):
     """Обращение в поддержку"""
     await callback.message.edit_text(
@@ -776,35 +3666,29 @@ async def support_action(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_support_message)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_support_message)
+@messages.state(ReferralStates.waiting_for_support_message)
 async def process_support_message(message: Message, state: FSMContext):
     """Обработка сообщения в поддержку"""
     user_id = message.from_user.id
     username = message.from_user.username or "нет username"
     
     # Сохраняем в историю переписки
-    if user_id not in support_chats:
-        support_chats[user_id] = []
-    
-    support_chats[user_id].append({
-        'time': datetime.now().strftime('%d.%m.%Y %H:%M'),
+    add_support_message(user_id, {
+        'time': clock.now(),
         'from': 'user',
         'text': message.text
     })
+    m_support.inc('user')
     
     # Отправка всем админам и модераторам
-    for admin_id in admins.union(moderators):
-        try:
-            await bot.send_message(
-                admin_id,
-                f"💬 НОВОЕ ОБРАЩЕНИЕ В ПОДДЕРЖКУ\n\n"
-                f"👤 От: @{username}\n"
-                f"🆔 ID: {user_id}\n"
-                f"📝 Сообщение: {message.text}",
-                reply_markup=get_support_keyboard(user_id)
-            )
-        except Exception as e:
-            logger.error(f"Ошибка отправки админу {admin_id}: {e}")
+    notifier.notify(
+        f"💬 НОВОЕ ОБРАЩЕНИЕ В ПОДДЕРЖКУ\n\n"
+        f"👤 От: @{username}\n"
+        f"🆔 ID: {user_id}\n"
+        f"📝 Сообщение: {message.text}",
+        reply_markup=get_support_keyboard(user_id),
+        with_moderators=True
+    )
     
     await message.answer(
         "✅ Ваше сообщение отправлено в поддержку. Ожидайте ответа.",
@@ -812,10 +3696,9 @@ async def process_support_message(message: Message, state: FSMContext):
     )
     await state.clear()
 
-@dp.callback_query(F.data.startswith("support_reply_"))
-async def support_reply(callback: CallbackQuery, state: FSMContext):
+@callbacks.action("support_reply")
+async def support_reply(callback: CallbackQuery, state: FSMContext, user_id: int):
     """Ответ на обращение в поддержку"""
-    user_id = int(callback.data.split("_")[2])
     
     await callback.message.edit_text(
         f"✍️ Напишите ответ пользователю (ID: {user_id}):"
@@ -824,7 +3707,7 @@ async def support_reply(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_support_reply)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_support_reply)
+@messages.state(ReferralStates.waiting_for_support_reply)
 async def process_support_reply(message: Message, state: FSMContext):
     """Отправка ответа пользователю"""
     data = await state.get_data()
@@ -838,16 +3721,14 @@ async def process_support_reply(message: Message, state: FSMContext):
         return
     
     # Сохраняем в историю
-    if target_user not in support_chats:
-        support_chats[target_user] = []
-    
-    support_chats[target_user].append({
-        'time': datetime.now().strftime('%d.%m.%Y %H:%M'),
+    add_support_message(target_user, {
+        'time': clock.now(),
         'from': 'admin',
         'admin_id': admin_id,
         'admin_name': admin_name,
         'text': message.text
     })
+    m_support.inc('staff')
     
     # ОТПРАВЛЯЕМ ПОЛЬЗОВАТЕЛЮ
     try:
@@ -860,16 +3741,11 @@ async def process_support_reply(message: Message, state: FSMContext):
         await message.answer(f"✅ Ответ отправлен пользователю {target_user}")
         
         # Уведомление другим админам
-        for adm_id in admins:
-            if adm_id != admin_id:
-                try:
-                    await bot.send_message(
-                        adm_id,
-                        f"👤 Админ @{message.from_user.username} ответил пользователю {target_user}"
-                    )
-                except:
-                    pass
-                    
+        notifier.notify(
+            f"👤 Админ @{message.from_user.username} ответил пользователю {target_user}",
+            exclude=admin_id
+        )
+        
     except Exception as e:
         await message.answer(f"❌ Ошибка отправки: {e}")
         logger.error(f"Ошибка отправки ответа пользователю {target_user}: {e}")
@@ -878,7 +3754,7 @@ async def process_support_reply(message: Message, state: FSMContext):
 
 # ==================== ОБРАБОТЧИКИ ССЫЛОК И СКРИНШОТОВ ====================
 
-@dp.callback_query(F.data == "send_link1")
+@callbacks.action("send_link1")
 async def send_link1(callback: CallbackQuery, state: FSMContext):
     """Отправка первой ссылки"""
     await callback.message.edit_text(
@@ -888,7 +3764,7 @@ async def send_link1(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_link1)
     await callback.answer()
 
-@dp.callback_query(F.data == "send_link2")
+@callbacks.action("send_link2")
 async def send_link2(callback: CallbackQuery, state: FSMContext):
     """Отправка второй ссылки"""
     await callback.message.edit_text(
@@ -898,7 +3774,7 @@ async def send_link2(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_link2)
     await callback.answer()
 
-@dp.callback_query(F.data == "skip_link2")
+@callbacks.action("skip_link2")
 async def skip_link2(callback: CallbackQuery, state: FSMContext):
     """Пропуск второй ссылки"""
     user_id = callback.from_user.id
@@ -911,7 +3787,7 @@ async def skip_link2(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_screenshot1)
     await callback.answer()
 
-@dp.callback_query(F.data == "already_in_bot_menu")
+@callbacks.action("already_in_bot_menu")
 async def already_in_bot_menu(callback: CallbackQuery, state: FSMContext):
     """Меню выбора бота, в котором уже был"""
     await callback.message.edit_text(
@@ -921,14 +3797,14 @@ async def already_in_bot_menu(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_already_in_bot_choice)
     await callback.answer()
 
-@dp.callback_query(F.data == "already_in_bot_1")
+@callbacks.action("already_in_bot_1")
 async def already_in_bot_1(callback: CallbackQuery, state: FSMContext):
     """Пользователь уже был в боте №1"""
     user_id = callback.from_user.id
     
     if user_id in users_db:
         users_db[user_id]['already_in_bot_1'] = True
-        users_db[user_id]['history'].append(f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Отметил, что уже был в {BOT_LINKS[0]['name']}")
+        add_history(user_id, HISTORY_ALREADY_IN_BOT, 1)
     
     await callback.message.edit_text(
         f"🔄 Вы уже были в боте {BOT_LINKS[0]['name']}.\n\n"
@@ -938,14 +3814,14 @@ async def already_in_bot_1(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_links)
     await callback.answer()
 
-@dp.callback_query(F.data == "already_in_bot_2")
+@callbacks.action("already_in_bot_2")
 async def already_in_bot_2(callback: CallbackQuery, state: FSMContext):
     """Пользователь уже был в боте №2"""
     user_id = callback.from_user.id
     
     if user_id in users_db:
         users_db[user_id]['already_in_bot_2'] = True
-        users_db[user_id]['history'].append(f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Отметил, что уже был в {BOT_LINKS[1]['name']}")
+        add_history(user_id, HISTORY_ALREADY_IN_BOT, 2)
     
     await callback.message.edit_text(
         f"🔄 Вы уже были в боте {BOT_LINKS[1]['name']}.\n\n"
@@ -955,7 +3831,7 @@ async def already_in_bot_2(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_links)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_link1)
+@messages.state(ReferralStates.waiting_for_link1)
 async def process_link1(message: Message, state: FSMContext):
     """Обработка первой ссылки"""
     user_id = message.from_user.id
@@ -969,9 +3845,11 @@ async def process_link1(message: Message, state: FSMContext):
         return
     
     # Сохраняем ссылку
-    users_db[user_id]['link1'] = message.text
-    users_db[user_id]['attempts'] = users_db[user_id].get('attempts', 0) + 1
-    users_db[user_id]['history'].append(f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Отправил ссылку №1")
+    async with user_lock(user_id):
+        users_db[user_id]['link1'] = message.text
+        users_db[user_id]['attempts'] = users_db[user_id].get('attempts', 0) + 1
+        add_history(user_id, HISTORY_LINK_SENT, 1)
+    m_links.inc('1')
     
     await message.answer(
         "✅ Ссылка №1 принята!\n\n"
@@ -983,7 +3861,7 @@ async def process_link1(message: Message, state: FSMContext):
     )
     await state.set_state(ReferralStates.waiting_for_links)
 
-@dp.message(ReferralStates.waiting_for_link2)
+@messages.state(ReferralStates.waiting_for_link2)
 async def process_link2(message: Message, state: FSMContext):
     """Обработка второй ссылки"""
     user_id = message.from_user.id
@@ -995,9 +3873,11 @@ async def process_link2(message: Message, state: FSMContext):
         )
         return
     
-    users_db[user_id]['link2'] = message.text
-    users_db[user_id]['attempts'] = users_db[user_id].get('attempts', 0) + 1
-    users_db[user_id]['history'].append(f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Отправил ссылку №2")
+    async with user_lock(user_id):
+        users_db[user_id]['link2'] = message.text
+        users_db[user_id]['attempts'] = users_db[user_id].get('attempts', 0) + 1
+        add_history(user_id, HISTORY_LINK_SENT, 2)
+    m_links.inc('2')
     
     await message.answer(
         "✅ Обе ссылки приняты!\n\n"
@@ -1006,7 +3886,7 @@ async def process_link2(message: Message, state: FSMContext):
     )
     await state.set_state(ReferralStates.waiting_for_links)
 
-@dp.callback_query(F.data == "completed_1")
+@callbacks.action("completed_1")
 async def completed_link1(callback: CallbackQuery, state: FSMContext):
     """Выполнение первой ссылки"""
     await callback.message.edit_text(
@@ -1016,7 +3896,7 @@ async def completed_link1(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_screenshot1)
     await callback.answer()
 
-@dp.callback_query(F.data == "completed_2")
+@callbacks.action("completed_2")
 async def completed_link2(callback: CallbackQuery, state: FSMContext):
     """Выполнение второй ссылки"""
     user_id = callback.from_user.id
@@ -1039,20 +3919,24 @@ async def completed_link2(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_screenshot2)
     await callback.answer()
 
-@dp.message(F.photo, ReferralStates.waiting_for_screenshot1)
+@messages.state(ReferralStates.waiting_for_screenshot1, photo=True)
 async def process_screenshot1(message: Message, state: FSMContext):
     """Обработка скриншота для первой ссылки"""
     user_id = message.from_user.id
     photo = message.photo[-1]
     
-    users_db[user_id]['link1_screenshot'] = photo.file_id
-    users_db[user_id]['history'].append(f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Отправил скриншот №1")
-    
-    # Проверяем, есть ли вторая ссылка и нужно ли отправлять второй скрин
-    user_data = users_db.get(user_id, {})
-    has_link2 = user_data.get('link2') is not None
-    
-    if has_link2 and not user_data.get('link2_screenshot'):
+    async with user_lock(user_id):
+        users_db[user_id]['link1_screenshot'] = photo.file_id
+        add_history(user_id, HISTORY_SCREENSHOT_SENT, 1)
+        
+        # Проверяем, есть ли вторая ссылка и нужно ли отправлять второй скрин
+        user_data = users_db.get(user_id, {})
+        has_link2 = user_data.get('link2') is not None
+        need_second = has_link2 and not user_data.get('link2_screenshot')
+        if not need_second:
+            await send_screenshots_to_admin(user_id, message)
+    
+    if need_second:
         # Если есть вторая ссылка и скрин для нее еще не отправлен
         await message.answer(
             "✅ Скриншот №1 принят!\n\n"
@@ -1062,7 +3946,6 @@ async def process_screenshot1(message: Message, state: FSMContext):
         await state.set_state(ReferralStates.waiting_for_screenshot2)
     else:
         # Если вторая ссылка не нужна или скрин уже есть
-        await send_screenshots_to_admin(user_id, message)
         await message.answer(
             "✅ Скриншоты отправлены на проверку!\n"
             "Ожидайте подтверждения администратора.",
@@ -1070,16 +3953,16 @@ async def process_screenshot1(message: Message, state: FSMContext):
         )
         await state.clear()
 
-@dp.message(F.photo, ReferralStates.waiting_for_screenshot2)
+@messages.state(ReferralStates.waiting_for_screenshot2, photo=True)
 async def process_screenshot2(message: Message, state: FSMContext):
     """Обработка скриншота для второй ссылки"""
     user_id = message.from_user.id
     photo = message.photo[-1]
     
-    users_db[user_id]['link2_screenshot'] = photo.file_id
-    users_db[user_id]['history'].append(f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Отправил скриншот №2")
-    
-    await send_screenshots_to_admin(user_id, message)
+    async with user_lock(user_id):
+        users_db[user_id]['link2_screenshot'] = photo.file_id
+        add_history(user_id, HISTORY_SCREENSHOT_SENT, 2)
+        await send_screenshots_to_admin(user_id, message)
     
     await message.answer(
         "✅ Оба скриншота отправлены на проверку!\n"
@@ -1089,9 +3972,14 @@ async def process_screenshot2(message: Message, state: FSMContext):
     await state.clear()
 
 async def send_screenshots_to_admin(user_id: int, message: Message):
-    """Отправляет скриншоты админам одним сообщением"""
+    """Ставит скриншоты в очередь проверки"""
+    review_queue.submit(user_id)
+    logger.info(f"📥 Заявка {user_id} в очереди проверки ({review_queue.depth()} всего)")
+
+async def send_submission(moderator_id: int, user_id: int):
+    """Отправляет модератору взятую заявку одним сообщением"""
     user_data = users_db.get(user_id, {})
-    username = message.from_user.username or "нет username"
+    username = user_data.get('username') or "нет username"
     
     # Формируем текст
     status_text = "📊 ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ:\n\n"
@@ -1119,44 +4007,54 @@ async def send_screenshots_to_admin(user_id: int, message: Message):
             caption=f"Скриншот №2 ({BOT_LINKS[1]['name']})"
         ))
     
-    # Отправляем всем админам и модераторам
-    for admin_id in admins.union(moderators):
-        try:
-            if len(media) == 1:
-                await bot.send_photo(
-                    admin_id,
-                    photo=media[0].media,
-                    caption=f"{status_text}\n\n{media[0].caption}",
-                    reply_markup=get_admin_link_keyboard(
-                        user_id, 
-                        1 if "№1" in media[0].caption else 2,
-                        has_second=bool(user_data.get('link2') and not user_data.get('link2_screenshot'))
-                    )
-                )
-            elif len(media) == 2:
-                # Отправляем медиагруппу
-                await bot.send_media_group(admin_id, media)
-                # Отдельно отправляем текст с кнопками для первой ссылки
-                await bot.send_message(
-                    admin_id,
-                    status_text,
-                    reply_markup=get_admin_link_keyboard(
-                        user_id, 
-                        1,
-                        has_second=True
-                    )
-                )
-        except Exception as e:
-            logger.error(f"Ошибка отправки админу {admin_id}: {e}")
+    send_priority.set(PRIORITY_MODERATION)
+    if len(media) == 1:
+        await bot.send_photo(
+            moderator_id,
+            photo=media[0].media,
+            caption=f"{status_text}\n\n{media[0].caption}",
+            reply_markup=get_admin_link_keyboard(
+                user_id, 
+                1 if "№1" in media[0].caption else 2,
+                has_second=bool(user_data.get('link2') and not user_data.get('link2_screenshot'))
+            )
+        )
+    elif len(media) == 2:
+        # Отправляем медиагруппу
+        await bot.send_media_group(moderator_id, media)
+        # Отдельно отправляем текст с кнопками для первой ссылки
+        await bot.send_message(
+            moderator_id,
+            status_text,
+            reply_markup=get_admin_link_keyboard(
+                user_id, 
+                1,
+                has_second=True
+            )
+        )
 
 # ==================== ОБРАБОТЧИКИ ПОДТВЕРЖДЕНИЯ ССЫЛОК ====================
 
-@dp.callback_query(F.data.startswith("accept_link_"))
-async def accept_link(callback: CallbackQuery):
+@callbacks.action("review_claim")
+async def review_claim(callback: CallbackQuery):
+    """Модератор берет следующую заявку из очереди"""
+    moderator_id = callback.from_user.id
+    
+    if not is_moderator(moderator_id):
+        await callback.answer("⛔ Нет прав")
+        return
+    
+    user_id = review_queue.claim(moderator_id)
+    if user_id is None:
+        await callback.answer("📭 Очередь проверки пуста")
+        return
+    
+    await callback.answer(f"📥 Заявка {user_id}, осталось свободных: {review_queue.free()}")
+    await send_submission(moderator_id, user_id)
+
+@callbacks.action("accept")
+async def accept_link(callback: CallbackQuery, user_id: int, link_num: int, stamp: int):
     """Принятие ссылки админом"""
-    parts = callback.data.split("_")
-    user_id = int(parts[2])
-    link_num = int(parts[3])
     
     if not is_moderator(callback.from_user.id):
         await callback.answer("⛔ Нет прав")
@@ -1166,12 +4064,33 @@ async def accept_link(callback: CallbackQuery):
         await callback.answer("❌ Пользователь не найден")
         return
     
-    # Отмечаем ссылку как выполненную
-    users_db[user_id][f'link{link_num}_done'] = True
-    users_db[user_id]['active_refs'] = users_db[user_id].get('active_refs', 0) + 1
-    users_db[user_id]['history'].append(
-        f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Ссылка №{link_num} принята админом"
-    )
+    async with user_lock(user_id):
+        # Повторное нажатие или второй модератор - реферал уже засчитан
+        owned = review_queue.hold(user_id, stamp, callback.from_user.id)
+        decided = owned and review_queue.decide(user_id, stamp, link_num)
+        if decided:
+            # Отмечаем ссылку как выполненную
+            with stats.track(users_db[user_id]) as record:
+                record[f'link{link_num}_done'] = True
+                record['active_refs'] = record.get('active_refs', 0) + 1
+            add_history(user_id, HISTORY_LINK_ACCEPTED, link_num)
+            m_decisions.inc('accept', '')
+            
+            # Проверяем, есть ли вторая ссылка
+            user_data = users_db[user_id]
+            has_link2 = user_data.get('link2') is not None
+            finished = not (has_link2 and not user_data.get('link2_done'))
+            if finished:
+                review_queue.complete(user_id)
+    
+    if not owned:
+        await callback.answer("⚠️ Заявку проверяет другой модератор")
+        return
+    
+    if not decided:
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await callback.answer("⚠️ Заявка уже обработана")
+        return
     
     # Отправляем уведомление пользователю
     try:
@@ -1183,11 +4102,7 @@ async def accept_link(callback: CallbackQuery):
     except Exception as e:
         logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
     
-    # Проверяем, есть ли вторая ссылка
-    user_data = users_db[user_id]
-    has_link2 = user_data.get('link2') is not None
-    
-    if has_link2 and not user_data.get('link2_done'):
+    if not finished:
         # Если есть вторая ссылка и она еще не принята
         await callback.message.answer(
             f"✅ Ссылка №{link_num} принята!\n\n"
@@ -1209,34 +4124,50 @@ async def accept_link(callback: CallbackQuery):
         
         await callback.message.answer(
             f"✅ Все ссылки пользователя @{users_db[user_id].get('username', 'нет')} обработаны!\n\n"
-            f"{status_text}"
+            f"{status_text}\n\n{review_queue.counter_text()}",
+            reply_markup=get_review_keyboard()
         )
     
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.answer("✅ Ссылка принята")
 
-@dp.callback_query(F.data.startswith("reject_reason_"))
-async def reject_with_reason(callback: CallbackQuery):
-    """Отклонение ссылки с причиной"""
-    parts = callback.data.split("_")
-    user_id = int(parts[2])
-    link_num = int(parts[3])
-    reason_code = parts[4]
-    
-    reason_texts = {
-        "more_6": "Больше 6 спонсоров",
-        "already_in_bot": "Вы уже были в этом боте",
-        "bad_screenshot": "Некорректный скриншот",
-        "other": "Другая причина"
-    }
+@callbacks.action("reject")
+async def reject_with_reason(callback: CallbackQuery, user_id: int, link_num: int, stamp: int, reason: int):
+    """Отклонение ссылки с причиной (reason - индекс в REJECT_REASON_CODES)"""
     
-    reason_text = reason_texts.get(reason_code, "Не указана")
+    if not is_moderator(callback.from_user.id):
+        await callback.answer("⛔ Нет прав")
+        return
     
-    if user_id in users_db:
-        users_db[user_id][f'link{link_num}_rejected'] = True
-        users_db[user_id]['history'].append(
-            f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Ссылка №{link_num} отклонена: {reason_text}"
-        )
+    known = 0 <= reason < len(REJECT_REASON_CODES)
+    reason_text = REJECT_REASONS[REJECT_REASON_CODES[reason]] if known else "Не указана"
+    reason_index = reason + 1 if known else 0
+    
+    async with user_lock(user_id):
+        owned = review_queue.hold(user_id, stamp, callback.from_user.id)
+        decided = owned and review_queue.decide(user_id, stamp, link_num)
+        if decided:
+            if user_id in users_db:
+                with stats.track(users_db[user_id]) as record:
+                    record[f'link{link_num}_rejected'] = True
+                add_history(user_id, HISTORY_LINK_REJECTED, link_num | reason_index << 8)
+            m_decisions.inc('reject', REJECT_REASON_CODES[reason] if known else 'unknown')
+            
+            # Проверяем, есть ли вторая ссылка
+            user_data = users_db.get(user_id, {})
+            has_link2 = user_data.get('link2') is not None
+            finished = not (has_link2 and not user_data.get('link2_rejected') and not user_data.get('link2_done'))
+            if finished:
+                review_queue.complete(user_id)
+    
+    if not owned:
+        await callback.answer("⚠️ Заявку проверяет другой модератор")
+        return
+    
+    if not decided:
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await callback.answer("⚠️ Заявка уже обработана")
+        return
     
     # Отправляем уведомление пользователю
     try:
@@ -1249,30 +4180,44 @@ async def reject_with_reason(callback: CallbackQuery):
     except Exception as e:
         logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
     
-    # Проверяем, есть ли вторая ссылка
-    user_data = users_db.get(user_id, {})
-    has_link2 = user_data.get('link2') is not None
-    
-    if has_link2 and not user_data.get('link2_rejected') and not user_data.get('link2_done'):
+    if not finished:
         # Если есть вторая ссылка и она еще не обработана
         await callback.message.answer(
             f"❌ Ссылка №{link_num} отклонена\n\n"
             f"Теперь проверьте ссылку №2:",
             reply_markup=get_admin_link_keyboard(user_id, 2, has_second=False)
         )
+    else:
+        await callback.message.answer(review_queue.counter_text(), reply_markup=get_review_keyboard())
     
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.answer(f"❌ Отклонено: {reason_text}")
 
-@dp.callback_query(F.data.startswith("skip_second_"))
-async def skip_second_link(callback: CallbackQuery):
+@callbacks.action("skip_second")
+async def skip_second_link(callback: CallbackQuery, user_id: int, stamp: int):
     """Пропуск второй ссылки (только одна ссылка)"""
-    user_id = int(callback.data.split("_")[2])
     
-    if user_id in users_db:
-        users_db[user_id]['history'].append(
-            f"{datetime.now().strftime('%d.%m.%Y %H:%M')} - Админ пропустил вторую ссылку"
-        )
+    if not is_moderator(callback.from_user.id):
+        await callback.answer("⛔ Нет прав")
+        return
+    
+    async with user_lock(user_id):
+        owned = review_queue.hold(user_id, stamp, callback.from_user.id)
+        decided = owned and review_queue.decide(user_id, stamp, 2)
+        if decided:
+            if user_id in users_db:
+                add_history(user_id, HISTORY_SECOND_SKIPPED)
+            m_decisions.inc('skip', '')
+            review_queue.complete(user_id)
+    
+    if not owned:
+        await callback.answer("⚠️ Заявку проверяет другой модератор")
+        return
+    
+    if not decided:
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await callback.answer("⚠️ Заявка уже обработана")
+        return
     
     # Отправляем итоговое уведомление
     user_data = users_db.get(user_id, {})
@@ -1287,16 +4232,16 @@ async def skip_second_link(callback: CallbackQuery):
         pass
     
     await callback.message.answer(
-        f"✅ Обработка завершена!\n\n{status_text}"
+        f"✅ Обработка завершена!\n\n{status_text}\n\n{review_queue.counter_text()}",
+        reply_markup=get_review_keyboard()
     )
     
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.answer("✅ Готово")
 
-@dp.callback_query(F.data.startswith("admin_ban_"))
-async def admin_ban_user(callback: CallbackQuery):
+@callbacks.action("ban")
+async def admin_ban_user(callback: CallbackQuery, user_id: int):
     """Бан пользователя из админки"""
-    user_id = int(callback.data.split("_")[2])
     
     if not is_moderator(callback.from_user.id):
         await callback.answer("⛔ Нет прав")
@@ -1313,6 +4258,8 @@ async def admin_ban_user(callback: CallbackQuery):
         return
     
     blacklist.add(user_id)
+    m_bans.inc('review')
+    review_queue.complete(user_id)
     
     # Уведомление пользователя
     try:
@@ -1329,7 +4276,7 @@ async def admin_ban_user(callback: CallbackQuery):
 
 # ==================== АДМИН-ПАНЕЛЬ ====================
 
-@dp.callback_query(F.data == "admin_panel")
+@callbacks.action("admin_panel")
 async def admin_panel(callback: CallbackQuery):
     """Открытие админ-панели"""
     user_id = callback.from_user.id
@@ -1345,7 +4292,7 @@ async def admin_panel(callback: CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_ban_menu")
+@callbacks.action("admin_ban_menu")
 async def admin_ban_menu(callback: CallbackQuery, state: FSMContext):
     """Меню бана/разбана"""
     await callback.message.edit_text(
@@ -1355,7 +4302,7 @@ async def admin_ban_menu(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_ban_permanent")
+@callbacks.action("admin_ban_permanent")
 async def admin_ban_permanent(callback: CallbackQuery, state: FSMContext):
     """Постоянный бан"""
     await callback.message.edit_text(
@@ -1364,7 +4311,7 @@ async def admin_ban_permanent(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_ban_id)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_ban_id)
+@messages.state(ReferralStates.waiting_for_ban_id)
 async def process_ban_id(message: Message, state: FSMContext):
     """Обработка ID для бана"""
     try:
@@ -1387,6 +4334,8 @@ async def process_ban_id(message: Message, state: FSMContext):
         return
     
     blacklist.add(user_id)
+    m_bans.inc('permanent')
+    review_queue.complete(user_id)
     
     # Уведомление пользователя
     try:
@@ -1400,19 +4349,14 @@ async def process_ban_id(message: Message, state: FSMContext):
     await message.answer(f"✅ Пользователь {user_id} навсегда забанен")
     
     # Уведомление другим админам
-    for admin_id in admins:
-        if admin_id != message.from_user.id:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"👤 Админ @{message.from_user.username} забанил пользователя {user_id}"
-                )
-            except:
-                pass
+    notifier.notify(
+        f"👤 Админ @{message.from_user.username} забанил пользователя {user_id}",
+        exclude=message.from_user.id
+    )
     
     await state.clear()
 
-@dp.callback_query(F.data == "admin_unban")
+@callbacks.action("admin_unban")
 async def admin_unban(callback: CallbackQuery, state: FSMContext):
     """Разбан"""
     await callback.message.edit_text(
@@ -1421,7 +4365,7 @@ async def admin_unban(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_unban_id)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_unban_id)
+@messages.state(ReferralStates.waiting_for_unban_id)
 async def process_unban(message: Message, state: FSMContext):
     """Обработка разбана"""
     try:
@@ -1454,21 +4398,16 @@ async def process_unban(message: Message, state: FSMContext):
             pass
         
         # Уведомление другим админам
-        for admin_id in admins:
-            if admin_id != message.from_user.id:
-                try:
-                    await bot.send_message(
-                        admin_id,
-                        f"👤 Админ @{message.from_user.username} разбанил пользователя {user_id}"
-                    )
-                except:
-                    pass
+        notifier.notify(
+            f"👤 Админ @{message.from_user.username} разбанил пользователя {user_id}",
+            exclude=message.from_user.id
+        )
     else:
         await message.answer(f"⚠️ Пользователь {user_id} не найден в банах")
     
     await state.clear()
 
-@dp.callback_query(F.data == "admin_temp_ban")
+@callbacks.action("admin_temp_ban")
 async def admin_temp_ban(callback: CallbackQuery, state: FSMContext):
     """Временный бан"""
     await callback.message.edit_text(
@@ -1483,7 +4422,7 @@ async def admin_temp_ban(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_temp_ban_time)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_temp_ban_time)
+@messages.state(ReferralStates.waiting_for_temp_ban_time)
 async def process_temp_ban(message: Message, state: FSMContext):
     """Обработка временного бана"""
     parts = message.text.split()
@@ -1517,6 +4456,7 @@ async def process_temp_ban(message: Message, state: FSMContext):
     
     ban_until = datetime.now() + timedelta(seconds=seconds)
     temp_bans[user_id] = ban_until
+    m_bans.inc('temp')
     
     # Уведомление пользователя
     try:
@@ -1531,20 +4471,15 @@ async def process_temp_ban(message: Message, state: FSMContext):
     await message.answer(f"✅ Пользователь {user_id} забанен на {time_str_formatted}")
     
     # Уведомление другим админам
-    for admin_id in admins:
-        if admin_id != message.from_user.id:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"👤 Админ @{message.from_user.username} "
-                    f"забанил пользователя {user_id} на {time_str_formatted}"
-                )
-            except:
-                pass
+    notifier.notify(
+        f"👤 Админ @{message.from_user.username} "
+        f"забанил пользователя {user_id} на {time_str_formatted}",
+        exclude=message.from_user.id
+    )
     
     await state.clear()
 
-@dp.callback_query(F.data == "admin_blacklist_menu")
+@callbacks.action("admin_blacklist_menu")
 async def admin_blacklist_menu(callback: CallbackQuery):
     """Меню ЧС"""
     await callback.message.edit_text(
@@ -1554,7 +4489,7 @@ async def admin_blacklist_menu(callback: CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_blacklist_add")
+@callbacks.action("admin_blacklist_add")
 async def admin_blacklist_add(callback: CallbackQuery, state: FSMContext):
     """Добавление в ЧС"""
     await callback.message.edit_text(
@@ -1563,7 +4498,7 @@ async def admin_blacklist_add(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_blacklist_id)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_blacklist_id)
+@messages.state(ReferralStates.waiting_for_blacklist_id)
 async def process_blacklist_add(message: Message, state: FSMContext):
     """Обработка добавления в ЧС"""
     try:
@@ -1586,6 +4521,7 @@ async def process_blacklist_add(message: Message, state: FSMContext):
         return
     
     blacklist.add(user_id)
+    m_bans.inc('blacklist')
     
     # Уведомление пользователя
     try:
@@ -1599,19 +4535,14 @@ async def process_blacklist_add(message: Message, state: FSMContext):
     await message.answer(f"✅ Пользователь {user_id} добавлен в ЧС")
     
     # Уведомление другим админам
-    for admin_id in admins:
-        if admin_id != message.from_user.id:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"👤 Админ @{message.from_user.username} добавил пользователя {user_id} в ЧС"
-                )
-            except:
-                pass
+    notifier.notify(
+        f"👤 Админ @{message.from_user.username} добавил пользователя {user_id} в ЧС",
+        exclude=message.from_user.id
+    )
     
     await state.clear()
 
-@dp.callback_query(F.data == "admin_blacklist_remove")
+@callbacks.action("admin_blacklist_remove")
 async def admin_blacklist_remove(callback: CallbackQuery, state: FSMContext):
     """Удаление из ЧС"""
     await callback.message.edit_text(
@@ -1620,7 +4551,7 @@ async def admin_blacklist_remove(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_unblacklist_id)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_unblacklist_id)
+@messages.state(ReferralStates.waiting_for_unblacklist_id)
 async def process_blacklist_remove(message: Message, state: FSMContext):
     """Обработка удаления из ЧС"""
     try:
@@ -1647,7 +4578,7 @@ async def process_blacklist_remove(message: Message, state: FSMContext):
     
     await state.clear()
 
-@dp.callback_query(F.data == "admin_whitelist_menu")
+@callbacks.action("admin_whitelist_menu")
 async def admin_whitelist_menu(callback: CallbackQuery):
     """Меню белого списка"""
     await callback.message.edit_text(
@@ -1657,7 +4588,7 @@ async def admin_whitelist_menu(callback: CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_whitelist_add")
+@callbacks.action("admin_whitelist_add")
 async def admin_whitelist_add(callback: CallbackQuery, state: FSMContext):
     """Добавление в белый список"""
     await callback.message.edit_text(
@@ -1666,7 +4597,7 @@ async def admin_whitelist_add(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_whitelist_id)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_whitelist_id)
+@messages.state(ReferralStates.waiting_for_whitelist_id)
 async def process_whitelist_add(message: Message, state: FSMContext):
     """Обработка добавления в белый список"""
     try:
@@ -1690,16 +4621,16 @@ async def process_whitelist_add(message: Message, state: FSMContext):
     
     await state.clear()
 
-@dp.callback_query(F.data == "admin_whitelist_remove")
+@callbacks.action("admin_whitelist_remove")
 async def admin_whitelist_remove(callback: CallbackQuery, state: FSMContext):
     """Удаление из белого списка"""
     await callback.message.edit_text(
         "➖ Введите ID пользователя для удаления из белого списка:"
     )
-    await state.set_state(ReferralStates.waiting_for_whitelist_id)
+    await state.set_state(ReferralStates.waiting_for_whitelist_remove_id)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_whitelist_id)
+@messages.state(ReferralStates.waiting_for_whitelist_remove_id)
 async def process_whitelist_remove(message: Message, state: FSMContext):
     """Обработка удаления из белого списка"""
     try:
@@ -1717,7 +4648,7 @@ async def process_whitelist_remove(message: Message, state: FSMContext):
     
     await state.clear()
 
-@dp.callback_query(F.data == "admin_whitelist_show")
+@callbacks.action("admin_whitelist_show")
 async def admin_whitelist_show(callback: CallbackQuery):
     """Показать белый список"""
     text = "📋 БЕЛЫЙ СПИСОК:\n\n"
@@ -1732,7 +4663,7 @@ async def admin_whitelist_show(callback: CallbackQuery):
     await callback.message.edit_text(text, reply_markup=get_back_keyboard())
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_stats")
+@callbacks.action("admin_stats")
 async def admin_stats(callback: CallbackQuery):
     """Статистика"""
     user_id = callback.from_user.id
@@ -1741,35 +4672,156 @@ async def admin_stats(callback: CallbackQuery):
         await callback.answer("⛔ Нет прав")
         return
     
-    total_users = len(users_db)
-    active_refs = sum(data.get('active_refs', 0) for data in users_db.values())
-    blacklisted = len(blacklist)
-    temp_banned = len(temp_bans)
-    whitelisted = len(whitelist)
-    
-    # Подсчет выполненных ссылок
-    links_done = sum(
-        1 for data in users_db.values() 
-        if data.get('link1_done', False) or data.get('link2_done', False)
-    )
-    
+    # Все значения - готовые счетчики, users_db не перебирается
     stats_text = (
         f"📊 СТАТИСТИКА БОТА\n\n"
-        f"👥 Всего пользователей: {total_users}\n"
-        f"✅ Выполненных рефералов: {active_refs}\n"
-        f"🔗 Пользователей с выполненными ссылками: {links_done}\n"
-        f"⛔ В ЧС: {blacklisted}\n"
-        f"⏰ Временный бан: {temp_banned}\n"
-        f"💘 В белом списке: {whitelisted}\n"
+        f"👥 Всего пользователей: {stats.users}\n"
+        f"✅ Выполненных рефералов: {stats.active_refs}\n"
+        f"🔗 Пользователей с выполненными ссылками: {stats.links_done}\n"
+        f"❌ Пользователей с отклоненными ссылками: {stats.links_rejected}\n"
+        f"⛔ В ЧС: {len(blacklist)}\n"
+        f"⏰ Временный бан: {len(temp_bans)}\n"
+        f"💘 В белом списке: {len(whitelist)}\n"
         f"👑 Администраторов: {len(admins)}\n"
         f"🛡 Модераторов: {len(moderators)}\n\n"
-        f"🔧 Техработы: {'ВКЛ' if maintenance_mode else 'ВЫКЛ'}"
+        f"🚫 Отброшено апдейтов: {gate_stats['banned']} от забаненных\n"
+        f"📥 Очередь проверки: {review_queue.depth()}, самая старая ждет "
+        f"{format_time_delta(int(review_queue.oldest_age()))}\n"
+        f"📤 Очередь отправки: {' / '.join(map(str, outbound.depth()))}\n"
+        f"🔧 Техработы: {'ВКЛ' if maintenance_mode else 'ВЫКЛ'}\n\n"
+        f"{format_activity()}"
     )
     
     await callback.message.edit_text(stats_text, reply_markup=get_back_keyboard())
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_maintenance_on")
+@callbacks.action("admin_broadcast")
+async def admin_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Запуск рассылки через админ-панель"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ Нет прав")
+        return
+    
+    if broadcaster.active:
+        await callback.message.edit_text(broadcaster.progress_text(), reply_markup=get_broadcast_keyboard())
+    else:
+        await callback.message.edit_text(
+            f"📢 Рассылка всем пользователям ({len(users_db)})\n\n"
+            f"Отправьте текст сообщения:",
+            reply_markup=get_back_keyboard()
+        )
+        await state.set_state(ReferralStates.waiting_for_broadcast_text)
+    await callback.answer()
+
+@messages.state(ReferralStates.waiting_for_broadcast_text)
+async def process_broadcast_text(message: Message, state: FSMContext):
+    """Обработка текста рассылки"""
+    await state.clear()
+    
+    if not is_admin(message.from_user.id) or not message.text:
+        return
+    
+    if broadcaster.active:
+        await message.answer("⚠️ Рассылка уже идет", reply_markup=get_broadcast_keyboard())
+        return
+    
+    if len(message.text) > BROADCAST_MAX_LENGTH:
+        await message.answer(f"❌ Текст длиннее {BROADCAST_MAX_LENGTH} символов ({len(message.text)})")
+        return
+    
+    report = await message.answer("📢 Рассылка запускается...", reply_markup=get_broadcast_keyboard())
+    broadcaster.start(message.text, report_chat_id=report.chat.id, report_message_id=report.message_id)
+
+@callbacks.action("admin_broadcast_status")
+async def admin_broadcast_status(callback: CallbackQuery):
+    """Обновление отчета о рассылке"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ Нет прав")
+        return
+    
+    try:
+        await callback.message.edit_text(broadcaster.progress_text(), reply_markup=get_broadcast_keyboard())
+    except TelegramBadRequest:
+        pass  # Прогресс не изменился
+    await callback.answer()
+
+@callbacks.action("admin_broadcast_cancel")
+async def admin_broadcast_cancel(callback: CallbackQuery):
+    """Остановка рассылки"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ Нет прав")
+        return
+    
+    if broadcaster.cancel():
+        await callback.answer("⛔ Рассылка остановлена")
+    else:
+        await callback.answer("⚠️ Нет активной рассылки")
+
+@callbacks.action("admin_import")
+async def admin_import(callback: CallbackQuery):
+    """Массовый импорт ID: выбор списка"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ Нет прав")
+        return
+    
+    await callback.message.edit_text(
+        "📂 ИМПОРТ ID ИЗ ФАЙЛА\n\n"
+        "В какой список добавить пользователей?",
+        reply_markup=get_import_keyboard()
+    )
+    await callback.answer()
+
+@callbacks.action("admin_import_to")
+async def admin_import_to(callback: CallbackQuery, state: FSMContext, target: int):
+    """Массовый импорт ID: ожидание файла"""
+    names = list(IMPORT_TARGETS)
+    if not is_admin(callback.from_user.id) or not 0 <= target < len(names):
+        await callback.answer("⛔ Нет прав")
+        return
+    
+    await state.update_data(import_target=names[target])
+    await callback.message.edit_text(
+        f"📂 Импорт: {IMPORT_TARGETS[names[target]]}\n\n"
+        f"Отправьте .txt или .csv файл с ID (до 20 МБ) или список ID сообщением.\n"
+        f"ID разделяются пробелами, запятыми, точками с запятой или переводом строки.",
+        reply_markup=get_back_keyboard()
+    )
+    await state.set_state(ReferralStates.waiting_for_import_file)
+    await callback.answer()
+
+@messages.state(ReferralStates.waiting_for_import_file)
+async def process_import_file(message: Message, state: FSMContext):
+    """Массовый импорт ID: разбор файла и одна запись в базу"""
+    name = (await state.get_data()).get('import_target')
+    await state.clear()
+    
+    if not is_admin(message.from_user.id) or name not in IMPORT_TARGETS:
+        return
+    
+    started = time.perf_counter()
+    if message.document:
+        if (message.document.file_size or 0) > IMPORT_MAX_FILE_SIZE:
+            await message.answer("❌ Файл больше 20 МБ - разбейте его на части или используйте /import в консоли")
+            return
+        buffer = io.BytesIO()
+        await bot.download(message.document, destination=buffer)
+        parsed = await asyncio.to_thread(parse_ids, io.TextIOWrapper(buffer, encoding='utf-8', errors='replace'))
+    elif message.text:
+        parsed = parse_ids(message.text.splitlines())
+    else:
+        await message.answer("❌ Нужен файл с ID или список ID сообщением")
+        return
+    
+    summary = await import_ids(name, parsed, started)
+    await message.answer(summary, reply_markup=get_admin_panel_keyboard())
+    
+    # Одно уведомление на весь импорт
+    notifier.notify(
+        f"{summary}\n\n👤 Импортировал: @{message.from_user.username}",
+        exclude=message.from_user.id
+    )
+
+@callbacks.action("admin_maintenance_on")
 async def admin_maintenance_on(callback: CallbackQuery, state: FSMContext):
     """Включение техработ через админ-панель"""
     await callback.message.edit_text(
@@ -1782,7 +4834,7 @@ async def admin_maintenance_on(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_maintenance_time)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_maintenance_time)
+@messages.state(ReferralStates.waiting_for_maintenance_time)
 async def process_maintenance_time(message: Message, state: FSMContext):
     """Обработка времени техработ"""
     # Здесь нужно global, потому что мы ИЗМЕНЯЕМ переменные
@@ -1807,7 +4859,7 @@ async def process_maintenance_time(message: Message, state: FSMContext):
                 await message.answer("❌ Неверный формат времени")
                 return
         
-        await state.update_data(end_time=end_time)
+        await state.update_data(end_time=end_time.timestamp())
         await message.answer(
             "📝 Введите причину техработ (или отправьте 'нет'):"
         )
@@ -1816,14 +4868,14 @@ async def process_maintenance_time(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Неверный формат даты")
 
-@dp.message(ReferralStates.waiting_for_maintenance_reason)
+@messages.state(ReferralStates.waiting_for_maintenance_reason)
 async def process_maintenance_reason(message: Message, state: FSMContext):
     """Обработка причины техработ"""
     # Здесь нужно global, потому что мы ИЗМЕНЯЕМ переменные
     global maintenance_mode, maintenance_end_time, maintenance_reason
     
     data = await state.get_data()
-    end_time = data.get('end_time')
+    end_time = datetime.fromtimestamp(data['end_time'])
     reason = message.text if message.text.lower() != 'нет' else ""
     
     maintenance_mode = True
@@ -1838,6 +4890,7 @@ async def process_maintenance_reason(message: Message, state: FSMContext):
         'reason': reason,
         'status': 'active'
     })
+    save_maintenance_record()
     
     await message.answer(
         f"✅ Технические работы включены до {end_time.strftime('%d.%m.%Y %H:%M')}\n"
@@ -1845,7 +4898,7 @@ async def process_maintenance_reason(message: Message, state: FSMContext):
     )
     await state.clear()
 
-@dp.callback_query(F.data == "admin_maintenance_off")
+@callbacks.action("admin_maintenance_off")
 async def admin_maintenance_off(callback: CallbackQuery):
     """Выключение техработ"""
     # Здесь нужно global, потому что мы ИЗМЕНЯЕМ переменные
@@ -1854,6 +4907,7 @@ async def admin_maintenance_off(callback: CallbackQuery):
     if maintenance_history:
         maintenance_history[-1]['status'] = 'completed'
         maintenance_history[-1]['actual_end_time'] = datetime.now()
+        save_maintenance_record()
     
     maintenance_mode = False
     maintenance_end_time = None
@@ -1862,7 +4916,7 @@ async def admin_maintenance_off(callback: CallbackQuery):
     await callback.message.edit_text("✅ Технические работы выключены")
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_maintenance_history")
+@callbacks.action("admin_maintenance_history")
 async def admin_maintenance_history(callback: CallbackQuery):
     """История техработ"""
     if not maintenance_history:
@@ -1890,7 +4944,7 @@ async def admin_maintenance_history(callback: CallbackQuery):
     await callback.message.edit_text(text, reply_markup=get_back_keyboard())
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_give_moder")
+@callbacks.action("admin_give_moder")
 async def admin_give_moder(callback: CallbackQuery, state: FSMContext):
     """Выдача прав модератора"""
     await callback.message.edit_text(
@@ -1899,7 +4953,7 @@ async def admin_give_moder(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_moder_id)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_moder_id)
+@messages.state(ReferralStates.waiting_for_moder_id)
 async def process_give_moder(message: Message, state: FSMContext):
     """Обработка выдачи прав модератора"""
     try:
@@ -1923,19 +4977,14 @@ async def process_give_moder(message: Message, state: FSMContext):
     await message.answer(f"✅ Пользователю {user_id} выданы права модератора")
     
     # Уведомление другим админам
-    for admin_id in admins:
-        if admin_id != message.from_user.id:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"👤 Админ @{message.from_user.username} выдал права модератора пользователю {user_id}"
-                )
-            except:
-                pass
+    notifier.notify(
+        f"👤 Админ @{message.from_user.username} выдал права модератора пользователю {user_id}",
+        exclude=message.from_user.id
+    )
     
     await state.clear()
 
-@dp.callback_query(F.data == "admin_give_admin")
+@callbacks.action("admin_give_admin")
 async def admin_give_admin(callback: CallbackQuery, state: FSMContext):
     """Выдача прав администратора"""
     await callback.message.edit_text(
@@ -1944,7 +4993,7 @@ async def admin_give_admin(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ReferralStates.waiting_for_admin_id)
     await callback.answer()
 
-@dp.message(ReferralStates.waiting_for_admin_id)
+@messages.state(ReferralStates.waiting_for_admin_id)
 async def process_give_admin(message: Message, state: FSMContext):
     """Обработка выдачи прав администратора"""
     try:
@@ -1969,21 +5018,15 @@ async def process_give_admin(message: Message, state: FSMContext):
     await message.answer(f"✅ Пользователю {user_id} выданы права администратора")
     
     # Уведомление другим админам
-    for admin_id in admins:
-        if admin_id != message.from_user.id:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"👤 Админ @{message.from_user.username} выдал права администратора пользователю {user_id}"
-                )
-            except:
-                pass
+    notifier.notify(
+        f"👤 Админ @{message.from_user.username} выдал права администратора пользователю {user_id}",
+        exclude=message.from_user.id
+    )
     
     await state.clear()
 
 # ==================== ОБРАБОТКА НЕВАЛИДНЫХ СООБЩЕНИЙ ====================
 
-@dp.message()
 async def handle_invalid_message(message: Message, state: FSMContext):
     """Обработка всех остальных сообщений"""
     user_id = message.from_user.id
@@ -2008,8 +5051,66 @@ async def handle_invalid_message(message: Message, state: FSMContext):
             reply_markup=get_main_keyboard(user_id)
         )
 
+# Регистрируется последним: команды (/start, /admin) проверяются раньше
+@dp.message()
+async def route_message(message: Message, state: FSMContext):
+    """Единственный обработчик сообщений вне команд"""
+    await messages.dispatch(message, state, handle_invalid_message)
+
 # ==================== ЗАПУСК БОТА ====================
 
+# ==================== ВЕБХУК ====================
+
+BOT_MODE = os.getenv('BOT_MODE', 'polling')          # polling или webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')           # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')     # общий для всех экземпляров за балансировщиком
+
+def build_webhook_app(dispatcher: Dispatcher, telegram_bot: Bot, secret: str) -> web.Application:
+    """aiohttp-приложение вебхука.
+
+    Запросы без верного X-Telegram-Bot-Api-Secret-Token отклоняются (401),
+    остальным Telegram сразу получает 200, а апдейт обрабатывается в фоне
+    теми же обработчиками, что и при polling.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dispatcher, bot=telegram_bot, secret_token=secret, handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dispatcher, bot=telegram_bot)
+    return app
+
+async def run_webhook():
+    """Прием апдейтов через вебхук до SIGINT/SIGTERM"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_URL")
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("⚠️ WEBHOOK_SECRET не задан, сгенерирован случайный - для нескольких экземпляров задайте общий")
+    
+    runner = web.AppRunner(build_webhook_app(dp, bot, secret), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info(f"🌐 Вебхук: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH} (слушаем {WEBHOOK_HOST}:{WEBHOOK_PORT})")
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     """Запуск бота"""
     logger.info("🚀 Запуск бота...")
@@ -2017,14 +5118,45 @@ async def main():
     logger.info(f"🛡 Защищенный ID: {PROTECTED_ID}")
     logger.info(f"🔧 Техработы: {'ВКЛ' if maintenance_mode else 'ВЫКЛ'}")
     
-    # Запуск обработчика консольных команд
-    asyncio.create_task(console_command_handler())
+    # Загрузка данных из базы
+    db.connect()
+    db.load()
+    # Фоновые задачи: ссылки держим, чтобы задачи не собрал сборщик мусора,
+    # и останавливаем их при выходе до закрытия базы
+    tasks = [asyncio.create_task(clock.run()), asyncio.create_task(db.run())]
+    ban_scheduler.load()
+    broadcaster.resume()
+    warm_keyboards()
+    for job in (ban_scheduler.run(), outbound.run(), notifier.run(), review_queue.run(),
+                storage.run_sweeper(), loop_watchdog.run()):
+        tasks.append(asyncio.create_task(job))
+    metrics_runner = await start_metrics_server()
+    
+    # Консоль управления (python botctl.py)
+    control_server = await console.start(CONTROL_SOCKET)
     
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            # Пока у бота установлен вебхук, getUpdates не работает
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"❌ Ошибка при запуске бота: {e}")
     finally:
+        if control_server:
+            control_server.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(CONTROL_SOCKET)
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if broadcaster.task:
+            tasks.append(broadcaster.task)  # прогресс сохранен, продолжится после перезапуска
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await db.close()
         await bot.session.close()
 
 if __name__ == "__main__":
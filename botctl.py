@@ -0,0 +1,71 @@
+"""Клиент консоли управления ботом.
+
+Запуск:
+    python botctl.py                       - интерактивный режим
+    python botctl.py /maintenance_status   - одна команда и выход
+    python botctl.py --socket /run/bot.sock /queue
+
+Подключается к Unix-сокету CONTROL_SOCKET работающего бота; одновременно
+может быть подключено несколько операторов.
+"""
+import argparse
+import os
+import socket
+import sys
+
+CONSOLE_END = '\x04'  # строка-признак конца ответа (то же в bot.py)
+
+def read_reply(stream) -> bool:
+    """Печатает ответ до строки-признака; False - бот закрыл соединение"""
+    for line in stream:
+        line = line.rstrip('\n')
+        if line == CONSOLE_END:
+            return True
+        print(line)
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description="Консоль управления ботом")
+    parser.add_argument('--socket', default=os.getenv('CONTROL_SOCKET', 'bot.sock'), help="путь к сокету бота")
+    parser.add_argument('command', nargs=argparse.REMAINDER, help="команда, например /queue")
+    args = parser.parse_args()
+
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.socket)
+    except OSError as e:
+        sys.exit(f"❌ Не удалось подключиться к {args.socket}: {e}")
+
+    stream = sock.makefile('r', encoding='utf-8', errors='replace')
+
+    def send(command: str) -> bool:
+        sock.sendall(f"{command}\n".encode())
+        return read_reply(stream)
+
+    with sock:
+        greeting = read_reply(stream)
+        if args.command:
+            send(' '.join(args.command))
+            return
+        if not greeting:
+            return
+
+        try:
+            import readline  # noqa: F401 - история и редактирование строки в input()
+        except ImportError:
+            pass
+
+        while True:
+            try:
+                command = input('bot> ').strip()
+            except (EOFError, KeyboardInterrupt):
+                print()
+                break
+            if command in ('/quit', '/exit'):
+                break
+            if command and not send(command):
+                print("⚠️ Бот закрыл соединение")
+                break
+
+if __name__ == "__main__":
+    main()